@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Cold-start benchmark for the Lambda handlers: init cost measured in fresh interpreters.
+
+    python cold_start_bench.py --runs 30
+    python cold_start_bench.py ../page_meta_data/main.py --runs 30 --importtime
+
+Every run starts a new Python process, as a new Lambda container would, with dummy
+credentials and region so no network is touched. It times the module import on its
+own and then the AWS client creation the handler needs before its first request
+(warm_clients / get_dynamodb, whichever the module has). Together they are the
+init work a cold container adds to the first join. --importtime prints the slowest
+imports of one extra run.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_TARGETS = [
+    os.path.join(HERE, 'webrtc_signaling_lambda.py'),
+    os.path.join(HERE, '..', 'page_meta_data', 'main.py'),
+]
+WARM_FUNCTIONS = ('warm_clients', 'get_dynamodb')
+
+CHILD = """
+import json, sys, time
+sys.path.insert(0, {directory!r})
+started = time.perf_counter()
+import {module} as target
+imported = time.perf_counter()
+for name in {warm_functions!r}:
+    if hasattr(target, name):
+        getattr(target, name)()
+        break
+warmed = time.perf_counter()
+print(json.dumps({{'import': imported - started, 'clients': warmed - imported}}))
+"""
+
+
+def child_environment():
+    env = dict(os.environ)
+    env.update({
+        'AWS_DEFAULT_REGION': 'us-east-1',
+        'AWS_ACCESS_KEY_ID': 'cold-start-bench',
+        'AWS_SECRET_ACCESS_KEY': 'cold-start-bench',
+        'AWS_EC2_METADATA_DISABLED': 'true',
+        'PREWARM_CLIENTS': '0',  # time the client creation separately from the import
+        'PYTHONDONTWRITEBYTECODE': '1',
+    })
+    return env
+
+
+def run_once(path, env, extra_args=()):
+    directory, filename = os.path.split(os.path.abspath(path))
+    code = CHILD.format(directory=directory, module=os.path.splitext(filename)[0], warm_functions=WARM_FUNCTIONS)
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, *extra_args, '-c', code], env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if result.returncode != 0:
+        raise SystemExit(f"{path} failed to import:\n{result.stderr}")
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    timings['process'] = elapsed
+    return timings, result.stderr
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def bench(path, runs, importtime):
+    env = child_environment()
+    run_once(path, env)  # populate the OS file cache so every measured run starts alike
+    samples = [run_once(path, env)[0] for _ in range(runs)]
+    for sample in samples:
+        sample['init'] = sample['import'] + sample['clients']
+
+    print(f"{os.path.relpath(path)} ({runs} fresh interpreters)")
+    print(f"  {'phase':<22}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for phase, label in (('import', 'module import'), ('clients', 'AWS client creation'),
+                         ('init', 'init total'), ('process', 'process wall time')):
+        values = [sample[phase] * 1000 for sample in samples]
+        print(f"  {label:<22}{percentile(values, 0.5):>9.1f}{percentile(values, 0.99):>9.1f}{max(values):>9.1f}")
+
+    if importtime:
+        _, stderr = run_once(path, env, ('-X', 'importtime'))
+        rows = []
+        for line in stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                _, cumulative, name = line.split('|')
+                if cumulative.strip().isdigit():
+                    rows.append((int(cumulative), name.rstrip()))
+        print("  slowest imports (cumulative us):")
+        for cumulative, name in sorted(rows, reverse=True)[:importtime]:
+            print(f"    {cumulative:>9} {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('targets', nargs='*', default=DEFAULT_TARGETS, help='Lambda handler modules to measure')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--importtime', type=int, nargs='?', const=12, default=0,
+                        help='also list the N slowest imports (default 12)')
+    args = parser.parse_args()
+    for path in args.targets:
+        bench(path, args.runs, args.importtime)
+
+
+if __name__ == '__main__':
+    main()
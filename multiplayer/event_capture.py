@@ -0,0 +1,114 @@
+import hashlib
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+
+# Capture of the events webrtc_signaling_lambda.lambda_handler receives, for replay_events.py.
+#
+# One JSON object per line: {"t": epoch ms, "e": "C" | "M" | "D", "c": connection, "b": message}.
+# Connection and player IDs are replaced by keyed hashes, so a capture keeps who talked to whom
+# without the real IDs; with a shared CAPTURE_SECRET every container maps an ID to the same
+# pseudonym, and captures from several containers merge into one stream. Routing tokens (which
+# carry a connection ID) are dropped, and SDP, ICE candidates and chat text are stored as just
+# their length ({"~": n}) and replayed as that many filler characters, so replayed messages cost
+# what the real ones did. Sampling is per connection, so a sampled connection's events are all kept.
+
+EVENT_CODES = {'CONNECT': 'C', 'MESSAGE': 'M', 'DISCONNECT': 'D'}
+EVENT_TYPES = {code: event_type for event_type, code in EVENT_CODES.items()}
+PLAYER_FIELDS = ('playerId', 'playerIds', 'from', 'to', 'targetId')
+DROPPED_FIELDS = ('token', 'tokens')
+BLANKED_FIELDS = ('sdp', 'candidate', 'usernameFragment', 'message', 'text')
+BLANK = '~'
+
+
+class EventRecorder:
+    """Appends anonymized events to a capture file ('-' for stdout, which Lambda ships to CloudWatch Logs)"""
+
+    def __init__(self, path, secret=None, sample_rate=1.0):
+        self.key = secret.encode('utf-8') if secret else os.urandom(32)
+        self.sample_rate = sample_rate
+        self.output = sys.stdout if path == '-' else open(path, 'a', buffering=1, encoding='utf-8')
+        self.lock = threading.Lock()
+        self.recorded = 0
+        self.skipped = 0
+
+    def pseudonym(self, prefix, value):
+        digest = hmac.new(self.key, f'{prefix}:{value}'.encode('utf-8'), hashlib.sha256).hexdigest()
+        return f'{prefix}-{digest[:12]}'
+
+    def sampled(self, connection_id):
+        if self.sample_rate >= 1.0:
+            return True
+        digest = hmac.new(self.key, connection_id.encode('utf-8'), hashlib.sha256).digest()
+        return int.from_bytes(digest[:4], 'big') < self.sample_rate * 2 ** 32
+
+    def anonymize(self, value, field=None):
+        if isinstance(value, dict):
+            return {k: self.anonymize(v, k) for k, v in value.items() if k not in DROPPED_FIELDS}
+        if isinstance(value, list):
+            return [self.anonymize(v, field) for v in value]
+        if isinstance(value, str):
+            if field in PLAYER_FIELDS:
+                return self.pseudonym('p', value)
+            if field in BLANKED_FIELDS:
+                return {BLANK: len(value)}
+        return value
+
+    def record(self, event):
+        """Append one lambda_handler event; returns False if its connection isn't sampled"""
+        context = event.get('requestContext', {})
+        code = EVENT_CODES.get(context.get('eventType'))
+        connection_id = context.get('connectionId')
+        if code is None or connection_id is None or not self.sampled(connection_id):
+            with self.lock:
+                self.skipped += 1
+            return False
+        entry = {'t': round(time.time() * 1000, 1), 'e': code, 'c': self.pseudonym('c', connection_id)}
+        if code == 'M':
+            try:
+                entry['b'] = self.anonymize(json.loads(event.get('body') or ''))
+            except ValueError:
+                # Kept as an unparseable body of the same size, so the replay exercises that path too
+                entry['b'] = {BLANK: len(event.get('body') or '')}
+        line = json.dumps(entry, separators=(',', ':'))
+        with self.lock:
+            self.output.write(line + '\n')
+            self.recorded += 1
+        return True
+
+    def stats(self):
+        with self.lock:
+            return {'recorded': self.recorded, 'skipped': self.skipped}
+
+
+def expand(value):
+    """A captured message with its blanked strings filled back in to their original length"""
+    if isinstance(value, dict):
+        if len(value) == 1 and BLANK in value:
+            return 'x' * value[BLANK]
+        return {k: expand(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [expand(v) for v in value]
+    return value
+
+
+def read_capture(paths):
+    """Events from capture files (or CloudWatch exports with other lines mixed in), oldest first"""
+    events = []
+    for path in paths:
+        with open(path, encoding='utf-8') as capture:
+            for line in capture:
+                line = line.strip()
+                if not line.startswith('{'):
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(entry, dict) and entry.get('e') in EVENT_TYPES and 'c' in entry and 't' in entry:
+                    events.append(entry)
+    events.sort(key=lambda entry: entry['t'])
+    return events
@@ -0,0 +1,61 @@
+import threading
+from collections import OrderedDict
+
+# Server relay for game data, used by webrtc_signaling_lambda.py when two players' DataChannel
+# can't connect (symmetric NAT and no TURN server).
+#
+# Relayed messages wait in a per-recipient buffer until the next tick, when each recipient gets
+# everything addressed to them as one relay_batch frame. A newer player_update from the same
+# sender replaces the buffered one (only the latest position matters); events such as
+# projectile_fired are all kept, in order. player_hit goes the same way because multiplayer.js
+# broadcasts it to peers like any other game message.
+
+RELAYED_TYPES = ('player_update', 'projectile_fired', 'player_hit')
+COALESCED_TYPES = ('player_update',)
+
+
+class RelayHub:
+    """Per-recipient buffers of relayed game messages waiting for the next flush"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}  # recipient player_id -> OrderedDict of key -> message
+        self.sequence = 0
+        self.submitted = 0
+        self.superseded = 0
+
+    def submit(self, sender, recipients, message):
+        """Queue `message` from `sender` for each recipient; returns how many recipients it was queued for"""
+        entry = dict(message, **{'from': sender})
+        coalesced = message.get('type') in COALESCED_TYPES
+        queued = 0
+        with self.lock:
+            for recipient in recipients:
+                if recipient == sender:
+                    continue
+                buffer = self.pending.setdefault(recipient, OrderedDict())
+                if coalesced:
+                    key = ('update', sender)
+                    if buffer.pop(key, None) is not None:
+                        self.superseded += 1
+                else:
+                    key = self.sequence
+                    self.sequence += 1
+                buffer[key] = entry
+                queued += 1
+            self.submitted += queued
+        return queued
+
+    def drain(self):
+        """Take everything buffered: {recipient: [messages in arrival order]}"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return {recipient: list(buffer.values()) for recipient, buffer in pending.items()}
+
+    def stats(self):
+        with self.lock:
+            return {
+                'submitted': self.submitted,
+                'superseded': self.superseded,
+                'pending_recipients': len(self.pending)
+            }
@@ -0,0 +1,853 @@
+import copy
+import json
+import math
+import re
+import threading
+import time
+from decimal import Decimal
+from botocore.exceptions import ClientError
+
+# In-memory stand-in for the boto3 DynamoDB resource API (and, through LocalDynamoDBClient,
+# the low-level client API) used by the signaling Lambda.
+#
+# It understands the subset of the expression language the Lambda uses (SET/ADD/
+# DELETE/REMOVE updates, condition/filter/key-condition expressions) and keeps
+# DynamoDB-style read/write capacity accounting per table, so benchmarks can compare
+# how many units a code path burns:
+#   - GetItem / BatchGetItem: 1 RCU per 4 KB per item (0.5 if eventually consistent)
+#   - Scan / Query: 1 RCU per 4 KB of *scanned* data (0.5 if eventually consistent)
+#   - Writes: 1 WCU per 1 KB of the larger of the old and new item, min 1
+
+READ_UNIT_BYTES = 4096
+WRITE_UNIT_BYTES = 1024
+PAGE_BYTES = 1024 * 1024
+
+
+def client_error(code, message, operation):
+    """Build a botocore ClientError the way the real SDK raises it"""
+    return ClientError({'Error': {'Code': code, 'Message': message}}, operation)
+
+
+def to_dynamo(value):
+    """Deep-copy a value into its stored form, enforcing the boto3 serializer's rules"""
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, float):
+        raise TypeError('Float types are not supported. Use Decimal types instead.')
+    if isinstance(value, int):
+        return Decimal(value)
+    if isinstance(value, (str, bytes, Decimal)):
+        return value
+    if isinstance(value, (set, frozenset)):
+        if not value:
+            raise client_error('ValidationException', 'One or more parameter values were invalid: An string set may not be empty', 'UpdateItem')
+        return {to_dynamo(v) for v in value}
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamo(v) for v in value]
+    raise TypeError(f'Unsupported type "{type(value)}" for value "{value}"')
+
+
+def item_size(value):
+    """Approximate DynamoDB item size in bytes"""
+    if value is None or isinstance(value, bool):
+        return 1
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, Decimal):
+        return len(str(value).lstrip('-').replace('.', '')) // 2 + 2
+    if isinstance(value, (set, frozenset)):
+        return sum(item_size(v) for v in value)
+    if isinstance(value, dict):
+        return 3 + sum(len(k.encode('utf-8')) + 1 + item_size(v) for k, v in value.items())
+    if isinstance(value, list):
+        return 3 + sum(1 + item_size(v) for v in value)
+    return len(str(value))
+
+
+def read_units(size, consistent):
+    units = max(1, math.ceil(size / READ_UNIT_BYTES))
+    return units if consistent else units / 2
+
+
+def write_units(size):
+    return max(1, math.ceil(size / WRITE_UNIT_BYTES))
+
+
+# ---------------------------------------------------------------------------
+# Expression parsing
+# ---------------------------------------------------------------------------
+
+_TOKEN_RE = re.compile(r'\s*(?:(<>|<=|>=|[=<>(),+\-\[\].])|(#[A-Za-z0-9_]+)|(:[A-Za-z0-9_]+)|([A-Za-z_][A-Za-z0-9_]*)|(\d+))')
+_MISSING = object()
+
+
+def _tokenize(expression):
+    tokens = []
+    pos = 0
+    expression = expression.strip()
+    while pos < len(expression):
+        match = _TOKEN_RE.match(expression, pos)
+        if not match or match.end() == pos:
+            raise client_error('ValidationException', f'Invalid expression near: {expression[pos:]}', 'Expression')
+        tokens.append(next(g for g in match.groups() if g is not None))
+        pos = match.end()
+    return tokens
+
+
+class _Parser:
+    """Recursive-descent parser producing small tuples that the evaluator walks"""
+
+    def __init__(self, expression, names, values):
+        self.tokens = _tokenize(expression)
+        self.pos = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self, offset=0):
+        index = self.pos + offset
+        return self.tokens[index] if index < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if token is None or (expected and token.upper() != expected):
+            raise client_error('ValidationException', f'Expected {expected}, got {token}', 'Expression')
+        self.pos += 1
+        return token
+
+    def done(self):
+        return self.pos >= len(self.tokens)
+
+    # -- operands ---------------------------------------------------------
+    def path(self):
+        parts = [self.name(self.take())]
+        while self.peek() in ('.', '['):
+            if self.take() == '.':
+                parts.append(self.name(self.take()))
+            else:
+                parts.append(int(self.take()))
+                self.take(']')
+        return ('path', parts)
+
+    def name(self, token):
+        if token.startswith('#'):
+            if token not in self.names:
+                raise client_error('ValidationException', f'Undefined attribute name {token}', 'Expression')
+            return self.names[token]
+        return token
+
+    def operand(self):
+        token = self.peek()
+        if token.startswith(':'):
+            self.take()
+            if token not in self.values:
+                raise client_error('ValidationException', f'Undefined attribute value {token}', 'Expression')
+            return ('value', to_dynamo(self.values[token]))
+        if self.peek(1) == '(':
+            function = self.take().lower()
+            self.take('(')
+            args = [self.operand()]
+            while self.peek() == ',':
+                self.take(',')
+                args.append(self.operand())
+            self.take(')')
+            return ('call', function, args)
+        return self.path()
+
+    def set_value(self):
+        left = self.operand()
+        if self.peek() in ('+', '-'):
+            op = self.take()
+            return ('arith', op, left, self.operand())
+        return left
+
+    # -- conditions -------------------------------------------------------
+    def condition(self):
+        node = self.conjunction()
+        while self.peek() and self.peek().upper() == 'OR':
+            self.take()
+            node = ('or', node, self.conjunction())
+        return node
+
+    def conjunction(self):
+        node = self.negation()
+        while self.peek() and self.peek().upper() == 'AND':
+            self.take()
+            node = ('and', node, self.negation())
+        return node
+
+    def negation(self):
+        if self.peek() and self.peek().upper() == 'NOT':
+            self.take()
+            return ('not', self.negation())
+        if self.peek() == '(':
+            self.take('(')
+            node = self.condition()
+            self.take(')')
+            return node
+        left = self.operand()
+        token = self.peek()
+        if token in ('=', '<>', '<', '<=', '>', '>='):
+            self.take()
+            return ('cmp', token, left, self.operand())
+        if token and token.upper() == 'BETWEEN':
+            self.take()
+            low = self.operand()
+            self.take('AND')
+            return ('between', left, low, self.operand())
+        if token and token.upper() == 'IN':
+            self.take()
+            self.take('(')
+            options = [self.operand()]
+            while self.peek() == ',':
+                self.take(',')
+                options.append(self.operand())
+            self.take(')')
+            return ('in', left, options)
+        if left[0] != 'call':
+            raise client_error('ValidationException', f'Expected a condition near {token}', 'Expression')
+        return ('fn', left)
+
+    # -- updates ----------------------------------------------------------
+    def update(self):
+        actions = []
+        while not self.done():
+            clause = self.take().upper()
+            if clause not in ('SET', 'REMOVE', 'ADD', 'DELETE'):
+                raise client_error('ValidationException', f'Unknown update clause {clause}', 'Expression')
+            while True:
+                target = self.path()
+                if clause == 'SET':
+                    self.take('=')
+                    actions.append(('SET', target, self.set_value()))
+                elif clause == 'REMOVE':
+                    actions.append(('REMOVE', target, None))
+                else:
+                    actions.append((clause, target, self.operand()))
+                if self.peek() != ',':
+                    break
+                self.take(',')
+        return actions
+
+
+def _get_path(item, parts):
+    current = item
+    for part in parts:
+        if isinstance(part, int):
+            if not isinstance(current, list) or part >= len(current):
+                return _MISSING
+            current = current[part]
+        else:
+            if not isinstance(current, dict) or part not in current:
+                return _MISSING
+            current = current[part]
+    return current
+
+
+def _set_path(item, parts, value):
+    parent = _get_path(item, parts[:-1])
+    if not isinstance(parent, list if isinstance(parts[-1], int) else dict):
+        raise client_error('ValidationException',
+                           'The document path provided in the update expression is invalid for update',
+                           'UpdateItem')
+    parent[parts[-1]] = value
+
+
+def _remove_path(item, parts):
+    parent = _get_path(item, parts[:-1]) if len(parts) > 1 else item
+    if isinstance(parent, dict):
+        parent.pop(parts[-1], None)
+    elif isinstance(parent, list) and parts[-1] < len(parent):
+        parent.pop(parts[-1])
+
+
+def _eval_operand(node, item):
+    kind = node[0]
+    if kind == 'value':
+        return node[1]
+    if kind == 'path':
+        return _get_path(item, node[1])
+    if kind == 'arith':
+        left, right = _eval_operand(node[2], item), _eval_operand(node[3], item)
+        if not isinstance(left, Decimal) or not isinstance(right, Decimal):
+            raise client_error('ValidationException',
+                               'An operand in the update expression has an incorrect data type', 'UpdateItem')
+        return left + right if node[1] == '+' else left - right
+    function, args = node[1], node[2]
+    if function == 'if_not_exists':
+        current = _eval_operand(args[0], item)
+        return _eval_operand(args[1], item) if current is _MISSING else current
+    if function == 'list_append':
+        return list(_eval_operand(args[0], item)) + list(_eval_operand(args[1], item))
+    if function == 'size':
+        value = _eval_operand(args[0], item)
+        return _MISSING if value is _MISSING else Decimal(len(value))
+    return _eval_function(function, args, item)
+
+
+def _type_code(value):
+    if isinstance(value, bool):
+        return 'BOOL'
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (set, frozenset)):
+        return 'SS' if all(isinstance(v, str) for v in value) else 'NS'
+    return {str: 'S', Decimal: 'N', bytes: 'B', dict: 'M', list: 'L'}.get(type(value))
+
+
+def _eval_function(function, args, item):
+    if function == 'attribute_type':
+        value = _eval_operand(args[0], item)
+        return value is not _MISSING and _type_code(value) == _eval_operand(args[1], item)
+    if function == 'attribute_exists':
+        return _eval_operand(args[0], item) is not _MISSING
+    if function == 'attribute_not_exists':
+        return _eval_operand(args[0], item) is _MISSING
+    if function == 'begins_with':
+        value = _eval_operand(args[0], item)
+        return isinstance(value, str) and value.startswith(_eval_operand(args[1], item))
+    if function == 'contains':
+        value = _eval_operand(args[0], item)
+        return value is not _MISSING and value is not None and _eval_operand(args[1], item) in value
+    raise client_error('ValidationException', f'Unsupported function {function}', 'Expression')
+
+
+def _compare(op, left, right):
+    if left is _MISSING or right is _MISSING:
+        return op == '<>' and left is not right
+    try:
+        if op == '=':
+            return left == right
+        if op == '<>':
+            return left != right
+        if op == '<':
+            return left < right
+        if op == '<=':
+            return left <= right
+        if op == '>':
+            return left > right
+        return left >= right
+    except TypeError:
+        return False
+
+
+def _eval_condition(node, item):
+    kind = node[0]
+    if kind == 'and':
+        return _eval_condition(node[1], item) and _eval_condition(node[2], item)
+    if kind == 'or':
+        return _eval_condition(node[1], item) or _eval_condition(node[2], item)
+    if kind == 'not':
+        return not _eval_condition(node[1], item)
+    if kind == 'cmp':
+        return _compare(node[1], _eval_operand(node[2], item), _eval_operand(node[3], item))
+    if kind == 'between':
+        value = _eval_operand(node[1], item)
+        return _compare('>=', value, _eval_operand(node[2], item)) and _compare('<=', value, _eval_operand(node[3], item))
+    if kind == 'in':
+        value = _eval_operand(node[1], item)
+        return any(_compare('=', value, _eval_operand(option, item)) for option in node[2])
+    return _eval_function(node[1][1], node[1][2], item)
+
+
+def compile_condition(expression, names=None, values=None):
+    """Parse a condition/filter expression once into a predicate over items"""
+    if not expression:
+        return lambda item: True
+    node = _Parser(expression, names, values).condition()
+    return lambda item: _eval_condition(node, item)
+
+
+def matches(expression, item, names=None, values=None):
+    """Evaluate a condition/filter expression against an item"""
+    return compile_condition(expression, names, values)(item)
+
+
+def apply_update(expression, item, names=None, values=None):
+    """Apply an update expression to an item in place"""
+    # Like DynamoDB, every operand sees the item as it was before the update
+    actions = [
+        (action, target[1], None if operand is None else _eval_operand(operand, item))
+        for action, target, operand in _Parser(expression, names, values).update()
+    ]
+    for action, parts, value in actions:
+        if action == 'SET':
+            _set_path(item, parts, copy.deepcopy(value))
+        elif action == 'REMOVE':
+            _remove_path(item, parts)
+        elif action == 'ADD':
+            current = _get_path(item, parts)
+            if current is _MISSING:
+                _set_path(item, parts, copy.deepcopy(value))
+            elif isinstance(current, set):
+                current |= value
+            else:
+                _set_path(item, parts, current + value)
+        elif action == 'DELETE':
+            current = _get_path(item, parts)
+            if isinstance(current, set):
+                current -= value
+                if not current:
+                    _remove_path(item, parts)
+
+
+# ---------------------------------------------------------------------------
+# Tables
+# ---------------------------------------------------------------------------
+
+class LocalTable:
+    """A single DynamoDB table held in a dict, keyed by (hash, range)"""
+
+    def __init__(self, name, hash_key, range_key=None, indexes=None, latency=0.0):
+        self.name = name
+        self.table_name = name
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.indexes = indexes or {}  # index name -> (hash_key, range_key)
+        self.items = {}
+        self.lock = threading.RLock()
+        self.latency = latency  # seconds each request takes, so concurrent callers interleave like real ones
+        self.consumed = threading.local()  # units used by this thread's calls, for ReturnConsumedCapacity
+        self.reset_counters()
+
+    def _delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def reset_counters(self):
+        self.read_units = 0.0
+        self.write_units = 0.0
+        self.calls = {}
+
+    def _count(self, operation, reads=0.0, writes=0.0):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+            self.read_units += reads
+            self.write_units += writes
+        self.consumed.units = getattr(self.consumed, 'units', 0.0) + reads + writes
+
+    def take_consumed(self):
+        """Units used by this thread's calls since the last take_consumed"""
+        units, self.consumed.units = getattr(self.consumed, 'units', 0.0), 0.0
+        return units
+
+    def _key(self, key):
+        if self.hash_key not in key or key[self.hash_key] is None:
+            raise client_error('ValidationException',
+                               'The provided key element does not match the schema', 'GetItem')
+        if self.range_key:
+            return (to_dynamo(key[self.hash_key]), to_dynamo(key.get(self.range_key)))
+        return (to_dynamo(key[self.hash_key]),)
+
+    def _key_of(self, item):
+        return self._key({k: item.get(k) for k in (self.hash_key, self.range_key) if k})
+
+    def _check(self, expression, item, names, values, operation, return_on_failure=None):
+        if expression and not matches(expression, item or {}, names, values):
+            error = client_error('ConditionalCheckFailedException', 'The conditional request failed', operation)
+            if return_on_failure == 'ALL_OLD' and item is not None:
+                error.response['Item'] = copy.deepcopy(item)
+            raise error
+
+    @staticmethod
+    def _returned(old, new, return_values):
+        if return_values == 'ALL_OLD' and old is not None:
+            return {'Attributes': copy.deepcopy(old)}
+        if return_values in ('ALL_NEW', 'UPDATED_NEW') and new is not None:
+            return {'Attributes': copy.deepcopy(new)}
+        return {}
+
+    # -- item operations --------------------------------------------------
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        self._delay()
+        with self.lock:
+            item = self.items.get(self._key(Key))
+            self._count('GetItem', reads=read_units(item_size(item) if item else 0, ConsistentRead))
+            return {'Item': copy.deepcopy(item)} if item is not None else {}
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None,
+                 ExpressionAttributeValues=None, ReturnValues=None, ReturnValuesOnConditionCheckFailure=None,
+                 **kwargs):
+        self._delay()
+        new = to_dynamo(Item)
+        with self.lock:
+            key = self._key_of(new)
+            old = self.items.get(key)
+            self._count('PutItem', writes=write_units(max(item_size(old) if old else 0, item_size(new))))
+            self._check(ConditionExpression, old, ExpressionAttributeNames, ExpressionAttributeValues, 'PutItem',
+                        ReturnValuesOnConditionCheckFailure)
+            self.items[key] = new
+            return self._returned(old, None, ReturnValues)
+
+    def update_item(self, Key, UpdateExpression=None, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None, ReturnValuesOnConditionCheckFailure=None,
+                    **kwargs):
+        self._delay()
+        with self.lock:
+            key = self._key(Key)
+            old = self.items.get(key)
+            new = copy.deepcopy(old) if old is not None else to_dynamo(dict(Key))
+            try:
+                self._check(ConditionExpression, old, ExpressionAttributeNames, ExpressionAttributeValues,
+                            'UpdateItem', ReturnValuesOnConditionCheckFailure)
+                if UpdateExpression:
+                    apply_update(UpdateExpression, new, ExpressionAttributeNames, ExpressionAttributeValues)
+            finally:
+                self._count('UpdateItem', writes=write_units(max(item_size(old) if old else 0, item_size(new))))
+            self.items[key] = new
+            return self._returned(old, new, ReturnValues)
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None,
+                    ExpressionAttributeValues=None, ReturnValues=None, ReturnValuesOnConditionCheckFailure=None,
+                    **kwargs):
+        self._delay()
+        with self.lock:
+            key = self._key(Key)
+            old = self.items.get(key)
+            self._count('DeleteItem', writes=write_units(item_size(old) if old else 0))
+            self._check(ConditionExpression, old, ExpressionAttributeNames, ExpressionAttributeValues, 'DeleteItem',
+                        ReturnValuesOnConditionCheckFailure)
+            self.items.pop(key, None)
+            return self._returned(old, None, ReturnValues)
+
+    # -- multi-item reads -------------------------------------------------
+    def _page(self, operation, candidates, key_fn, FilterExpression, ExpressionAttributeNames,
+              ExpressionAttributeValues, ExclusiveStartKey, Limit, ConsistentRead, Select=None, order=None):
+        if ExclusiveStartKey is not None:
+            start = key_fn(ExclusiveStartKey)
+            keys = [key_fn(item) for item in candidates]
+            if start in keys:
+                candidates = candidates[keys.index(start) + 1:]
+            elif order is not None:
+                # The item the last page ended on has since been deleted: carry on from where it was
+                candidates = [item for item in candidates if order(item) > order(ExclusiveStartKey)]
+            else:
+                candidates = []
+        scanned_bytes = 0
+        scanned = []
+        last_key = None
+        for item in candidates:
+            if Limit is not None and len(scanned) >= Limit or scanned_bytes >= PAGE_BYTES:
+                last_key = scanned[-1]
+                break
+            scanned.append(item)
+            scanned_bytes += item_size(item)
+        keep = compile_condition(FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        items = [copy.deepcopy(item) for item in scanned if keep(item)]
+        self._count(operation, reads=read_units(scanned_bytes, ConsistentRead))
+        response = {'Count': len(items), 'ScannedCount': len(scanned)}
+        if Select != 'COUNT':
+            response['Items'] = items
+        if last_key is not None:
+            response['LastEvaluatedKey'] = {k: last_key[k] for k in self._key_names(last_key)}
+        return response
+
+    def _key_names(self, item):
+        names = [self.hash_key] + ([self.range_key] if self.range_key else [])
+        for index_hash, index_range in self.indexes.values():
+            names += [name for name in (index_hash, index_range) if name and name in item]
+        return list(dict.fromkeys(names))
+
+    def scan(self, FilterExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+             ExclusiveStartKey=None, Limit=None, ConsistentRead=False, Select=None, **kwargs):
+        self._delay()
+        with self.lock:
+            # Scans walk the table in key order (DynamoDB's is by key hash: also stable, just not readable)
+            order = lambda item: tuple(str(part) for part in self._key_of(item))
+            candidates = sorted(self.items.values(), key=order)
+            return self._page('Scan', candidates, self._key_of, FilterExpression, ExpressionAttributeNames,
+                              ExpressionAttributeValues, ExclusiveStartKey, Limit, ConsistentRead, Select, order)
+
+    def query(self, KeyConditionExpression, IndexName=None, FilterExpression=None, ExpressionAttributeNames=None,
+              ExpressionAttributeValues=None, ExclusiveStartKey=None, Limit=None, ConsistentRead=False,
+              ScanIndexForward=True, Select=None, **kwargs):
+        self._delay()
+        with self.lock:
+            hash_key, range_key = self.indexes[IndexName] if IndexName else (self.hash_key, self.range_key)
+            in_key = compile_condition(KeyConditionExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+            candidates = [item for item in self.items.values() if item.get(hash_key) is not None and in_key(item)]
+            if range_key:
+                candidates.sort(key=lambda item: item.get(range_key), reverse=not ScanIndexForward)
+            return self._page('Query', candidates, self._key_of, FilterExpression, ExpressionAttributeNames,
+                              ExpressionAttributeValues, ExclusiveStartKey, Limit, ConsistentRead, Select)
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return _BatchWriter(self)
+
+
+class _BatchWriter:
+    """Mirrors boto3's Table.batch_writer: buffers requests and flushes in groups of 25"""
+
+    def __init__(self, table):
+        self.table = table
+        self.pending = []
+
+    def put_item(self, Item):
+        self.pending.append({'PutRequest': {'Item': Item}})
+        self._maybe_flush()
+
+    def delete_item(self, Key):
+        self.pending.append({'DeleteRequest': {'Key': Key}})
+        self._maybe_flush()
+
+    def _maybe_flush(self):
+        if len(self.pending) >= 25:
+            self.flush()
+
+    def flush(self):
+        while self.pending:
+            batch, self.pending = self.pending[:25], self.pending[25:]
+            self.table._count('BatchWriteItem', writes=_write_batch(self.table, batch))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+def _write_batch(table, requests):
+    """Apply a batch of put/delete requests; returns the write units they used"""
+    units = 0.0
+    with table.lock:
+        for request in requests:
+            if 'PutRequest' in request:
+                new = to_dynamo(request['PutRequest']['Item'])
+                key = table._key_of(new)
+                old = table.items.get(key)
+                units += write_units(max(item_size(old) if old else 0, item_size(new)))
+                table.items[key] = new
+            else:
+                key = table._key(request['DeleteRequest']['Key'])
+                old = table.items.pop(key, None)
+                units += write_units(item_size(old) if old else 0)
+    return units
+
+
+class LocalDynamoDB:
+    """Drop-in for boto3.resource('dynamodb') covering Table, batch_get_item and batch_write_item"""
+
+    def __init__(self, latency=0.0):
+        self.tables = {}
+        self.latency = latency
+
+    def create_table(self, name, hash_key, range_key=None, indexes=None):
+        self.tables[name] = LocalTable(name, hash_key, range_key, indexes, latency=self.latency)
+        return self.tables[name]
+
+    def Table(self, name):
+        if name not in self.tables:
+            raise client_error('ResourceNotFoundException', f'Requested resource not found: {name}', 'DescribeTable')
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        responses = {}
+        requested = sum(len(spec['Keys']) for spec in RequestItems.values())
+        if requested > 100:
+            raise client_error('ValidationException', 'Too many items requested for the BatchGetItem call',
+                               'BatchGetItem')
+        for name, spec in RequestItems.items():
+            table = self.Table(name)
+            consistent = spec.get('ConsistentRead', False)
+            found = []
+            with table.lock:
+                units = 0.0
+                for key in spec['Keys']:
+                    item = table.items.get(table._key(key))
+                    units += read_units(item_size(item) if item else 0, consistent)
+                    if item is not None:
+                        found.append(copy.deepcopy(item))
+                table._count('BatchGetItem', reads=units)
+            responses[name] = found
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise client_error('ValidationException', 'Too many items requested for the BatchWriteItem call',
+                               'BatchWriteItem')
+        for name, requests in RequestItems.items():
+            table = self.Table(name)
+            table._count('BatchWriteItem', writes=_write_batch(table, requests))
+        return {'UnprocessedItems': {}}
+
+    def client(self):
+        """The same tables behind the low-level client API"""
+        return LocalDynamoDBClient(self)
+
+    def reset_counters(self):
+        for table in self.tables.values():
+            table.reset_counters()
+
+    def usage(self):
+        """Summarise calls and consumed capacity across all tables"""
+        return {
+            name: {
+                'read_units': table.read_units,
+                'write_units': table.write_units,
+                'calls': dict(table.calls),
+            }
+            for name, table in self.tables.items()
+        }
+
+
+class LocalDynamoDBClient:
+    """Drop-in for boto3.client('dynamodb'): converts typed attribute values and delegates to a LocalDynamoDB"""
+
+    TYPED_REQUEST = ('Item', 'Key', 'ExpressionAttributeValues', 'ExclusiveStartKey')
+    TYPED_RESPONSE = ('Item', 'Attributes', 'LastEvaluatedKey')
+
+    def __init__(self, db):
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+        self.db = db
+        self._serialize = TypeSerializer().serialize
+        self._deserialize = TypeDeserializer().deserialize
+
+    def _native(self, values):
+        return {k: self._deserialize(v) for k, v in values.items()}
+
+    def _typed(self, values):
+        return {k: self._serialize(v) for k, v in values.items()}
+
+    @staticmethod
+    def _consumed(table):
+        return {'TableName': table.name, 'CapacityUnits': table.take_consumed()}
+
+    def _call(self, operation, TableName, ReturnConsumedCapacity='NONE', **kwargs):
+        for name in self.TYPED_REQUEST:
+            if kwargs.get(name) is not None:
+                kwargs[name] = self._native(kwargs[name])
+        table = self.db.Table(TableName)
+        table.take_consumed()
+        try:
+            response = getattr(table, operation)(**kwargs)
+        except ClientError as e:
+            if 'Item' in e.response:
+                e.response['Item'] = self._typed(e.response['Item'])
+            raise
+        for name in self.TYPED_RESPONSE:
+            if name in response:
+                response[name] = self._typed(response[name])
+        if 'Items' in response:
+            response['Items'] = [self._typed(item) for item in response['Items']]
+        if ReturnConsumedCapacity != 'NONE':
+            response['ConsumedCapacity'] = self._consumed(table)
+        return response
+
+    def get_item(self, **kwargs):
+        return self._call('get_item', **kwargs)
+
+    def put_item(self, **kwargs):
+        return self._call('put_item', **kwargs)
+
+    def update_item(self, **kwargs):
+        return self._call('update_item', **kwargs)
+
+    def delete_item(self, **kwargs):
+        return self._call('delete_item', **kwargs)
+
+    def scan(self, **kwargs):
+        return self._call('scan', **kwargs)
+
+    def query(self, **kwargs):
+        return self._call('query', **kwargs)
+
+    def batch_get_item(self, RequestItems, ReturnConsumedCapacity='NONE', **kwargs):
+        request = {
+            name: dict(spec, Keys=[self._native(key) for key in spec['Keys']])
+            for name, spec in RequestItems.items()
+        }
+        tables = [self.db.Table(name) for name in request]
+        for table in tables:
+            table.take_consumed()
+        response = self.db.batch_get_item(RequestItems=request, **kwargs)
+        response['Responses'] = {
+            name: [self._typed(item) for item in items] for name, items in response['Responses'].items()
+        }
+        if ReturnConsumedCapacity != 'NONE':
+            response['ConsumedCapacity'] = [self._consumed(table) for table in tables]
+        return response
+
+    def batch_write_item(self, RequestItems, ReturnConsumedCapacity='NONE', **kwargs):
+        request = {}
+        for name, requests in RequestItems.items():
+            request[name] = [
+                {'PutRequest': {'Item': self._native(r['PutRequest']['Item'])}} if 'PutRequest' in r
+                else {'DeleteRequest': {'Key': self._native(r['DeleteRequest']['Key'])}}
+                for r in requests
+            ]
+        tables = [self.db.Table(name) for name in request]
+        for table in tables:
+            table.take_consumed()
+        response = self.db.batch_write_item(RequestItems=request, **kwargs)
+        if ReturnConsumedCapacity != 'NONE':
+            response['ConsumedCapacity'] = [self._consumed(table) for table in tables]
+        return response
+
+
+class LocalApiGatewayManagementApi:
+    """Drop-in for the apigatewaymanagementapi client: records every frame sent per connection"""
+
+    def __init__(self, latency=0.0, rate_limit=0, burst=0, max_payload=0):
+        self.connections = {}
+        self.lock = threading.Lock()
+        self.post_count = 0
+        self.latency = latency  # seconds each post_to_connection takes, to model the network round trip
+        # Optional API Gateway limits: posts beyond rate_limit a second (after a burst) are throttled,
+        # and frames over max_payload bytes are rejected
+        self.rate_limit = rate_limit
+        self.burst = burst or rate_limit
+        self.tokens = float(self.burst)
+        self.refilled = time.monotonic()
+        self.max_payload = max_payload
+        self.throttled_count = 0
+        self.too_large_count = 0
+
+    def connect(self, connection_id):
+        with self.lock:
+            self.connections[connection_id] = []
+
+    def disconnect(self, connection_id):
+        with self.lock:
+            self.connections.pop(connection_id, None)
+
+    def post_to_connection(self, ConnectionId, Data):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            self.post_count += 1
+            if self.rate_limit:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate_limit)
+                self.refilled = now
+                if self.tokens < 1:
+                    self.throttled_count += 1
+                    raise client_error('LimitExceededException', 'Rate exceeded', 'PostToConnection')
+                self.tokens -= 1
+            if self.max_payload and len(Data) > self.max_payload:
+                self.too_large_count += 1
+                raise client_error('PayloadTooLargeException', 'Message too long', 'PostToConnection')
+            if ConnectionId not in self.connections:
+                raise client_error('GoneException', 'Connection is gone', 'PostToConnection')
+            self.connections[ConnectionId].append(Data)
+        return {}
+
+    def get_connection(self, ConnectionId):
+        with self.lock:
+            if ConnectionId not in self.connections:
+                raise client_error('GoneException', 'Connection is gone', 'GetConnection')
+        return {'ConnectionId': ConnectionId}
+
+    def delete_connection(self, ConnectionId):
+        self.disconnect(ConnectionId)
+        return {}
+
+    def messages(self, connection_id, start=0):
+        """Decode everything delivered to a connection (from the start-th frame on)"""
+        with self.lock:
+            frames = self.connections.get(connection_id, [])[start:]
+        return [json.loads(frame) for frame in frames]
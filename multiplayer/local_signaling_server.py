@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""Self-hosted WebSocket signaling server that runs the Lambda handlers in-process.
+
+    pip install websockets        (uvloop optional, picked up if installed)
+    python local_signaling_server.py --port 8765 [--store sqlite --sqlite-path signaling.db] [--relay-tick-ms 50] [--reap-every 60] [--leave-window-ms 500] [--capture events.jsonl]
+
+Then point multiplayer.js at it: this.signalServer = "ws://localhost:8765/";
+
+CONNECT, DISCONNECT and MESSAGE events are built the way API Gateway builds them
+and passed to webrtc_signaling_lambda.lambda_handler, with storage swapped for the
+in-memory (default) or SQLite backend and post_to_connection delivering straight
+to the open sockets. Handlers run on the event loop thread, so one core can hold
+tens of thousands of mostly idle sockets (raise `ulimit -n` first). Relayed game
+data is flushed to its recipients once per --relay-tick-ms (0 sends it straight on).
+Connections whose heartbeats have stopped are reaped every --reap-every seconds,
+starting with any left in the SQLite database by a previous run. Leaves from
+disconnects are collected per room for --leave-window-ms and flushed together
+by a timer, so no handler blocks the loop waiting out the window. --capture
+appends every event, anonymized, to a file that replay_events.py can replay.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import uuid
+from botocore.exceptions import ClientError
+
+try:
+    import websockets
+except ImportError:
+    raise SystemExit("local_signaling_server.py needs the websockets package: pip install websockets")
+
+import signaling_storage
+import webrtc_signaling_lambda as signaling
+from event_capture import EventRecorder
+
+logger = logging.getLogger('local_signaling_server')
+
+
+class LocalSocketApi:
+    """Stands in for the apigatewaymanagementapi client, posting to sockets held by this process"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.outboxes = {}  # connection_id -> asyncio.Queue of text frames
+        self.sockets = {}
+
+    def register(self, connection_id, websocket):
+        self.outboxes[connection_id] = asyncio.Queue()
+        self.sockets[connection_id] = websocket
+        return self.outboxes[connection_id]
+
+    def unregister(self, connection_id):
+        self.outboxes.pop(connection_id, None)
+        self.sockets.pop(connection_id, None)
+
+    def _gone(self, operation):
+        return ClientError({'Error': {'Code': 'GoneException', 'Message': 'Connection is gone'}}, operation)
+
+    def post_to_connection(self, ConnectionId, Data):
+        outbox = self.outboxes.get(ConnectionId)
+        if outbox is None:
+            raise self._gone('PostToConnection')
+        frame = Data.decode('utf-8') if isinstance(Data, bytes) else Data
+        # Broadcasts post from the fan-out thread pool; everything else is already on the loop
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self.loop:
+            outbox.put_nowait(frame)
+        else:
+            self.loop.call_soon_threadsafe(outbox.put_nowait, frame)
+        return {}
+
+    def get_connection(self, ConnectionId):
+        if ConnectionId not in self.outboxes:
+            raise self._gone('GetConnection')
+        return {'ConnectionId': ConnectionId}
+
+    def delete_connection(self, ConnectionId):
+        websocket = self.sockets.get(ConnectionId)
+        if websocket is None:
+            raise self._gone('DeleteConnection')
+        self.loop.create_task(websocket.close())
+        return {}
+
+
+def install_local_backend(api, backend, sqlite_path):
+    """Swap the Lambda module's AWS resources for local ones"""
+    if backend == 'sqlite':
+        signaling.store = signaling_storage.SQLiteStore(sqlite_path)
+    else:
+        signaling.store = signaling_storage.MemoryStore()
+    signaling.api_client = api
+
+
+def make_event(event_type, connection_id, host, stage, headers=None, body=None):
+    event = {
+        'requestContext': {
+            'eventType': event_type,
+            'routeKey': {'CONNECT': '$connect', 'DISCONNECT': '$disconnect'}.get(event_type, '$default'),
+            'connectionId': connection_id,
+            'domainName': host,
+            'stage': stage
+        }
+    }
+    if headers is not None:
+        event['headers'] = headers
+    if body is not None:
+        event['body'] = body
+    return event
+
+
+async def drain_outbox(websocket, outbox):
+    """Write queued frames to the socket in order"""
+    while True:
+        frame = await outbox.get()
+        await websocket.send(frame)
+
+
+def make_connection_handler(api, host, stage):
+    async def handle_connection(websocket):
+        connection_id = uuid.uuid4().hex[:16]
+        outbox = api.register(connection_id, websocket)
+        request = getattr(websocket, 'request', None)
+        headers = dict(request.headers) if request else dict(getattr(websocket, 'request_headers', {}))
+
+        response = signaling.lambda_handler(make_event('CONNECT', connection_id, host, stage, headers=headers), None)
+        if response.get('statusCode') != 200:
+            api.unregister(connection_id)
+            await websocket.close(code=1011, reason='Connect rejected')
+            return
+
+        writer = asyncio.create_task(drain_outbox(websocket, outbox))
+        try:
+            async for frame in websocket:
+                if isinstance(frame, bytes):
+                    frame = frame.decode('utf-8', errors='replace')
+                signaling.lambda_handler(make_event('MESSAGE', connection_id, host, stage, body=frame), None)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            api.unregister(connection_id)
+            writer.cancel()
+            signaling.lambda_handler(make_event('DISCONNECT', connection_id, host, stage), None)
+
+    return handle_connection
+
+
+async def flush_relay_every(interval):
+    """Send what the relay buffered each tick; handlers only queue while a tick is set"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            signaling.flush_relay()
+        except Exception:
+            logger.exception("Relay flush failed")
+
+
+async def flush_departures_every(interval):
+    """Flush rooms whose leave window has passed; disconnects only queue their leaves while this runs"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            signaling.flush_departures()
+        except Exception:
+            logger.exception("Departure flush failed")
+
+
+async def reap_every(interval):
+    """Run the connection reaper now and then every `interval` seconds"""
+    while True:
+        try:
+            signaling.reap_expired_connections()
+        except Exception:
+            logger.exception("Connection reaper failed")
+        await asyncio.sleep(interval)
+
+
+async def serve(host, port, stage, backend, sqlite_path, relay_tick_ms, reap_seconds, leave_window_ms):
+    api = LocalSocketApi(asyncio.get_running_loop())
+    install_local_backend(api, backend, sqlite_path)
+    signaling.RELAY_TICK_MS = relay_tick_ms
+    signaling.LEAVE_WINDOW_MS = leave_window_ms
+    signaling.DEPARTURES_TICKED = True
+    # Sends run on the event loop here, which must never sleep waiting for a token; nothing throttles locally
+    signaling.send_scheduler.bucket.rate = 0
+    flusher = asyncio.create_task(flush_relay_every(relay_tick_ms / 1000)) if relay_tick_ms > 0 else None
+    reaper = asyncio.create_task(reap_every(reap_seconds)) if reap_seconds > 0 else None
+    departures = (asyncio.create_task(flush_departures_every(leave_window_ms / 2000))
+                  if leave_window_ms > 0 else None)
+    # No per-message deflate: at tens of thousands of sockets its per-connection buffers dominate memory
+    async with websockets.serve(make_connection_handler(api, host, stage), host, port,
+                                compression=None, max_size=256 * 1024):
+        logger.warning(f"Signaling server listening on ws://{host}:{port}/")
+        try:
+            await asyncio.Future()
+        finally:
+            for task in (flusher, reaper, departures):
+                if task:
+                    task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--stage', default='local')
+    parser.add_argument('--store', choices=['memory', 'sqlite'], default='memory')
+    parser.add_argument('--sqlite-path', default='signaling.db')
+    parser.add_argument('--relay-tick-ms', type=float, default=50.0,
+                        help='batch relayed game data per recipient over this interval (0 = no batching)')
+    parser.add_argument('--reap-every', type=float, default=60.0,
+                        help='seconds between sweeps for connections that stopped sending heartbeats (0 = never)')
+    parser.add_argument('--leave-window-ms', type=float, default=500.0,
+                        help='coalesce leaves from disconnects per room over this interval (0 = one at a time)')
+    parser.add_argument('--capture', help='append anonymized events to this file for replay_events.py')
+    parser.add_argument('--log-level', default='WARNING', help='handler log level (DEBUG is slow under load)')
+    args = parser.parse_args()
+    if args.capture:
+        signaling.event_recorder = EventRecorder(args.capture, secret=os.environ.get('CAPTURE_SECRET'))
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s %(message)s')
+    logging.getLogger().setLevel(args.log_level.upper())
+
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+
+    try:
+        asyncio.run(serve(args.host, args.port, args.stage, args.store, args.sqlite_path, args.relay_tick_ms,
+                          args.reap_every, args.leave_window_ms))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import math
+
+# Peer overlay planning for webrtc_signaling_lambda.py.
+#
+# Instead of every player connecting to every other player in the room, each player
+# is linked to at most `degree` peers, nearest first by last reported position. The
+# plan is a pure function of (roster, positions, degree), so any invocation can work
+# out what the overlay was before a join or leave and what it is after, and only tell
+# the players whose peer set actually changed.
+
+
+def distance(positions, a, b):
+    """Distance between two players; players who haven't reported a position are far from everyone"""
+    pa, pb = positions.get(a), positions.get(b)
+    if pa is None or pb is None:
+        return math.inf
+    return math.hypot(float(pa[0]) - float(pb[0]), float(pa[1]) - float(pb[1]))
+
+
+def nearest_candidates(players, positions, count):
+    """{player_id: up to `count` nearest other players}
+
+    Placed players are bucketed on a grid sized for about `count` players per cell and
+    search outwards ring by ring, so a big room costs O(n * count) rather than O(n^2).
+    Players without a position get the next players in ID order instead.
+    """
+    placed = [pid for pid in players if pid in positions]
+    unplaced = [pid for pid in players if pid not in positions]
+    candidates = {}
+
+    if placed:
+        xs = [float(positions[pid][0]) for pid in placed]
+        ys = [float(positions[pid][1]) for pid in placed]
+        area = max(max(xs) - min(xs), 1.0) * max(max(ys) - min(ys), 1.0)
+        cell = math.sqrt(area * count / len(placed)) or 1.0
+        grid = {}
+        for pid, x, y in zip(placed, xs, ys):
+            grid.setdefault((int(x // cell), int(y // cell)), []).append((pid, x, y))
+        span = max(max(xs) - min(xs), max(ys) - min(ys)) / cell + 1
+
+        for pid, x, y in zip(placed, xs, ys):
+            cx, cy = int(x // cell), int(y // cell)
+            found = []
+            ring = 0
+            while ring <= span + 1:
+                for gx in range(cx - ring, cx + ring + 1):
+                    for gy in range(cy - ring, cy + ring + 1):
+                        if max(abs(gx - cx), abs(gy - cy)) != ring:
+                            continue
+                        for other, ox, oy in grid.get((gx, gy), ()):
+                            if other != pid:
+                                found.append((math.hypot(x - ox, y - oy), other))
+                # Anything in a further ring is at least `ring` cells away
+                if len(found) >= count and sorted(found)[count - 1][0] <= ring * cell:
+                    break
+                ring += 1
+            candidates[pid] = [other for _, other in sorted(found)[:count]]
+            # Too few placed players nearby: the unplaced ones come after them, as if far away
+            if len(candidates[pid]) < count:
+                candidates[pid] += sorted(unplaced)[:count - len(candidates[pid])]
+
+    # Unplaced players are only ever linked to each other or to whoever still has a free slot
+    pool = sorted(unplaced) + sorted(placed)
+    for i, pid in enumerate(sorted(unplaced)):
+        candidates[pid] = [pool[(i + j) % len(pool)] for j in range(1, min(count, len(pool) - 1) + 1)]
+    return candidates
+
+
+def plan_mesh(players, positions, degree):
+    """Return {player_id: sorted peer list} with at most `degree` peers each, preferring near ones
+
+    Small rooms (degree + 1 players or fewer) are a full mesh. Otherwise each player's
+    nearest few players are candidate links, taken shortest first (player IDs break ties,
+    so the plan is deterministic) while both ends have a free slot. A player left with no
+    peers at all takes a slot from its nearest candidate that can give one: a free slot, or
+    its longest link to a player who keeps another, so nobody is left without peers in turn.
+    If no candidate can (degree 1, where the links are pairs), the nearest goes over degree.
+    """
+    players = sorted(players)
+    if len(players) <= degree + 1:
+        return {pid: [peer for peer in players if peer != pid] for pid in players}
+
+    candidates = nearest_candidates(players, positions, 2 * degree)
+    pairs = {(min(a, b), max(a, b)) for a, near in candidates.items() for b in near}
+    links = {pid: set() for pid in players}
+    for _, a, b in sorted((distance(positions, a, b), a, b) for a, b in pairs):
+        if len(links[a]) < degree and len(links[b]) < degree:
+            links[a].add(b)
+            links[b].add(a)
+
+    for pid in players:
+        if links[pid]:
+            continue
+        peer = candidates[pid][0]
+        for near in candidates[pid]:
+            if len(links[near]) < degree:
+                peer = near
+                break
+            droppable = [p for p in links[near] if len(links[p]) > 1]
+            if droppable:
+                farthest = max(droppable, key=lambda p: (distance(positions, near, p), p))
+                links[near].discard(farthest)
+                links[farthest].discard(near)
+                peer = near
+                break
+        links[peer].add(pid)
+        links[pid].add(peer)
+
+    return {pid: sorted(peers) for pid, peers in links.items()}
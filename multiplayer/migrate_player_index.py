@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Create and backfill the player index table used by webrtc_signaling_lambda.py.
+
+Rollout for an existing deployment:
+  1. python migrate_player_index.py --create   (creates the table, then backfills)
+  2. deploy the Lambda with PLAYERS_TABLE set
+  3. python migrate_player_index.py            (backfill again to catch players who
+                                                joined on the old code during the deploy)
+
+The backfill is idempotent: it never overwrites an entry the new Lambda has written.
+"""
+import argparse
+import os
+import boto3
+from botocore.exceptions import ClientError
+
+CONNECTIONS_TABLE = os.environ.get('CONNECTIONS_TABLE', 'tank-simulator-signaling-connections-prod')
+PLAYERS_TABLE = os.environ.get('PLAYERS_TABLE', 'tank-simulator-signaling-players-prod')
+
+
+def create_players_table(client, table_name):
+    """Create the player index table (on-demand billing) if it doesn't already exist"""
+    try:
+        client.create_table(
+            TableName=table_name,
+            AttributeDefinitions=[{'AttributeName': 'player_id', 'AttributeType': 'S'}],
+            KeySchema=[{'AttributeName': 'player_id', 'KeyType': 'HASH'}],
+            BillingMode='PAY_PER_REQUEST'
+        )
+        print(f"Creating table {table_name}...")
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceInUseException':
+            raise
+        print(f"Table {table_name} already exists")
+    client.get_waiter('table_exists').wait(TableName=table_name)
+
+
+def backfill(connections_table, players_table):
+    """Copy player_id -> connection_id from every joined connection into the index"""
+    scanned = copied = skipped = 0
+    scan_kwargs = {
+        'FilterExpression': 'attribute_exists(player_id) AND player_id <> :null',
+        'ExpressionAttributeValues': {':null': None},
+    }
+    while True:
+        response = connections_table.scan(**scan_kwargs)
+        for item in response.get('Items', []):
+            scanned += 1
+            entry = {'player_id': item['player_id'], 'connection_id': item['connection_id']}
+            if item.get('room'):
+                entry['room'] = item['room']
+            try:
+                players_table.put_item(Item=entry, ConditionExpression='attribute_not_exists(player_id)')
+                copied += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                skipped += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    print(f"Backfill complete: {scanned} joined connections, {copied} indexed, {skipped} already present")
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--create', action='store_true', help='create the players table before backfilling')
+    parser.add_argument('--connections-table', default=CONNECTIONS_TABLE)
+    parser.add_argument('--players-table', default=PLAYERS_TABLE)
+    args = parser.parse_args()
+
+    if args.create:
+        create_players_table(boto3.client('dynamodb'), args.players_table)
+
+    dynamodb = boto3.resource('dynamodb')
+    backfill(dynamodb.Table(args.connections_table), dynamodb.Table(args.players_table))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,21 @@ class MultiplayerManager {
         this.maxPlayers = 5;
         this.pendingIceCandidates = {};
         this.connectionAttempts = 0;
+        this.roomPlayers = new Set(); // Everyone in the room, whether or not we're connected to them
+        this.meshPlanned = false; // Server picks our peers (room_info carries a peers list)
+        this.positionTimer = null;
+        this.heartbeatTimer = null;
+        this.lastSeen = undefined; // When the server last recorded our heartbeat (from its last pong)
+        this.relayedPeers = new Set(); // Peers we have no DataChannel to; game data goes via the server
+        this.relayFallbackMs = 10000; // How long a peer connection gets to open before we relay instead
+        this.signalQueue = []; // Offers, answers and ICE candidates waiting to go out as one batch
+        this.signalTimer = null;
+        this.signalBatchMs = 30;
+        this.routeTokens = {}; // Server-signed route per player, sent back with signaling messages to them
+        this.rosterVersion = 0; // Room version our roomPlayers reflects; roster events carry the version they produce
+        this.rosterPending = []; // Roster events that arrived ahead of one we haven't seen yet
+        this.rosterSyncTimer = null;
+        this.rosterSyncMs = 250; // How long a gap may stay open (events can arrive out of order) before we ask
         
         this.setupConnection();
     }
@@ -37,15 +52,29 @@ class MultiplayerManager {
 					if (message.type === "room_info") {
 						console.log(`🏠 Room info received: ${message.players.length} players already in room`, message.players);
 						if (typeof updateConnectionStatus === 'function') {
-							updateConnectionStatus("Connected to main room", "#4CAF50");
+							updateConnectionStatus(message.room ? `Connected to room ${message.room}` : "Connected to main room", "#4CAF50");
 						}
 						this.handleRoomInfo(message);
 					} else if (message.type === "new_player") {
 						console.log(`👋 New player notification: ${message.playerId}`);
-						this.handleNewPlayer(message);
+						this.handleRosterEvent(message);
 					} else if (message.type === "player_left") {
 						console.log("👋 Player left notification");
-						this.handlePlayerLeft(message);
+						this.handleRosterEvent(message);
+					} else if (message.type === "players_left") {
+						console.log(`👋 ${message.playerIds.length} players left`);
+						this.handleRosterEvent(message);
+					} else if (message.type === "roster") {
+						console.log(`👥 Roster ${message.players ? "snapshot" : "changes"} at version ${message.version}`);
+						this.handleRosterEvent(message);
+					} else if (message.type === "batch") {
+						console.log(`📦 Handling batch of ${message.messages.length} signaling messages`);
+						message.messages.forEach(entry => this.handleSignal(entry));
+					} else if (message.type === "relay_batch") {
+						this.handleRelayBatch(message);
+					} else if (message.type === "mesh") {
+						console.log("🕸️ Mesh update: peers", message.peers);
+						this.handleMeshUpdate(message);
 					} else if (message.type === "offer") {
 						console.log("📞 Handling offer");
 						this.handleOffer(message);
@@ -57,6 +86,11 @@ class MultiplayerManager {
 						this.handleIceCandidate(message);
 					} else if (message.type === "pong") {
 						console.log("🏓 Received pong response");
+						this.lastSeen = message.lastSeen; // echoed back so the server can skip redundant writes
+						// The server expires connections that stop pinging; keep ours alive
+						if (message.heartbeatInterval > 0 && !this.heartbeatTimer) {
+							this.startHeartbeat(message.heartbeatInterval);
+						}
 					} else {
 						console.warn("⚠️ Unknown message type:", message.type);
 					}
@@ -77,7 +111,8 @@ class MultiplayerManager {
 				// Send a simple join message - the server will handle room assignment
 				this.socket.send(JSON.stringify({
 					type: "join",
-					playerId: this.localPlayerId
+					playerId: this.localPlayerId,
+					position: this.currentPosition()
 				}));
 				console.log("📤 JOIN MESSAGE SENT");
 				
@@ -102,6 +137,12 @@ class MultiplayerManager {
 			};
 			
 			this.socket.onclose = (event) => {
+				this.stopPositionReports();
+				this.stopHeartbeat();
+				this.lastSeen = undefined;
+				this.room = undefined; // until the next room_info
+				this.rosterPending = [];
+				this.resetRosterVersion(0);
 				console.log("Disconnected from signaling server", 
 							"Code:", event.code, 
 							"Reason:", event.reason || "No reason provided", 
@@ -159,6 +200,11 @@ class MultiplayerManager {
                Math.random().toString(36).substring(2, 15);
     }
 
+    currentPosition() {
+        const player = this.game.player;
+        return player ? { x: player.x, y: player.y } : undefined;
+    }
+
 handleRoomInfo(message) {
         const existingPlayers = message.players;
         const playerIndex = existingPlayers.length;
@@ -167,13 +213,28 @@ handleRoomInfo(message) {
         this.game.player.playerIndex = playerIndex;
         this.game.player.color = this.playerColors[playerIndex];
         
-        // Create peer connections for each existing player
-        existingPlayers.forEach(playerId => {
+        this.room = message.room;
+        this.roomPlayers = new Set(existingPlayers);
+        this.routeTokens = Object.assign({}, message.tokens);
+        this.resetRosterVersion(message.version || 0);
+        
+        // Connect to the peers the server planned for us (everyone, from servers that don't plan a mesh)
+        this.meshPlanned = Array.isArray(message.peers);
+        const peers = this.meshPlanned ? message.peers : existingPlayers;
+        peers.forEach(playerId => {
             this.createPeerConnection(playerId, true);
         });
         
+        // In rooms too big for everyone to connect to everyone, peers are picked by distance
+        if (message.positionInterval > 0) {
+            this.startPositionReports(message.positionInterval);
+        }
+        
         // Update the number of AI enemies (remove one for each human player)
-        this.updateAIEnemies(existingPlayers.length + 1);
+        this.updateAIEnemies(this.roomPlayers.size + 1);
+        
+        // Changes to the room that overtook room_info
+        this.applyPendingRoster();
         
         // Show notification for current player if function exists
         if (typeof showPlayerJoinNotification === 'function') {
@@ -200,12 +261,19 @@ handleRoomInfo(message) {
 
     handleNewPlayer(message) {
         const newPlayerId = message.playerId;
+        this.roomPlayers.add(newPlayerId);
+        if (message.token) {
+            this.routeTokens[newPlayerId] = message.token;
+        }
         
-        // Create a new peer connection for the new player
-        this.createPeerConnection(newPlayerId, false);
+        // Create a new peer connection for the new player; with a planned mesh we only
+        // connect if they pick us, and handleOffer creates the connection then
+        if (!this.meshPlanned) {
+            this.createPeerConnection(newPlayerId, false);
+        }
         
         // Update the number of AI enemies
-        const humanPlayers = Object.keys(this.peers).length + 1;
+        const humanPlayers = this.roomPlayers.size + 1;
         this.updateAIEnemies(humanPlayers);
         
         // Show notification for new player if function exists
@@ -237,12 +305,195 @@ handleRoomInfo(message) {
         if (this.players[playerId]) {
             delete this.players[playerId];
         }
+        this.roomPlayers.delete(playerId);
+        this.relayedPeers.delete(playerId);
+        delete this.routeTokens[playerId];
         
         // Update the number of AI enemies
-        const humanPlayers = Object.keys(this.peers).length + 1;
+        const humanPlayers = this.roomPlayers.size + 1;
         this.updateAIEnemies(humanPlayers);
     }
 
+    // new_player, player_left, players_left and roster each carry the room version they bring us
+    // to; apply each change once, in order, and ask the server to fill any gap
+    handleRosterEvent(message) {
+        if (typeof message.version !== "number") {
+            this.applyRosterEvent(message); // server without roster versions
+            return;
+        }
+        if (message.version <= this.rosterVersion) {
+            console.log(`Ignoring ${message.type} for version ${message.version}, already at ${this.rosterVersion}`);
+            return;
+        }
+        if (!this.room || this.rosterGap(message)) {
+            this.rosterPending.push(message);
+            this.scheduleRosterSync();
+            return;
+        }
+        this.applyRosterEvent(message);
+        this.rosterVersion = message.version;
+        this.applyPendingRoster();
+    }
+
+    rosterGap(message) {
+        // A snapshot replaces everything; a change applies on top of the version before it
+        if (message.players) {
+            return false;
+        }
+        const since = typeof message.since === "number" ? message.since : message.version - 1;
+        return since > this.rosterVersion;
+    }
+
+    applyRosterEvent(message) {
+        if (message.type === "new_player") {
+            this.handleNewPlayer(message);
+        } else if (message.type === "player_left") {
+            this.handlePlayerLeft(message);
+        } else if (message.type === "players_left") {
+            message.playerIds.forEach(playerId => this.handlePlayerLeft({ playerId: playerId }));
+        } else {
+            this.handleRosterUpdate(message);
+        }
+    }
+
+    applyPendingRoster() {
+        if (!this.room) {
+            return;
+        }
+        this.rosterPending.sort((a, b) => a.version - b.version);
+        while (this.rosterPending.length > 0) {
+            const next = this.rosterPending[0];
+            if (next.version > this.rosterVersion && this.rosterGap(next)) {
+                this.scheduleRosterSync();
+                return;
+            }
+            this.rosterPending.shift();
+            if (next.version > this.rosterVersion) {
+                this.applyRosterEvent(next);
+                this.rosterVersion = next.version;
+            }
+        }
+        if (this.rosterSyncTimer) {
+            clearTimeout(this.rosterSyncTimer);
+            this.rosterSyncTimer = null;
+        }
+    }
+
+    scheduleRosterSync() {
+        if (this.rosterSyncTimer || !this.room) {
+            return;
+        }
+        this.rosterSyncTimer = setTimeout(() => {
+            this.rosterSyncTimer = null;
+            if (this.rosterPending.length > 0 && this.socket && this.socket.readyState === WebSocket.OPEN) {
+                console.log(`👥 Missing roster changes after version ${this.rosterVersion}, asking for them`);
+                this.socket.send(JSON.stringify({
+                    type: "roster_sync",
+                    playerId: this.localPlayerId,
+                    room: this.room,
+                    version: this.rosterVersion
+                }));
+            }
+        }, this.rosterSyncMs);
+    }
+
+    resetRosterVersion(version) {
+        this.rosterVersion = version;
+        this.rosterPending = this.rosterPending.filter(message => message.version > version);
+        if (this.rosterSyncTimer) {
+            clearTimeout(this.rosterSyncTimer);
+            this.rosterSyncTimer = null;
+        }
+    }
+
+    handleRosterUpdate(message) {
+        const tokens = message.tokens || {};
+        let joined = message.joined || [];
+        if (message.players) {
+            // Snapshot: whoever isn't in it has left
+            const current = new Set(message.players);
+            [...this.roomPlayers].filter(playerId => !current.has(playerId))
+                .forEach(playerId => this.handlePlayerLeft({ playerId: playerId }));
+            joined = message.players;
+        } else {
+            (message.left || []).filter(playerId => this.roomPlayers.has(playerId))
+                .forEach(playerId => this.handlePlayerLeft({ playerId: playerId }));
+        }
+        joined.filter(playerId => playerId !== this.localPlayerId).forEach(playerId => {
+            if (this.roomPlayers.has(playerId)) {
+                // Still here, but maybe on a new connection
+                if (tokens[playerId]) {
+                    this.routeTokens[playerId] = tokens[playerId];
+                }
+            } else {
+                this.handleNewPlayer({ playerId: playerId, token: tokens[playerId] });
+            }
+        });
+    }
+
+    handleMeshUpdate(message) {
+        const wanted = new Set(message.peers);
+        
+        // Drop connections the new plan doesn't include (the player stays in the room)
+        for (const playerId in this.peers) {
+            if (!wanted.has(playerId)) {
+                this.peers[playerId].close();
+                delete this.peers[playerId];
+                delete this.players[playerId];
+                this.relayedPeers.delete(playerId);
+            }
+        }
+        
+        // Open the new links assigned to us; the other side of every other new link calls us
+        (message.connect || []).forEach(playerId => {
+            if (!this.peers[playerId]) {
+                this.createPeerConnection(playerId, true);
+            }
+        });
+    }
+
+    startPositionReports(intervalSeconds) {
+        this.stopPositionReports();
+        this.positionTimer = setInterval(() => {
+            const position = this.currentPosition();
+            if (position && this.socket && this.socket.readyState === WebSocket.OPEN) {
+                this.socket.send(JSON.stringify({
+                    type: "position",
+                    playerId: this.localPlayerId,
+                    room: this.room,
+                    position: position
+                }));
+            }
+        }, intervalSeconds * 1000);
+    }
+
+    stopPositionReports() {
+        if (this.positionTimer) {
+            clearInterval(this.positionTimer);
+            this.positionTimer = null;
+        }
+    }
+
+    startHeartbeat(intervalSeconds) {
+        this.stopHeartbeat();
+        this.heartbeatTimer = setInterval(() => {
+            if (this.socket && this.socket.readyState === WebSocket.OPEN) {
+                this.socket.send(JSON.stringify({
+                    type: "ping",
+                    timestamp: Date.now(),
+                    lastSeen: this.lastSeen
+                }));
+            }
+        }, intervalSeconds * 1000);
+    }
+
+    stopHeartbeat() {
+        if (this.heartbeatTimer) {
+            clearInterval(this.heartbeatTimer);
+            this.heartbeatTimer = null;
+        }
+    }
+
     updateAIEnemies(humanPlayerCount) {
         // Calculate how many AI enemies should be active
         const aiEnemiesNeeded = Math.max(0, 5 - humanPlayerCount);
@@ -296,12 +547,12 @@ createPeerConnection(remotePlayerId, isInitiator) {
             peerConnection.createOffer()
                 .then(offer => peerConnection.setLocalDescription(offer))
                 .then(() => {
-                    this.socket.send(JSON.stringify({
+                    this.queueSignal({
                         type: "offer",
                         offer: peerConnection.localDescription,
                         to: remotePlayerId,
                         from: this.localPlayerId
-                    }));
+                    });
                 })
                 .catch(error => console.error("Error creating offer:", error));
         } else {
@@ -318,12 +569,12 @@ createPeerConnection(remotePlayerId, isInitiator) {
         // ICE candidate handling
         peerConnection.onicecandidate = (event) => {
             if (event.candidate) {
-                this.socket.send(JSON.stringify({
+                this.queueSignal({
                     type: "ice_candidate",
                     candidate: event.candidate,
                     to: remotePlayerId,
                     from: this.localPlayerId
-                }));
+                });
             }
         };
         
@@ -333,6 +584,7 @@ createPeerConnection(remotePlayerId, isInitiator) {
             
             if (peerConnection.connectionState === 'connected') {
                 console.log(`Connected to player ${remotePlayerId}`);
+                this.relayedPeers.delete(remotePlayerId);
                 if (typeof updateConnectionStatus === 'function') {
                     updateConnectionStatus("Connected to all players", "#4CAF50");
                 }
@@ -341,9 +593,17 @@ createPeerConnection(remotePlayerId, isInitiator) {
                 if (typeof updateConnectionStatus === 'function') {
                     updateConnectionStatus("Some player connections failed", "#FF9800");
                 }
+                this.startRelay(remotePlayerId);
             }
         };
         
+        // Symmetric NATs without a TURN server never connect, often without ever reporting 'failed'
+        setTimeout(() => {
+            if (this.peers[remotePlayerId] === peerConnection && peerConnection.connectionState !== 'connected') {
+                this.startRelay(remotePlayerId);
+            }
+        }, this.relayFallbackMs);
+        
         // ICE connection state monitoring
         peerConnection.oniceconnectionstatechange = () => {
             console.log(`ICE connection state with ${remotePlayerId}: ${peerConnection.iceConnectionState}`);
@@ -364,20 +624,7 @@ createPeerConnection(remotePlayerId, isInitiator) {
         
         dataChannel.onmessage = (event) => {
             try {
-                const data = JSON.parse(event.data);
-                
-                // Handle different message types
-                switch (data.type) {
-                    case "player_update":
-                        this.updateRemotePlayer(remotePlayerId, data.playerData);
-                        break;
-                    case "projectile_fired":
-                        this.handleRemoteProjectile(data.projectile);
-                        break;
-                    case "player_hit":
-                        this.handleRemoteHit(data.hitData);
-                        break;
-                }
+                this.handleGameMessage(remotePlayerId, JSON.parse(event.data));
             } catch (e) {
                 console.error("Error processing message:", e);
             }
@@ -392,6 +639,10 @@ createPeerConnection(remotePlayerId, isInitiator) {
         };
         
         // Store the data channel
+        this.addRemotePlayer(remotePlayerId).dataChannel = dataChannel;
+    }
+
+    addRemotePlayer(remotePlayerId) {
         if (!this.players[remotePlayerId]) {
             // Get next available index
             const playerIndices = Object.values(this.players)
@@ -404,7 +655,7 @@ createPeerConnection(remotePlayerId, isInitiator) {
             
             this.players[remotePlayerId] = {
                 playerId: remotePlayerId,
-                dataChannel: dataChannel,
+                dataChannel: null,
                 playerIndex: nextIndex,
                 color: this.playerColors[nextIndex],
                 x: 0,
@@ -413,10 +664,94 @@ createPeerConnection(remotePlayerId, isInitiator) {
                 health: 1000,
                 currentWeapon: "Cannon"
             };
-        } else {
-            this.players[remotePlayerId].dataChannel = dataChannel;
+        }
+        return this.players[remotePlayerId];
+    }
+
+    handleGameMessage(remotePlayerId, data) {
+        // Handle different message types
+        switch (data.type) {
+            case "player_update":
+                this.updateRemotePlayer(remotePlayerId, data.playerData);
+                break;
+            case "projectile_fired":
+                this.handleRemoteProjectile(data.projectile);
+                break;
+            case "player_hit":
+                this.handleRemoteHit(data.hitData);
+                break;
         }
     }
+
+    startRelay(remotePlayerId) {
+        if (this.relayedPeers.has(remotePlayerId) || !this.peers[remotePlayerId]) return;
+        console.warn(`No direct connection to ${remotePlayerId}, relaying game data through the server`);
+        this.relayedPeers.add(remotePlayerId);
+        this.addRemotePlayer(remotePlayerId);
+        this.connectionEstablished = true;
+    }
+
+    handleRelayBatch(message) {
+        // One frame per server tick: the latest update from each player plus any shots and hits
+        message.messages.forEach(data => {
+            try {
+                this.handleGameMessage(data.from, data);
+            } catch (e) {
+                console.error("Error processing relayed message:", e);
+            }
+        });
+    }
+    // Offers, answers and ICE candidates come in bursts (to every peer on join, several candidates
+    // per peer); collect each burst for a few ms and send it as one 'batch' frame
+    queueSignal(message) {
+        // The recipient's routing token lets the server skip looking up their connection
+        if (this.routeTokens[message.to]) {
+            message.token = this.routeTokens[message.to];
+        }
+        this.signalQueue.push(message);
+        if (!this.signalTimer) {
+            this.signalTimer = setTimeout(() => this.flushSignals(), this.signalBatchMs);
+        }
+    }
+
+    flushSignals() {
+        this.signalTimer = null;
+        const messages = this.signalQueue;
+        this.signalQueue = [];
+        if (!messages.length || !this.socket || this.socket.readyState !== WebSocket.OPEN) return;
+        
+        // Stay well inside API Gateway's 128 KB frame limit (offers carry a full SDP each)
+        // and the server's cap of 256 entries per batch
+        const send = (chunk) => this.socket.send(JSON.stringify(chunk.length === 1 ? chunk[0] : {
+            type: "batch",
+            from: this.localPlayerId,
+            messages: chunk
+        }));
+        let chunk = [];
+        let size = 0;
+        messages.forEach(message => {
+            const length = JSON.stringify(message).length;
+            if (chunk.length && (size + length > 96 * 1024 || chunk.length === 256)) {
+                send(chunk);
+                chunk = [];
+                size = 0;
+            }
+            chunk.push(message);
+            size += length;
+        });
+        send(chunk);
+    }
+
+    handleSignal(message) {
+        if (message.type === "offer") {
+            this.handleOffer(message);
+        } else if (message.type === "answer") {
+            this.handleAnswer(message);
+        } else if (message.type === "ice_candidate") {
+            this.handleIceCandidate(message);
+        }
+    }
+
 handleOffer(message) {
         const remotePlayerId = message.from;
         const peerConnection = this.peers[remotePlayerId] || 
@@ -428,12 +763,12 @@ handleOffer(message) {
             .then(() => peerConnection.createAnswer())
             .then(answer => peerConnection.setLocalDescription(answer))
             .then(() => {
-                this.socket.send(JSON.stringify({
+                this.queueSignal({
                     type: "answer",
                     answer: peerConnection.localDescription,
                     to: remotePlayerId,
                     from: this.localPlayerId
-                }));
+                });
                 
                 // Process any pending ICE candidates
                 this.pendingIceCandidates[remotePlayerId].forEach(candidate => {
@@ -550,6 +885,7 @@ broadcastPlayerUpdate() {
 
     broadcast(data) {
         // Send data to all connected peers
+        const relayTo = [];
         for (const playerId in this.players) {
             const player = this.players[playerId];
             if (player.dataChannel && player.dataChannel.readyState === "open") {
@@ -558,12 +894,28 @@ broadcastPlayerUpdate() {
                 } catch (e) {
                     console.error("Error sending data:", e);
                 }
+            } else if (this.relayedPeers.has(playerId)) {
+                relayTo.push(playerId);
             }
         }
+        
+        // Peers we can't reach directly get it through the signaling server, in one message for all of them
+        if (relayTo.length && this.socket && this.socket.readyState === WebSocket.OPEN) {
+            this.socket.send(JSON.stringify({
+                type: "relay",
+                from: this.localPlayerId,
+                to: relayTo,
+                data: data
+            }));
+        }
     }
 
     // Called on game shutdown or when player leaves
     disconnect() {
+        this.stopPositionReports();
+        this.stopHeartbeat();
+        this.relayedPeers.clear();
+        
         // Close all peer connections
         for (const playerId in this.peers) {
             this.peers[playerId].close();
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Replay captured signaling traffic against a storage backend and a fake API Gateway client.
+
+    python replay_events.py events.jsonl [more.jsonl ...] [--store dynamodb|memory|sqlite]
+        [--speed 1] [--concurrency 8] [--overlap-ms 0] [--db-latency-ms 0] [--api-latency-ms 0]
+        [--leave-window-ms 500]
+
+Captures come from CAPTURE_PATH on the Lambda (or a CloudWatch Logs export of it; other lines
+are skipped) or from local_signaling_server.py --capture. Events are replayed in recorded order
+at --speed times the recorded pace. Each connection's events run in order on one of
+--concurrency workers, the way API Gateway runs one connection's messages in turn while other
+connections' run alongside. At --speed 0 there is no pace to keep the order between connections
+(an ICE candidate must not overtake the join it follows), so by default each event starts once
+the one before has finished. Timestamps are taken when the handler starts, so an event recorded
+a few ms after the one it depends on may have been sent before that one finished; --overlap-ms
+lets events recorded within that many ms of each other run together, each group once the one
+before has finished, at the risk of such reorderings. Reports throughput, latency percentiles per
+message type, how far the replay fell behind the recorded pace, and DynamoDB calls and
+capacity per event (dynamodb store only, through the in-memory stand-in).
+
+Routing tokens are not in captures, so replayed signaling messages route by the player index.
+Connections already open when the capture started get a CONNECT of their own first.
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+import zlib
+
+import signaling_bench
+import webrtc_signaling_lambda as signaling
+from event_capture import EVENT_TYPES, expand, read_capture
+
+
+def make_event(entry):
+    event = {
+        'requestContext': {
+            'eventType': EVENT_TYPES[entry['e']],
+            'connectionId': entry['c'],
+            'domainName': 'localhost',
+            'stage': 'replay'
+        }
+    }
+    if entry['e'] == 'M':
+        body = expand(entry.get('b', ''))
+        event['body'] = body if isinstance(body, str) else json.dumps(body)
+    return event
+
+
+def label(entry):
+    if entry['e'] != 'M':
+        return f"${EVENT_TYPES[entry['e']].lower()}"
+    body = expand(entry.get('b'))
+    return str(body.get('type')) if isinstance(body, dict) else 'unparseable'
+
+
+def with_connects(events):
+    """Prefix a CONNECT for every connection whose first captured event isn't one"""
+    seen = set()
+    missing = []
+    for entry in events:
+        if entry['c'] not in seen:
+            seen.add(entry['c'])
+            if entry['e'] != 'C':
+                missing.append({'t': events[0]['t'], 'e': 'C', 'c': entry['c']})
+    return missing + events, len(missing)
+
+
+class Replayer:
+    """Runs captured events through lambda_handler on per-connection workers and keeps the timings"""
+
+    def __init__(self, api, concurrency):
+        self.api = api
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.lag = []
+        self.idle = threading.Condition(self.lock)
+        self.pending = 0
+        self.queues = [queue.Queue() for _ in range(concurrency)]
+        self.workers = [threading.Thread(target=self.work, args=(q,), daemon=True) for q in self.queues]
+        for worker in self.workers:
+            worker.start()
+
+    def submit(self, entry, scheduled):
+        with self.lock:
+            self.pending += 1
+        # Same connection, same worker: its events keep their order
+        self.queues[zlib.crc32(entry['c'].encode('utf-8')) % len(self.queues)].put((entry, scheduled))
+
+    def work(self, jobs):
+        while True:
+            job = jobs.get()
+            if job is None:
+                return
+            entry, scheduled = job
+            started = time.perf_counter()
+            if entry['e'] == 'C':
+                self.api.connect(entry['c'])
+            elif entry['e'] == 'D':
+                # API Gateway reports the socket closed before $disconnect runs
+                self.api.disconnect(entry['c'])
+            response = signaling.lambda_handler(make_event(entry), None)
+            elapsed = time.perf_counter() - started
+            name = label(entry)
+            with self.lock:
+                self.latencies.setdefault(name, []).append(elapsed)
+                if scheduled is not None:
+                    self.lag.append(max(0.0, started - scheduled))
+                if (response or {}).get('statusCode', 200) >= 400:
+                    self.errors[name] = self.errors.get(name, 0) + 1
+                self.pending -= 1
+                if not self.pending:
+                    self.idle.notify_all()
+
+    def wait_idle(self):
+        with self.lock:
+            while self.pending:
+                self.idle.wait()
+
+    def finish(self):
+        for jobs in self.queues:
+            jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
+def replay(paths, store, speed, concurrency, overlap_ms, db_latency_ms, api_latency_ms, leave_window_ms):
+    events, synthetic = with_connects(read_capture(paths))
+    if not events:
+        raise SystemExit("No captured events found")
+    db, api = signaling_bench.build_environment(api_latency_ms / 1000, db_latency_ms / 1000, store)
+    if leave_window_ms is not None:
+        signaling.LEAVE_WINDOW_MS = leave_window_ms
+    connections = len({entry['c'] for entry in events})
+    span = (events[-1]['t'] - events[0]['t']) / 1000
+    print(f"Replaying {len(events)} events from {connections} connections ({synthetic} opened before the capture), "
+          f"{span:.1f} s recorded, at {'full speed' if speed <= 0 else f'{speed:g}x'} on {concurrency} workers "
+          f"against {store}")
+
+    replayer = Replayer(api, concurrency)
+    db.reset_counters()
+    first = group_start = events[0]['t']
+    started = time.perf_counter()
+    for entry in events:
+        scheduled = None
+        if speed > 0:
+            scheduled = started + (entry['t'] - first) / 1000 / speed
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        elif overlap_ms <= 0 or entry['t'] > group_start + overlap_ms:
+            replayer.wait_idle()
+            group_start = entry['t']
+        replayer.submit(entry, scheduled)
+    replayer.finish()
+    elapsed = time.perf_counter() - started
+
+    print(f"  {len(events)} events in {elapsed:.2f} s: {len(events) / elapsed:.0f} events/s, "
+          f"{api.post_count} frames posted")
+    if replayer.lag:
+        print(f"  behind the recorded pace: p50 {signaling_bench.percentile(replayer.lag, 0.5) * 1000:.1f} ms, "
+              f"p99 {signaling_bench.percentile(replayer.lag, 0.99) * 1000:.1f} ms")
+    print(f"  {'event':<16}{'count':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}{'errors':>8}")
+    for name, latencies in sorted(replayer.latencies.items(), key=lambda item: -len(item[1])):
+        print(f"  {name:<16}{len(latencies):>8}"
+              f"{signaling_bench.percentile(latencies, 0.5) * 1000:>9.3f}"
+              f"{signaling_bench.percentile(latencies, 0.95) * 1000:>9.3f}"
+              f"{signaling_bench.percentile(latencies, 0.99) * 1000:>9.3f}"
+              f"{max(latencies) * 1000:>9.3f}{replayer.errors.get(name, 0):>8}")
+    if store == 'dynamodb':
+        usage = signaling_bench.usage_totals(db)
+        print(f"  DynamoDB per event: {usage['calls'] / len(events):.2f} calls, "
+              f"{usage['read_units'] / len(events):.2f} RCU, {usage['write_units'] / len(events):.2f} WCU, "
+              f"{usage['scans']} scans/queries")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('captures', nargs='+', help='capture files; several are merged by timestamp')
+    parser.add_argument('--store', choices=['dynamodb', 'memory', 'sqlite'], default='dynamodb')
+    parser.add_argument('--speed', type=float, default=1.0, help='multiple of the recorded pace (0 = full speed)')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--overlap-ms', type=float, default=0.0,
+                        help='at --speed 0, events recorded this close together run concurrently (0 = strict order)')
+    parser.add_argument('--db-latency-ms', type=float, default=0.0)
+    parser.add_argument('--api-latency-ms', type=float, default=0.0)
+    parser.add_argument('--leave-window-ms', type=float,
+                        help="override LEAVE_WINDOW_MS (disconnect leaders wait it out, as in Lambda)")
+    args = parser.parse_args()
+    replay(args.captures, args.store, args.speed, max(1, args.concurrency), args.overlap_ms, args.db_latency_ms,
+           args.api_latency_ms, args.leave_window_ms)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+# Routing tokens for webrtc_signaling_lambda.py.
+#
+# room_info and new_player give clients a token per player: that player's connection ID and
+# when it was issued, signed with a key only the Lambda holds. Clients send the recipient's
+# token back with offers, answers and ICE candidates, and the Lambda posts straight to the
+# connection in it without reading the player index. The signature covers the player ID, so a
+# token can't be edited or reused as a route to anyone else. A token whose connection has gone
+# (the player reconnected) just fails to send, and the caller falls back to the index lookup.
+
+
+def encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+class RoutingTokens:
+    """Issues and verifies signed player_id -> connection_id routes"""
+
+    def __init__(self, secret, ttl_seconds):
+        # Without a shared secret each container signs with its own random key: tokens still
+        # work within the container that issued them, and elsewhere fall back to the lookup
+        self.key = secret.encode('utf-8') if secret else os.urandom(32)
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.verified = 0
+        self.rejected = 0
+        self.expired = 0
+
+    def sign(self, player_id, body):
+        # Length-prefixed so no (player_id, body) pair can be re-split into another
+        signed = f'{len(player_id)}:{player_id}{body}'.encode('utf-8')
+        return encode(hmac.new(self.key, signed, hashlib.sha256).digest()[:16])
+
+    def issue(self, player_id, connection_id):
+        body = f'{int(time.time()):x}.{encode(connection_id.encode("utf-8"))}'
+        return f'{body}.{self.sign(player_id, body)}'
+
+    def issue_all(self, player_connections):
+        return {pid: self.issue(pid, conn_id) for pid, conn_id in player_connections.items()}
+
+    def verify(self, player_id, token):
+        """The connection ID `token` routes `player_id` to, or None if it is forged, malformed or expired"""
+        try:
+            issued, connection, signature = token.split('.')
+            body = f'{issued}.{connection}'
+            if not hmac.compare_digest(signature, self.sign(player_id, body)):
+                with self.lock:
+                    self.rejected += 1
+                return None
+            if int(issued, 16) + self.ttl_seconds < time.time():
+                with self.lock:
+                    self.expired += 1
+                return None
+            connection_id = decode(connection).decode('utf-8')
+        except (AttributeError, TypeError, ValueError):
+            with self.lock:
+                self.rejected += 1
+            return None
+        with self.lock:
+            self.verified += 1
+        return connection_id
+
+    def stats(self):
+        with self.lock:
+            return {'verified': self.verified, 'rejected': self.rejected, 'expired': self.expired}
@@ -0,0 +1,152 @@
+import json
+import logging
+import random
+import threading
+import time
+
+# Rate-aware post_to_connection for webrtc_signaling_lambda.py.
+#
+# Every post takes a token from a bucket refilled at this container's share of API Gateway's
+# @connections rate limit, so a burst waits here briefly instead of being throttled. A send that is
+# throttled anyway (LimitExceededException) is retried with exponential backoff and full jitter
+# until its attempts or the invocation's deadline run out, and only then dropped. A payload API
+# Gateway rejects as too large is split in two when it is a batch of messages, and each half sent
+# on its own. Counters cover the current invocation; the Lambda logs them when it ends.
+
+MAX_PAYLOAD_BYTES = 128 * 1024
+SPLITTABLE = {'batch': 'messages', 'relay_batch': 'messages'}  # message type -> list that can be split
+THROTTLING_ERRORS = ('LimitExceededException', 'TooManyRequestsException', 'ThrottlingException')
+COUNTERS = ('sent', 'queued', 'retried', 'throttled', 'split', 'dropped', 'gone', 'failed', 'waited_ms')
+
+
+def error_code(error):
+    """The AWS error code of a botocore ClientError, or the exception's text for anything else"""
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code'):
+        return response['Error']['Code']
+    return str(error)
+
+
+class TokenBucket:
+    """`rate` tokens a second, up to `burst` banked; a rate of 0 or less never makes anyone wait"""
+
+    def __init__(self, rate, burst, clock=time):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tokens = float(self.burst)
+        self.updated = clock.monotonic()
+
+    def take(self):
+        """Take a token, returning how many seconds to wait before using it"""
+        if self.rate <= 0:
+            return 0.0
+        with self.lock:
+            now = self.clock.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Going into debt reserves a place in line: concurrent senders wait their turn in order
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class SendScheduler:
+    """Posts payloads through `post(connection_id, payload)` under a token bucket, retrying throttled
+    sends and splitting oversized batches"""
+
+    def __init__(self, post, rate, burst, max_attempts=5, base_delay=0.025, max_delay=1.0, clock=time, logger=None):
+        self.post = post
+        self.logger = logger or logging.getLogger(__name__)
+        self.bucket = TokenBucket(rate, burst, clock)
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.deadline = None
+        self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def begin(self, deadline=None):
+        """Start an invocation: retries give up by `deadline` (a monotonic time), and counters restart"""
+        with self.lock:
+            self.deadline = deadline
+            self.counters = dict.fromkeys(COUNTERS, 0)
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def count(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def send(self, connection_id, payload):
+        """Post one payload; returns 'sent', 'gone' or 'failed'"""
+        if len(payload) > MAX_PAYLOAD_BYTES:
+            parts = split_payload(payload)
+            if parts:
+                self.count('split')
+                return self.send_parts(connection_id, parts)
+
+        attempt = 0
+        while True:
+            wait = self.bucket.take()
+            if wait > 0:
+                self.count('queued')
+                self.count('waited_ms', wait * 1000)
+                self.clock.sleep(wait)
+            try:
+                self.post(connection_id, payload)
+                self.count('sent')
+                return 'sent'
+            except Exception as e:
+                code = error_code(e)
+                if 'GoneException' in code:
+                    self.count('gone')
+                    return 'gone'
+                if 'PayloadTooLargeException' in code:
+                    parts = split_payload(payload)
+                    if parts:
+                        self.count('split')
+                        return self.send_parts(connection_id, parts)
+                    self.logger.error("Payload too large for connection %s: %s bytes", connection_id, len(payload))
+                    self.count('dropped')
+                    return 'failed'
+                if not any(throttled in code for throttled in THROTTLING_ERRORS):
+                    self.logger.error("Error sending message to connection %s: %s", connection_id, e)
+                    self.count('failed')
+                    return 'failed'
+
+                self.count('throttled')
+                attempt += 1
+                # Full jitter: concurrent senders throttled together don't all come back together
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if attempt >= self.max_attempts or (
+                        self.deadline is not None and self.clock.monotonic() + delay > self.deadline):
+                    self.logger.error("Still throttled after %s attempts, dropping message to connection %s",
+                                      attempt, connection_id)
+                    self.count('dropped')
+                    return 'failed'
+                self.count('retried')
+                self.clock.sleep(delay)
+
+    def send_parts(self, connection_id, parts):
+        statuses = [self.send(connection_id, part) for part in parts]
+        if 'gone' in statuses:
+            return 'gone'
+        return 'sent' if all(status == 'sent' for status in statuses) else 'failed'
+
+
+def split_payload(payload):
+    """Two payloads carrying the halves of a batch message's list, or None if it can't be split"""
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        return None
+    field = SPLITTABLE.get(message.get('type')) if isinstance(message, dict) else None
+    entries = message.get(field) if field else None
+    if not isinstance(entries, list) or len(entries) < 2:
+        return None
+    half = len(entries) // 2
+    return [json.dumps(dict(message, **{field: part})).encode('utf-8') for part in (entries[:half], entries[half:])]
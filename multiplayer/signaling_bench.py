@@ -0,0 +1,1408 @@
+#!/usr/bin/env python3
+"""Benchmarks for webrtc_signaling_lambda.py against the in-memory DynamoDB stand-in.
+
+    python signaling_bench.py lookup --players 2000 --messages 200
+    python signaling_bench.py broadcast --players 50 --latency-ms 20
+    python signaling_bench.py ice-storm --candidates 40
+    python signaling_bench.py join-race --players 100
+    python signaling_bench.py load --players 50 --ice-candidates 8 --check
+    python signaling_bench.py rooms --players 64 256 1024 --capacity 8
+    python signaling_bench.py mesh --players 16 64 256 --degree 6
+    python signaling_bench.py relay --players 8 --seconds 10 --fps 120 --tick-ms 0 50 100
+    python signaling_bench.py join-storm --players 64 --ice-candidates 8
+    python signaling_bench.py tokens --players 32 --ice-candidates 8 --db-latency-ms 2
+    python signaling_bench.py reaper --players 1000 --dead-fraction 0.2 --page-size 100
+    python signaling_bench.py heartbeat --players 500 --minutes 10 --containers 8
+    python signaling_bench.py roster --players 64 --churn 200 --gaps 1 4 16 64 200
+    python signaling_bench.py leave-storm --players 256 --capacity 32 --drop-fraction 0.5 --window-ms 200
+    python signaling_bench.py send-burst --players 64 --messages 20 --rate-limit 500 --burst 100
+    python signaling_bench.py metrics --players 32 --ice-candidates 8 --latency-ms 5 --rounds 3
+    python signaling_bench.py logging --messages 20000
+
+lookup reports the DynamoDB read units each signaling message costs, next to
+the full-table scan the Lambda used before the player index existed.
+broadcast compares concurrent fan-out with sending to each player in turn.
+ice-storm shows how many table reads a burst of ICE candidates between two
+peers costs with the warm-container routing cache.
+join-race fires concurrent joins at one room and exits non-zero if the
+roster loses anyone, or if the first join into a room still holding an older
+version's list roster drops its connected members.
+load plays a whole session (joins, full-mesh offer/answer/ICE exchange,
+leaves) and reports DynamoDB calls, read/write units, latency percentiles
+and throughput per handler; --check fails the run if a hot path starts
+scanning or blows its capacity budget.
+rooms joins growing numbers of players and shows join cost and fan-out per
+join with sharded rooms, next to everyone sharing one room.
+mesh fills one big room with players at random positions, has some of them
+leave, and compares each client's WebRTC connections and game-state upload
+with the planned partial mesh against a full mesh; it then plans random rooms
+(some players without positions) at every degree up to --degree and exits
+non-zero if any player is left without peers.
+relay has every player in a room relay its game data through the server (as
+clients do when no DataChannel connects) and reports relay frames per second
+per core with each per-tick batching interval.
+join-storm joins players and runs their offer/answer/ICE exchange with one
+frame per message and with the client's batch envelopes, and compares Lambda
+invocations, frames and DynamoDB calls per join.
+tokens forwards signaling messages routed by the recipient's routing token and
+by the player index lookup, in a warm container and with every message landing
+on a fresh one, plus tokens whose connection has gone (the fallback path).
+reaper drops some players without a $disconnect (and leaves some old clients
+that never send heartbeats), runs one sweep of the connection reaper, and
+reports what it cost and how many dead entries rosters and tables still hold.
+heartbeat runs every connection's pings through a simulated clock and compares
+the writes they cost with and without coalescing, and whether presence still
+tells live players from ones that went quiet.
+roster churns a room with joins and leaves and compares the bytes each change
+costs a client as a versioned event with resending the whole roster, then what
+a roster_sync costs a client that missed the last N changes (a delta, or a
+snapshot once the gap is too large).
+leave-storm drops many sockets at once and compares handling each disconnect's
+leave on its own with coalescing them per room: roster writes, notification
+frames, and whether every remaining player learns of every leaver.
+send-burst fans a burst of messages out to a room through an API Gateway that
+throttles above a rate limit and rejects oversized frames, and compares
+delivered and dropped messages without retries, with retries, and with the
+token bucket pacing sends, plus what happens to a batch too large for a frame.
+metrics runs joins and signaling exchanges with the timing spans and EMF records
+off and on, and reports the CPU and wall time they add per invocation, the
+bytes of EMF written, and whether the ConsumedCapacity they report matches
+what the tables counted.
+logging measures what logging adds to each relayed ICE candidate (CPU time
+and bytes shipped to CloudWatch) at different levels and sample rates.
+"""
+import argparse
+import json
+import logging
+import random
+import sys
+import threading
+import time
+
+import local_dynamodb
+import mesh_planner
+import send_queue
+import signaling_log
+import signaling_metrics
+import signaling_storage
+import webrtc_signaling_lambda as signaling
+
+CONNECTIONS_TABLE = 'bench-connections'
+ROOMS_TABLE = 'bench-rooms'
+PLAYERS_TABLE = 'bench-players'
+ROOM_NAME = 'tank-simulator-main-room'
+
+
+def build_environment(latency=0.0, db_latency=0.0, backend='dynamodb'):
+    """Point the Lambda module at a fresh store and a fake API Gateway client
+
+    The dynamodb backend runs against the in-memory DynamoDB stand-in so capacity is
+    accounted; memory and sqlite (in-memory database) measure those backends directly.
+    """
+    db = local_dynamodb.LocalDynamoDB(latency=db_latency)
+    db.create_table(CONNECTIONS_TABLE, 'connection_id')
+    db.create_table(ROOMS_TABLE, 'room_name')
+    db.create_table(PLAYERS_TABLE, 'player_id')
+    api = local_dynamodb.LocalApiGatewayManagementApi(latency=latency)
+
+    if backend == 'dynamodb':
+        signaling.store = signaling_storage.DynamoDBStore(db.client(), CONNECTIONS_TABLE, ROOMS_TABLE, PLAYERS_TABLE)
+    elif backend == 'memory':
+        signaling.store = signaling_storage.MemoryStore()
+    else:
+        signaling.store = signaling_storage.SQLiteStore(':memory:')
+    signaling.api_client = api
+    signaling.routing_cache = signaling.RoutingCache(
+        max_entries=signaling.routing_cache.max_entries,
+        ttl_seconds=signaling.routing_cache.ttl_seconds
+    )
+    signaling.room_directory = signaling.RoomDirectory(ROOM_NAME, ttl_seconds=signaling.room_directory.ttl_seconds)
+    return db, api
+
+
+def make_event(event_type, connection_id, body=None):
+    event = {
+        'requestContext': {
+            'eventType': event_type,
+            'connectionId': connection_id,
+            'domainName': 'localhost',
+            'stage': 'bench'
+        }
+    }
+    if body is not None:
+        event['body'] = json.dumps(body)
+    return event
+
+
+def seed_players(db, api, count):
+    """Write `count` joined players straight into the store (skips the join path)"""
+    for i in range(count):
+        connection_id = f'conn-{i:06d}'
+        player_id = f'player-{i:06d}'
+        api.connect(connection_id)
+        signaling.store.put_connection(connection_id, '2025-01-01T00:00:00', 'https://example.com')
+        signaling.store.set_connection_player(connection_id, player_id, ROOM_NAME)
+        signaling.store.put_player(player_id, connection_id, ROOM_NAME)
+    db.reset_counters()
+
+
+def legacy_scan_lookup(db, player_id):
+    """The lookup the Lambda did before the player index: a filtered scan of every connection"""
+    table = db.Table(CONNECTIONS_TABLE)
+    scan_kwargs = {'FilterExpression': 'player_id = :pid', 'ExpressionAttributeValues': {':pid': player_id}}
+    while True:
+        response = table.scan(**scan_kwargs)
+        if response.get('Items') or 'LastEvaluatedKey' not in response:
+            return response.get('Items')
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def total_read_units(db):
+    return sum(table['read_units'] for table in db.usage().values())
+
+
+def bench_lookup(players, messages):
+    """Read units per ice_candidate message: player index vs legacy scan"""
+    db, api = build_environment()
+    seed_players(db, api, players)
+
+    started = time.perf_counter()
+    for i in range(messages):
+        sender, recipient = i % players, (i * 7 + 1) % players
+        signaling.lambda_handler(make_event('MESSAGE', f'conn-{sender:06d}', {
+            'type': 'ice_candidate',
+            'from': f'player-{sender:06d}',
+            'to': f'player-{recipient:06d}',
+            'candidate': {'candidate': 'candidate:1 1 udp 2122260223 10.0.0.1 54321 typ host'}
+        }), None)
+    indexed_seconds = time.perf_counter() - started
+    indexed_units = total_read_units(db)
+
+    db.reset_counters()
+    started = time.perf_counter()
+    for i in range(messages):
+        legacy_scan_lookup(db, f'player-{(i * 7 + 1) % players:06d}')
+    legacy_seconds = time.perf_counter() - started
+    legacy_units = total_read_units(db)
+
+    print(f"Players: {players}, signaling messages: {messages}")
+    print(f"  legacy scan lookup : {legacy_units / messages:10.2f} RCU/message  "
+          f"({legacy_seconds / messages * 1000:.3f} ms/message in the stand-in)")
+    print(f"  player index lookup: {indexed_units / messages:10.2f} RCU/message  "
+          f"({indexed_seconds / messages * 1000:.3f} ms/message end to end)")
+    print(f"  reduction          : {legacy_units / max(indexed_units, 0.5):10.1f}x")
+    print(f"  frames delivered   : {api.post_count}")
+
+
+def bench_broadcast(players, latency_ms, gone):
+    """Wall time of one room notification: serial sends vs the concurrent fan-out"""
+    db, api = build_environment(latency=latency_ms / 1000)
+    seed_players(db, api, players)
+    player_connections = {f'player-{i:06d}': f'conn-{i:06d}' for i in range(players)}
+    message = {'type': 'new_player', 'playerId': 'player-new'}
+
+    started = time.perf_counter()
+    for conn_id in player_connections.values():
+        signaling.send_to_connection(conn_id, message)
+    serial_seconds = time.perf_counter() - started
+
+    for i in range(gone):
+        api.disconnect(f'conn-{i:06d}')
+    db.reset_counters()
+    started = time.perf_counter()
+    results = signaling.broadcast_to_players(player_connections, message)
+    concurrent_seconds = time.perf_counter() - started
+
+    usage = db.usage()[CONNECTIONS_TABLE]
+    print(f"Recipients: {players}, simulated post latency: {latency_ms} ms, "
+          f"concurrency: {signaling.BROADCAST_CONCURRENCY}")
+    print(f"  serial sends      : {serial_seconds * 1000:8.1f} ms")
+    print(f"  concurrent fan-out: {concurrent_seconds * 1000:8.1f} ms")
+    print(f"  results           : {sum(1 for s in results.values() if s == 'sent')} sent, "
+          f"{sum(1 for s in results.values() if s == 'gone')} gone")
+    print(f"  gone cleanup      : {usage['calls'].get('BatchWriteItem', 0)} BatchWriteItem call(s), "
+          f"{len(db.Table(CONNECTIONS_TABLE).items)} connections left")
+
+
+def bench_ice_storm(candidates):
+    """Two peers trade a burst of ICE candidates; count player index reads and cache hits"""
+    db, api = build_environment()
+    seed_players(db, api, 2)
+
+    for i in range(candidates):
+        sender, recipient = i % 2, (i + 1) % 2
+        signaling.lambda_handler(make_event('MESSAGE', f'conn-{sender:06d}', {
+            'type': 'ice_candidate',
+            'from': f'player-{sender:06d}',
+            'to': f'player-{recipient:06d}',
+            'candidate': {'candidate': f'candidate:{i} 1 udp 2122260223 10.0.0.{i % 250} 54321 typ host'}
+        }), None)
+
+    stats = signaling.routing_cache.stats()
+    reads = db.usage()[PLAYERS_TABLE]['calls'].get('GetItem', 0)
+    print(f"ICE candidates forwarded: {candidates}")
+    print(f"  player index reads: {reads}")
+    print(f"  routing cache     : {stats['hits']} hits, {stats['misses']} misses, "
+          f"hit rate {stats['hit_rate']:.1%}")
+
+
+def legacy_join(table, player_id):
+    """The roster update the Lambda did before the roster map: read the list, append, write it back"""
+    response = table.get_item(Key={'room_name': 'legacy-room'})
+    players = response.get('Item', {}).get('players', [])
+    if player_id not in players:
+        players.append(player_id)
+        table.put_item(Item={'room_name': 'legacy-room', 'players': players})
+
+
+def run_concurrently(target, args_list):
+    barrier = threading.Barrier(len(args_list))
+
+    def worker(*args):
+        barrier.wait()
+        target(*args)
+
+    threads = [threading.Thread(target=worker, args=args) for args in args_list]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def lobby_rosters(db):
+    """{room_name: roster} for every room shard of the lobby"""
+    items = db.Table(ROOMS_TABLE).items.values()
+    return {
+        item['room_name']: item.get('players', {}) for item in items
+        if item['room_name'] == ROOM_NAME or item['room_name'].startswith(ROOM_NAME + '-')
+    }
+
+
+def bench_join_race(players, db_latency_ms):
+    """Concurrent joins into the lobby must never lose a roster entry or overfill a room"""
+    db, api = build_environment(db_latency=db_latency_ms / 1000)
+    player_ids = [f'player-{i:06d}' for i in range(players)]
+    for i in range(players):
+        api.connect(f'conn-{i:06d}')
+        signaling.lambda_handler(make_event('CONNECT', f'conn-{i:06d}'), None)
+
+    rooms = db.Table(ROOMS_TABLE)
+    rooms.put_item(Item={'room_name': 'legacy-room', 'players': []})
+    db.reset_counters()
+    run_concurrently(legacy_join, [(rooms, pid) for pid in player_ids])
+    legacy_lost = set(player_ids) - set(rooms.get_item(Key={'room_name': 'legacy-room'})['Item']['players'])
+
+    db.reset_counters()
+    started = time.perf_counter()
+    run_concurrently(lambda i: signaling.lambda_handler(
+        make_event('MESSAGE', f'conn-{i:06d}', {'type': 'join', 'playerId': player_ids[i]}), None
+    ), [(i,) for i in range(players)])
+    elapsed = time.perf_counter() - started
+
+    rosters = lobby_rosters(db)
+    placed = [pid for roster in rosters.values() for pid in roster]
+    lost = set(player_ids) - set(placed)
+    duplicated = len(placed) - len(set(placed))
+    overfull = {name: len(roster) for name, roster in rosters.items() if len(roster) > signaling.ROOM_CAPACITY}
+    room_calls = db.usage()[ROOMS_TABLE]['calls']
+    print(f"Concurrent joins: {players} (simulated DynamoDB latency {db_latency_ms} ms)")
+    print(f"  legacy read-modify-write: {len(legacy_lost)} players lost")
+    print(f"  atomic roster map       : {len(lost)} players lost, {duplicated} placed twice, "
+          f"{len(rosters)} rooms of capacity {signaling.ROOM_CAPACITY}, {elapsed * 1000:.0f} ms")
+    print(f"  room table calls        : {room_calls}")
+    upgrade_lost = bench_legacy_roster_upgrade()
+    if lost or duplicated or overfull or upgrade_lost:
+        print(f"  LOST: {sorted(lost)}  OVERFULL: {overfull}  LOST IN UPGRADE: {sorted(upgrade_lost)}")
+        sys.exit(1)
+
+
+def bench_legacy_roster_upgrade():
+    """A lobby room still holding the list roster of older versions: the first join after the
+    deploy must keep everyone in it who is still connected; returns the players it lost"""
+    db, api = build_environment()
+    members = [f'legacy-{i}' for i in range(signaling.ROOM_CAPACITY - 1)]
+    for i, pid in enumerate(members):
+        # What older versions left behind, once migrate_player_index.py has indexed it
+        api.connect(f'legacy-conn-{i}')
+        signaling.lambda_handler(make_event('CONNECT', f'legacy-conn-{i}'), None)
+        signaling.store.set_connection_player(f'legacy-conn-{i}', pid, ROOM_NAME)
+        signaling.store.put_player(pid, f'legacy-conn-{i}', ROOM_NAME)
+    db.Table(ROOMS_TABLE).put_item(Item={'room_name': ROOM_NAME, 'players': members + ['long-gone']})
+    api.connect('new-conn')
+    signaling.lambda_handler(make_event('CONNECT', 'new-conn'), None)
+    signaling.lambda_handler(make_event('MESSAGE', 'new-conn', {'type': 'join', 'playerId': 'new-player'}), None)
+    roster = lobby_rosters(db).get(ROOM_NAME, {})
+    lost = set(members) - set(roster)
+    print(f"  list roster upgrade     : {len(members)} connected members, {len(lost)} lost, "
+          f"{'long-gone' in roster and 'kept' or 'dropped'} the disconnected one, new player "
+          f"{'placed' if 'new-player' in roster else 'MISSING'}")
+    return lost if 'new-player' in roster else lost | {'new-player'}
+
+
+# Per-call budgets enforced by `load --check`: the signaling path must stay O(1)
+BUDGETS = {
+    'handle_signaling_message': {'scans': 0, 'read_units': 0.5, 'write_units': 0},
+    'handle_join': {'scans': 0},
+    'handle_player_leave': {'scans': 0},
+}
+
+
+def usage_totals(db):
+    totals = {'calls': 0, 'scans': 0, 'read_units': 0.0, 'write_units': 0.0}
+    for table in db.usage().values():
+        totals['calls'] += sum(table['calls'].values())
+        totals['scans'] += table['calls'].get('Scan', 0) + table['calls'].get('Query', 0)
+        totals['read_units'] += table['read_units']
+        totals['write_units'] += table['write_units']
+    return totals
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if ordered else 0.0
+
+
+class LoadRecorder:
+    """Runs events through lambda_handler and attributes latency and DynamoDB usage to a handler"""
+
+    def __init__(self, db):
+        self.db = db
+        self.stats = {}
+
+    def run(self, handler_name, event):
+        before = usage_totals(self.db)
+        started = time.perf_counter()
+        response = signaling.lambda_handler(event, None)
+        elapsed = time.perf_counter() - started
+        after = usage_totals(self.db)
+
+        stats = self.stats.setdefault(handler_name, {
+            'latencies': [], 'calls': 0, 'scans': 0, 'read_units': 0.0, 'write_units': 0.0, 'errors': 0
+        })
+        stats['latencies'].append(elapsed)
+        for key in ('calls', 'scans', 'read_units', 'write_units'):
+            stats[key] += after[key] - before[key]
+        if response.get('statusCode') != 200:
+            stats['errors'] += 1
+        return response
+
+    def report(self):
+        print(f"  {'handler':<26}{'count':>7}{'msg/s':>10}{'p50 ms':>9}{'p99 ms':>9}"
+              f"{'ddb/call':>10}{'RCU/call':>10}{'WCU/call':>10}{'scans':>7}{'errors':>7}")
+        for name, stats in self.stats.items():
+            count = len(stats['latencies'])
+            busy = sum(stats['latencies'])
+            print(f"  {name:<26}{count:>7}{count / busy if busy else 0:>10.0f}"
+                  f"{percentile(stats['latencies'], 0.5) * 1000:>9.3f}"
+                  f"{percentile(stats['latencies'], 0.99) * 1000:>9.3f}"
+                  f"{stats['calls'] / count:>10.2f}{stats['read_units'] / count:>10.2f}"
+                  f"{stats['write_units'] / count:>10.2f}{stats['scans']:>7}{stats['errors']:>7}")
+
+    def violations(self):
+        problems = []
+        for name, budget in BUDGETS.items():
+            stats = self.stats.get(name)
+            if not stats:
+                continue
+            count = len(stats['latencies'])
+            for key, limit in budget.items():
+                value = stats[key] if key == 'scans' else stats[key] / count
+                if value > limit:
+                    problems.append(f"{name}: {key} {value:.2f} exceeds budget {limit}")
+        return problems
+
+
+SAMPLE_SDP = {'type': 'offer', 'sdp': 'v=0\r\no=- 4611731400430051336 2 IN IP4 127.0.0.1\r\n' * 20}
+SAMPLE_CANDIDATE = {'candidate': 'candidate:842163049 1 udp 1677729535 203.0.113.7 61530 typ srflx', 'sdpMid': '0'}
+
+
+def signaling_body(message_type, sender, recipient, token=None):
+    """A message shaped like the ones multiplayer.js sends"""
+    body = {'type': message_type, 'from': sender, 'to': recipient}
+    if token:
+        body['token'] = token
+    if message_type == 'ice_candidate':
+        body['candidate'] = SAMPLE_CANDIDATE
+    else:
+        body[message_type] = SAMPLE_SDP
+    return body
+
+
+class MeshClients:
+    """Follows what each multiplayer.js client does with room_info / new_player / player_left / mesh
+    messages, so which WebRTC connections exist and which routing tokens each client holds;
+    sync() returns the (initiator, peer) links opened since"""
+
+    def __init__(self, api):
+        self.api = api
+        self.connection_of = {}
+        self.seen = {}
+        self.peers = {}
+        self.tokens = {}
+        self.mesh_messages = 0
+
+    def add(self, player_id, connection_id):
+        self.connection_of[player_id] = connection_id
+        self.seen[connection_id] = 0
+        self.peers[player_id] = set()
+        self.tokens[player_id] = {}
+
+    def remove(self, player_id):
+        self.seen.pop(self.connection_of.pop(player_id), None)
+        self.tokens.pop(player_id, None)
+        for peer_id in self.peers.pop(player_id, ()):
+            self.peers.get(peer_id, set()).discard(player_id)
+
+    def sync(self):
+        opened = []
+        for player_id, connection_id in list(self.connection_of.items()):
+            messages = self.api.messages(connection_id, self.seen[connection_id])
+            for message in messages:
+                if message['type'] == 'room_info':
+                    opened += [(player_id, peer_id) for peer_id in message.get('peers', message['players'])]
+                    self.tokens[player_id] = dict(message.get('tokens', {}))
+                elif message['type'] == 'new_player' and message.get('token'):
+                    self.tokens[player_id][message['playerId']] = message['token']
+                elif message['type'] == 'player_left':
+                    self.peers[player_id].discard(message['playerId'])
+                    self.tokens[player_id].pop(message['playerId'], None)
+                elif message['type'] == 'mesh':
+                    self.mesh_messages += 1
+                    self.peers[player_id] = set(message['peers'])
+                    opened += [(player_id, peer_id) for peer_id in message['connect']]
+            self.seen[connection_id] += len(messages)
+        for player_id, peer_id in opened:
+            if peer_id in self.peers:
+                self.peers[player_id].add(peer_id)
+                self.peers[peer_id].add(player_id)  # the offer creates the connection on the other side
+        return opened
+
+    def asymmetric_links(self):
+        return sum(1 for pid, peers in self.peers.items() for peer in peers if pid not in self.peers.get(peer, ()))
+
+
+def bench_load(players, ice_candidates, check, backend):
+    """Join N players, run the client's signaling exchange with its planned peers, then have everyone leave"""
+    db, api = build_environment(backend=backend)
+    recorder = LoadRecorder(db)
+    clients = MeshClients(api)
+    connection_of = clients.connection_of
+    started = time.perf_counter()
+
+    for i in range(players):
+        player_id, connection_id = f'player-{i:06d}', f'conn-{i:06d}'
+        clients.add(player_id, connection_id)
+        api.connect(connection_id)
+        recorder.run('handle_connect', make_event('CONNECT', connection_id))
+        recorder.run('handle_join', make_event('MESSAGE', connection_id, {'type': 'join', 'playerId': player_id}))
+
+        # multiplayer.js: the joiner offers to the peers in room_info (and anyone told to by a mesh
+        # update opens its new links), each peer answers, and both sides trickle ICE candidates
+        for initiator, peer_id in clients.sync():
+            exchange = [(initiator, peer_id, 'offer'), (peer_id, initiator, 'answer')]
+            for n in range(ice_candidates):
+                exchange += [(initiator, peer_id, 'ice_candidate'), (peer_id, initiator, 'ice_candidate')]
+            for sender, recipient, message_type in exchange:
+                recorder.run('handle_signaling_message', make_event('MESSAGE', connection_of[sender], signaling_body(
+                    message_type, sender, recipient, clients.tokens[sender].get(recipient)
+                )))
+
+    for player_id, connection_id in list(connection_of.items()):
+        recorder.run('handle_player_leave', make_event('MESSAGE', connection_id, {'type': 'leave', 'playerId': player_id}))
+        api.disconnect(connection_id)
+        recorder.run('handle_disconnect', make_event('DISCONNECT', connection_id))
+
+    elapsed = time.perf_counter() - started
+    total_events = sum(len(stats['latencies']) for stats in recorder.stats.values())
+    print(f"Players: {players}, ICE candidates per side per peer: {ice_candidates}, store: {backend}, "
+          f"frames delivered: {api.post_count}")
+    print(f"  {total_events} events in {elapsed:.2f} s ({total_events / elapsed:.0f} events/s)")
+    recorder.report()
+    cache = signaling.routing_cache.stats()
+    tokens = signaling.routing_tokens.stats()
+    print(f"  routing cache hit rate: {cache['hit_rate']:.1%}, routing tokens verified: {tokens['verified']}, "
+          f"rejected: {tokens['rejected']}, expired: {tokens['expired']}")
+
+    if check:
+        problems = recorder.violations()
+        for problem in problems:
+            print(f"  BUDGET EXCEEDED: {problem}")
+        if problems:
+            sys.exit(1)
+
+
+class CountingStream:
+    """Log sink that only counts what would have been shipped to CloudWatch"""
+
+    def __init__(self):
+        self.bytes = 0
+        self.lines = 0
+
+    def write(self, text):
+        self.bytes += len(text.encode('utf-8'))
+        self.lines += text.count('\n')
+
+    def flush(self):
+        pass
+
+
+LOGGING_CONFIGS = [
+    ('off (baseline)', 'CRITICAL', None),
+    ('DEBUG, every message', 'DEBUG', None),
+    ('INFO, every message', 'INFO', None),
+    ('INFO, signaling sampled 1%', 'INFO', {'handle_signaling_message': 0.01}),
+    ('WARNING', 'WARNING', None),
+]
+
+
+def bench_logging(messages):
+    """Relay ICE candidates between two players under each logging configuration"""
+    root = logging.getLogger()
+    saved_level, saved_handlers, saved_logger = root.level, root.handlers[:], signaling.logger
+    body = signaling_body('ice_candidate', 'player-000000', 'player-000001')
+    event = make_event('MESSAGE', 'conn-000000', body)
+    baseline = None
+
+    print(f"Messages per configuration: {messages}")
+    print(f"  {'configuration':<30}{'us/msg':>9}{'overhead':>10}{'lines/msg':>11}{'bytes/msg':>11}")
+    try:
+        for label, level, rates in LOGGING_CONFIGS:
+            db, api = build_environment(backend='memory')
+            seed_players(db, api, 2)
+            stream = CountingStream()
+            handler = logging.StreamHandler(stream)
+            # Same shape as the Lambda runtime's line format
+            handler.setFormatter(logging.Formatter('[%(levelname)s]\t%(asctime)s.%(msecs)03dZ\t%(message)s'))
+            root.handlers = [handler]
+            root.setLevel(level)
+            signaling.logger = signaling_log.SignalingLogger(root, rates=rates)
+            if baseline is None:
+                for _ in range(messages // 10):
+                    signaling.lambda_handler(event, None)  # warm up before the baseline is taken
+
+            started = time.perf_counter()
+            for _ in range(messages):
+                signaling.lambda_handler(event, None)
+            per_message = (time.perf_counter() - started) / messages * 1e6
+            if baseline is None:
+                baseline = per_message
+            print(f"  {label:<30}{per_message:>9.1f}{per_message - baseline:>+10.1f}"
+                  f"{stream.lines / messages:>11.2f}{stream.bytes / messages:>11.0f}")
+    finally:
+        root.handlers, signaling.logger = saved_handlers, saved_logger
+        root.setLevel(saved_level)
+
+
+def bench_rooms(player_counts, capacity):
+    """Join cost and fan-out per join as the number of players online grows"""
+    saved_capacity = signaling.ROOM_CAPACITY
+    print(f"Join cost per player (room capacity {capacity}, vs one shared room)")
+    print(f"  {'players':>8}  {'layout':<10}{'rooms':>7}{'largest':>9}{'ddb/join':>10}{'WCU/join':>10}"
+          f"{'frames/join':>13}{'p99 ms':>9}")
+    try:
+        for players in player_counts:
+            for layout, room_capacity in (('sharded', capacity), ('one room', 10 ** 9)):
+                signaling.ROOM_CAPACITY = room_capacity
+                db, api = build_environment()
+                latencies = []
+                for i in range(players):
+                    connection_id = f'conn-{i:06d}'
+                    api.connect(connection_id)
+                    signaling.lambda_handler(make_event('CONNECT', connection_id), None)
+                db.reset_counters()
+                frames_before = api.post_count
+                for i in range(players):
+                    started = time.perf_counter()
+                    signaling.lambda_handler(make_event(
+                        'MESSAGE', f'conn-{i:06d}', {'type': 'join', 'playerId': f'player-{i:06d}'}
+                    ), None)
+                    latencies.append(time.perf_counter() - started)
+                totals = usage_totals(db)
+                rosters = lobby_rosters(db)
+                print(f"  {players:>8}  {layout:<10}{len(rosters):>7}{max(map(len, rosters.values())):>9}"
+                      f"{totals['calls'] / players:>10.2f}{totals['write_units'] / players:>10.2f}"
+                      f"{(api.post_count - frames_before) / players:>13.1f}"
+                      f"{percentile(latencies, 0.99) * 1000:>9.3f}")
+    finally:
+        signaling.ROOM_CAPACITY = saved_capacity
+
+
+def bench_mesh(player_counts, degree, leave_fraction, update_bytes, update_hz):
+    """Per-client connections and upload in one big room, planned mesh vs full mesh"""
+    saved = (signaling.ROOM_CAPACITY, signaling.MESH_DEGREE, signaling.MESH_PARTIAL)
+    print(f"One room, players at random positions, {leave_fraction:.0%} then leave; "
+          f"game state {update_bytes} B x {update_hz} Hz to every peer")
+    print(f"  {'players':>8}  {'layout':<12}{'conns max':>10}{'conns avg':>10}{'upload kB/s':>12}"
+          f"{'mesh msg/join':>14}{'mesh msg/leave':>15}{'join p99 ms':>12}{'asymmetric':>11}")
+    try:
+        for players in player_counts:
+            for layout, mesh_degree in (('full mesh', players), (f'degree {degree}', degree)):
+                signaling.ROOM_CAPACITY = players
+                signaling.MESH_DEGREE = mesh_degree
+                signaling.MESH_PARTIAL = players > mesh_degree + 1
+                db, api = build_environment()
+                clients = MeshClients(api)
+                rng = random.Random(players)
+                latencies = []
+                for i in range(players):
+                    player_id, connection_id = f'player-{i:06d}', f'conn-{i:06d}'
+                    clients.add(player_id, connection_id)
+                    api.connect(connection_id)
+                    signaling.lambda_handler(make_event('CONNECT', connection_id), None)
+                    started = time.perf_counter()
+                    signaling.lambda_handler(make_event('MESSAGE', connection_id, {
+                        'type': 'join', 'playerId': player_id,
+                        'position': {'x': rng.uniform(0, 2000), 'y': rng.uniform(0, 2000)}
+                    }), None)
+                    latencies.append(time.perf_counter() - started)
+                    clients.sync()
+                join_messages = clients.mesh_messages
+
+                leaving = rng.sample(sorted(clients.connection_of), int(players * leave_fraction))
+                for player_id in leaving:
+                    connection_id = clients.connection_of[player_id]
+                    signaling.lambda_handler(make_event('MESSAGE', connection_id, {'type': 'leave', 'playerId': player_id}), None)
+                    clients.remove(player_id)
+                    clients.sync()
+
+                counts = [len(peers) for peers in clients.peers.values()]
+                average = sum(counts) / len(counts)
+                print(f"  {players:>8}  {layout:<12}{max(counts):>10}{average:>10.1f}"
+                      f"{average * update_bytes * update_hz / 1000:>12.1f}"
+                      f"{join_messages / players:>14.2f}"
+                      f"{(clients.mesh_messages - join_messages) / max(1, len(leaving)):>15.2f}"
+                      f"{percentile(latencies, 0.99) * 1000:>12.3f}{clients.asymmetric_links():>11}")
+    finally:
+        signaling.ROOM_CAPACITY, signaling.MESH_DEGREE, signaling.MESH_PARTIAL = saved
+
+    rng = random.Random(0)
+    isolated = []
+    rooms = 2000
+    for room in range(rooms):
+        room_degree = rng.randint(1, max(1, degree))
+        players = [f'player-{i:03d}' for i in range(rng.randint(room_degree + 2, 40))]
+        placed = rng.choice((0.0, 0.1, 0.5, 0.9, 1.0))
+        positions = {pid: (rng.uniform(0, 2000), rng.uniform(0, 2000)) for pid in players if rng.random() < placed}
+        plan = mesh_planner.plan_mesh(players, positions, room_degree)
+        isolated += [(room, room_degree, pid) for pid, peers in plan.items() if not peers]
+    print(f"  {rooms} random rooms planned at degrees 1-{max(1, degree)}: {len(isolated)} players left without peers")
+    if isolated:
+        print(f"  ISOLATED: {isolated[:10]}")
+        sys.exit(1)
+
+
+def relay_schedule(players, seconds, fps, rng):
+    """(time, sender, message) in the order multiplayer.js would send them: game.js broadcasts a
+    player_update on frames where timestamp % 100 < 16 (one per 100 ms at 60 fps, two at 120),
+    plus about one shot per second"""
+    schedule = []
+    for frame in range(int(seconds * fps)):
+        now = frame * 1000 / fps
+        for i in range(players):
+            sender = f'player-{i:06d}'
+            if (now + i * 7) % 100 < 16:
+                schedule.append((now, sender, {'type': 'player_update', 'playerData': {
+                    'x': rng.uniform(0, 2000), 'y': rng.uniform(0, 2000), 'rotation': rng.uniform(0, 6.28),
+                    'health': 1000, 'currentWeapon': 'Cannon'
+                }}))
+            if rng.random() < 1 / fps:
+                schedule.append((now, sender, {'type': 'projectile_fired', 'projectile': {
+                    'x': rng.uniform(0, 2000), 'y': rng.uniform(0, 2000), 'rotation': rng.uniform(0, 6.28),
+                    'weaponName': 'Cannon', 'playerId': sender
+                }}))
+    return schedule
+
+
+def bench_relay(players, seconds, fps, ticks_ms):
+    """Every player relays to every other player; frames out and CPU per tick setting"""
+    saved_tick, saved_capacity = signaling.RELAY_TICK_MS, signaling.ROOM_CAPACITY
+    signaling.ROOM_CAPACITY = max(players, saved_capacity)
+    schedule = relay_schedule(players, seconds, fps, random.Random(players))
+    senders = [f'player-{i:06d}' for i in range(players)]
+    print(f"Players: {players}, all relayed to each other, {seconds:g} s of play at {fps} fps, "
+          f"{len(schedule)} relay messages from clients")
+    print(f"  {'tick':<12}{'frames out':>11}{'frames/s/client':>16}{'dropped':>9}{'kB out':>9}"
+          f"{'CPU s':>8}{'msgs in/s/core':>15}{'frames/s/core':>14}")
+    try:
+        for tick_ms in ticks_ms:
+            signaling.RELAY_TICK_MS = tick_ms
+            db, api = build_environment(backend='memory')
+            seed_players(db, api, players)
+            # Relays are only accepted from and to players in the sender's room roster
+            for i, player_id in enumerate(senders):
+                signaling.store.add_to_roster(ROOM_NAME, player_id, f'conn-{i:06d}')
+            signaling.relay_hub = signaling.RelayHub()
+            signaling.relay_scopes = signaling.RelayScopes(ttl_seconds=5, max_entries=players)
+            for player_id in senders:
+                signaling.get_connection_by_player_id(player_id)  # warm routing cache, as a running game would have
+            events = [
+                (now, make_event('MESSAGE', f'conn-{sender[7:]}', {
+                    'type': 'relay', 'from': sender, 'to': [p for p in senders if p != sender], 'data': message
+                }))
+                for now, sender, message in schedule
+            ]
+            frames_before = api.post_count
+
+            started = time.process_time()
+            next_flush = tick_ms
+            for now, event in events:
+                while tick_ms > 0 and now >= next_flush:
+                    signaling.flush_relay()
+                    next_flush += tick_ms
+                signaling.lambda_handler(event, None)
+            signaling.flush_relay()
+            cpu = time.process_time() - started
+
+            frames = api.post_count - frames_before
+            out_bytes = sum(len(frame) for cid in api.connections for frame in api.connections[cid])
+            label = f'{tick_ms:g} ms' if tick_ms > 0 else 'none'
+            print(f"  {label:<12}{frames:>11}{frames / seconds / players:>16.1f}"
+                  f"{signaling.relay_hub.stats()['superseded']:>9}{out_bytes / 1000:>9.0f}{cpu:>8.2f}"
+                  f"{len(events) / cpu:>15.0f}{frames / cpu:>14.0f}")
+    finally:
+        signaling.RELAY_TICK_MS, signaling.ROOM_CAPACITY = saved_tick, saved_capacity
+
+
+def storm_exchange(links, ice_candidates, batched):
+    """The frames clients send to set up `links` ((initiator, peer) pairs): (sender, body) in order
+
+    Unbatched, every offer, answer and candidate is its own frame. Batched, multiplayer.js
+    collects each burst: the initiator's offers, each peer's answers plus candidates, then the
+    initiator's candidates - one batch per sender per burst.
+    """
+    def entries(sender, recipient, message_type, count=1):
+        return [signaling_body(message_type, sender, recipient) for _ in range(count)]
+
+    offers, replies, candidates = {}, {}, {}
+    for initiator, peer in links:
+        offers.setdefault(initiator, []).extend(entries(initiator, peer, 'offer'))
+        replies.setdefault(peer, []).extend(entries(peer, initiator, 'answer') +
+                                            entries(peer, initiator, 'ice_candidate', ice_candidates))
+        candidates.setdefault(initiator, []).extend(entries(initiator, peer, 'ice_candidate', ice_candidates))
+
+    frames = []
+    for burst in (offers, replies, candidates):
+        for sender, messages in burst.items():
+            if batched and len(messages) > 1:
+                frames.append((sender, {'type': 'batch', 'from': sender, 'messages': messages}))
+            else:
+                frames.extend((sender, message) for message in messages)
+    return frames
+
+
+def bench_join_storm(players, ice_candidates):
+    """Invocations, frames and DynamoDB calls per join with and without batch envelopes"""
+    print(f"Players: {players} joining (room capacity {signaling.ROOM_CAPACITY}), "
+          f"{ice_candidates} ICE candidates per side per link")
+    print(f"  {'signaling frames':<20}{'invocations/join':>17}{'frames out/join':>16}{'ddb/join':>10}"
+          f"{'RCU/join':>10}{'ms/join':>9}{'errors':>8}")
+    for label, batched in (('one per message', False), ('batched', True)):
+        db, api = build_environment()
+        clients = MeshClients(api)
+        invocations = errors = 0
+        busy = 0.0
+        for i in range(players):
+            player_id, connection_id = f'player-{i:06d}', f'conn-{i:06d}'
+            clients.add(player_id, connection_id)
+            api.connect(connection_id)
+            signaling.lambda_handler(make_event('CONNECT', connection_id), None)
+        db.reset_counters()
+        frames_before = api.post_count
+
+        for i in range(players):
+            player_id = f'player-{i:06d}'
+            events = [make_event('MESSAGE', clients.connection_of[player_id], {'type': 'join', 'playerId': player_id})]
+            signaling.lambda_handler(events[0], None)
+            events = [make_event('MESSAGE', clients.connection_of[sender], body)
+                      for sender, body in storm_exchange(clients.sync(), ice_candidates, batched)]
+            started = time.perf_counter()
+            for event in events:
+                if signaling.lambda_handler(event, None).get('statusCode') != 200:
+                    errors += 1
+            busy += time.perf_counter() - started
+            invocations += 1 + len(events)
+
+        totals = usage_totals(db)
+        print(f"  {label:<20}{invocations / players:>17.1f}{(api.post_count - frames_before) / players:>16.1f}"
+              f"{totals['calls'] / players:>10.2f}{totals['read_units'] / players:>10.2f}"
+              f"{busy / players * 1000:>9.2f}{errors:>8}")
+
+
+def bench_tokens(players, ice_candidates, db_latency_ms):
+    """DynamoDB usage and latency per signaling message: routing tokens vs the player index lookup"""
+    db, api = build_environment(db_latency=db_latency_ms / 1000)
+    clients = MeshClients(api)
+    links = []
+    for i in range(players):
+        player_id, connection_id = f'player-{i:06d}', f'conn-{i:06d}'
+        clients.add(player_id, connection_id)
+        api.connect(connection_id)
+        signaling.lambda_handler(make_event('CONNECT', connection_id), None)
+        signaling.lambda_handler(make_event('MESSAGE', connection_id, {'type': 'join', 'playerId': player_id}), None)
+        links += clients.sync()
+
+    exchange = []
+    for initiator, peer_id in links:
+        exchange += [(initiator, peer_id, 'offer'), (peer_id, initiator, 'answer')]
+        exchange += [(initiator, peer_id, 'ice_candidate'), (peer_id, initiator, 'ice_candidate')] * ice_candidates
+    # Tokens issued for connections the recipients have since dropped (they reconnected)
+    stale = {pid: signaling.routing_tokens.issue(pid, f'gone-{conn_id}') for pid, conn_id in clients.connection_of.items()}
+
+    print(f"Players: {players} in rooms of {signaling.ROOM_CAPACITY}, {len(exchange)} signaling messages, "
+          f"DynamoDB latency {db_latency_ms} ms")
+    print(f"  {'route by':<16}{'container':<11}{'ddb/msg':>9}{'RCU/msg':>9}{'WCU/msg':>9}"
+          f"{'p50 ms':>9}{'p99 ms':>9}{'errors':>8}")
+    scenarios = [
+        ('index lookup', 'warm', lambda sender, recipient: None),
+        ('index lookup', 'cold', lambda sender, recipient: None),
+        ('routing token', 'warm', lambda sender, recipient: clients.tokens[sender].get(recipient)),
+        ('routing token', 'cold', lambda sender, recipient: clients.tokens[sender].get(recipient)),
+        ('stale token', 'cold', lambda sender, recipient: stale[recipient]),
+    ]
+    for route_by, container, token_for in scenarios:
+        recorder = LoadRecorder(db)
+        signaling.routing_cache = signaling.RoutingCache(
+            max_entries=signaling.routing_cache.max_entries,
+            ttl_seconds=signaling.routing_cache.ttl_seconds
+        )
+        for sender, recipient, message_type in exchange:
+            if container == 'cold':
+                signaling.routing_cache.entries.clear()
+            recorder.run(route_by, make_event('MESSAGE', clients.connection_of[sender], signaling_body(
+                message_type, sender, recipient, token_for(sender, recipient)
+            )))
+        stats = recorder.stats[route_by]
+        count = len(stats['latencies'])
+        print(f"  {route_by:<16}{container:<11}{stats['calls'] / count:>9.2f}{stats['read_units'] / count:>9.2f}"
+              f"{stats['write_units'] / count:>9.2f}{percentile(stats['latencies'], 0.5) * 1000:>9.3f}"
+              f"{percentile(stats['latencies'], 0.99) * 1000:>9.3f}{stats['errors']:>8}")
+    print(f"  token checks: {signaling.routing_tokens.stats()}")
+
+
+def bench_reaper(players, dead_fraction, legacy_fraction, page_size):
+    """One reaper sweep after some connections died without a $disconnect reaching the Lambda"""
+    db, api = build_environment()
+    rng = random.Random(7)
+    ttl = signaling.CONNECTION_TTL_SECONDS
+    signaling.REAPER_PAGE_SIZE = page_size
+    player_ids = [f'player-{i:06d}' for i in range(players)]
+    connection_of = {pid: f'conn-{i:06d}' for i, pid in enumerate(player_ids)}
+
+    # Everyone connects with an expiry already in the past; heartbeats then push the live ones out
+    signaling.CONNECTION_TTL_SECONDS = -1
+    for pid in player_ids:
+        api.connect(connection_of[pid])
+        signaling.lambda_handler(make_event('CONNECT', connection_of[pid]), None)
+        signaling.lambda_handler(make_event('MESSAGE', connection_of[pid], {'type': 'join', 'playerId': pid}), None)
+    signaling.CONNECTION_TTL_SECONDS = ttl
+
+    shuffled = rng.sample(player_ids, players)
+    dead = set(shuffled[:int(players * dead_fraction)])
+    legacy = set(shuffled[len(dead):len(dead) + int(players * legacy_fraction)])
+    for pid in player_ids:
+        if pid in dead:
+            api.disconnect(connection_of[pid])  # the socket dropped and $disconnect never arrived
+        elif pid not in legacy:
+            signaling.lambda_handler(make_event('MESSAGE', connection_of[pid], {'type': 'ping'}), None)
+
+    def ghosts():
+        rostered = [conn_id for roster in lobby_rosters(db).values() for conn_id in roster.values()]
+        rows = db.Table(CONNECTIONS_TABLE).items.values()
+        indexed = db.Table(PLAYERS_TABLE).items.values()
+        return (sum(1 for conn_id in rostered if conn_id not in api.connections),
+                sum(1 for row in rows if row['connection_id'] not in api.connections),
+                sum(1 for row in indexed if row['connection_id'] not in api.connections),
+                len(rostered))
+
+    before = ghosts()
+    db.reset_counters()
+    frames_before = api.post_count
+    started = time.perf_counter()
+    stats = signaling.reap_expired_connections()
+    elapsed = time.perf_counter() - started
+    after = ghosts()
+    usage = db.usage()
+
+    print(f"Players: {players} in rooms of {signaling.ROOM_CAPACITY}, {len(dead)} dropped without $disconnect, "
+          f"{len(legacy)} open but not sending heartbeats, page size {page_size}")
+    print(f"  {'':<10}{'dead roster entries':>21}{'dead connection rows':>22}{'dead index entries':>20}{'rostered':>10}")
+    for label, counts in (('before', before), ('after', after)):
+        print(f"  {label:<10}{counts[0]:>21}{counts[1]:>22}{counts[2]:>20}{counts[3]:>10}")
+    print(f"  sweep: {stats['pages']} pages, {stats['reaped']} reaped, {stats['still_open']} still open, "
+          f"{elapsed * 1000:.0f} ms, {api.post_count - frames_before} notifications sent")
+    for table, entry in usage.items():
+        print(f"  {table:<18} {entry['read_units']:>8.1f} RCU {entry['write_units']:>8.1f} WCU  "
+              f"{json.dumps(entry['calls'], sort_keys=True)}")
+
+
+class SimulatedClock:
+    """Stands in for the time module inside the Lambda module, so minutes of heartbeats run instantly"""
+
+    def __init__(self, start):
+        self.now = start
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return time.perf_counter()
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def bench_heartbeat(players, minutes, containers, quiet_fraction):
+    """Heartbeat writes per connection per minute, and presence accuracy, by coalescing strategy"""
+    heartbeat = signaling.HEARTBEAT_SECONDS
+    saved_window, saved_time = signaling.PRESENCE_WRITE_SECONDS, signaling.time
+    window = saved_window
+    print(f"Players: {players}, {minutes} min of pings every {heartbeat:.0f} s (+-1 s), write window {window:.0f} s, "
+          f"presence timeout {signaling.PRESENCE_TIMEOUT_SECONDS:.0f} s; {quiet_fraction:.0%} go quiet halfway")
+    print(f"  {'coalescing':<26}{'pings':>8}{'writes':>8}{'WCU':>8}{'writes/conn/min':>17}"
+          f"{'max lag s':>11}{'wrong presence':>16}")
+    scenarios = [
+        ('none (every ping writes)', 0, 0, 1, False),
+        ('conditional write only', window, 0, 1, False),
+        ('in-process + conditional', window, window, 1, False),
+        (f'same, {containers} containers', window, window, containers, False),
+        ('+ client echoes lastSeen', window, window, containers, True),
+    ]
+    try:
+        for label, condition_window, cache_window, container_count, echo in scenarios:
+            rng = random.Random(11)
+            clock = SimulatedClock(1_700_000_000.0)
+            signaling.time = clock
+            db, api = build_environment()
+            signaling.PRESENCE_WRITE_SECONDS = condition_window
+            coalescers = [signaling.HeartbeatCoalescer(cache_window, 8192) for _ in range(container_count)]
+
+            connection_ids = [f'conn-{i:06d}' for i in range(players)]
+            for connection_id in connection_ids:
+                api.connect(connection_id)
+                signaling.lambda_handler(make_event('CONNECT', connection_id), None)
+            quiet = set(rng.sample(connection_ids, int(players * quiet_fraction)))
+            db.reset_counters()
+
+            # (time, connection) of every ping; quiet connections stop halfway through
+            end = clock.now + minutes * 60
+            pings = []
+            for connection_id in connection_ids:
+                at = clock.now + rng.uniform(0, heartbeat)
+                stop = clock.now + minutes * 30 if connection_id in quiet else end
+                while at < stop:
+                    pings.append((at, connection_id))
+                    at += heartbeat + rng.uniform(-1, 1)
+            pings.sort()
+
+            rows = db.Table(CONNECTIONS_TABLE).items
+            max_lag = 0.0
+            echoed = {}
+            for at, connection_id in pings:
+                clock.now = at
+                last_seen = rows[(connection_id,)].get('last_seen')
+                if last_seen is not None and connection_id not in quiet:
+                    max_lag = max(max_lag, at - float(last_seen))
+                signaling.heartbeat_coalescer = rng.choice(coalescers)
+                ping = {'type': 'ping', 'lastSeen': echoed.get(connection_id)} if echo else {'type': 'ping'}
+                signaling.lambda_handler(make_event('MESSAGE', connection_id, ping), None)
+                if echo:
+                    echoed[connection_id] = json.loads(api.connections[connection_id][-1])['lastSeen']
+
+            clock.now = end
+            usage = db.usage()[CONNECTIONS_TABLE]
+            writes = usage['calls'].get('UpdateItem', 0)
+            present = signaling.present_connections(connection_ids)
+            wrong = sum(1 for conn_id in connection_ids if (conn_id in present) == (conn_id in quiet))
+            print(f"  {label:<26}{len(pings):>8}{writes:>8}{usage['write_units']:>8.0f}"
+                  f"{writes / players / minutes:>17.2f}{max_lag:>11.1f}{wrong:>16}")
+    finally:
+        signaling.PRESENCE_WRITE_SECONDS = saved_window
+        signaling.time = saved_time
+        signaling.heartbeat_coalescer = signaling.HeartbeatCoalescer(saved_window, 8192)
+
+
+def bench_roster(players, churn, gaps):
+    """Bytes per roster change as versioned events vs whole rosters, and roster_sync replies by gap"""
+    saved_capacity = signaling.ROOM_CAPACITY
+    signaling.ROOM_CAPACITY = players * 2
+    try:
+        db, api = build_environment()
+        rng = random.Random(5)
+
+        def join(pid):
+            connection_id = f'conn-{pid}'
+            api.connect(connection_id)
+            signaling.lambda_handler(make_event('CONNECT', connection_id), None)
+            signaling.lambda_handler(make_event('MESSAGE', connection_id, {'type': 'join', 'playerId': pid}), None)
+
+        observer = 'player-000000'
+        observer_conn = f'conn-{observer}'
+        members = [f'player-{i:06d}' for i in range(players)]
+        for pid in members:
+            join(pid)
+
+        # Churn the room; the observer stays in it and counts what each change costs them
+        received = len(api.connections[observer_conn])
+        event_bytes, snapshot_bytes = [], []
+        joined_count = players
+        for _ in range(churn):
+            if len(members) > players // 2 and rng.random() < 0.5:
+                pid = rng.choice(members[1:])
+                members.remove(pid)
+                signaling.lambda_handler(make_event('MESSAGE', f'conn-{pid}', {'type': 'leave', 'playerId': pid}), None)
+            else:
+                pid = f'player-{joined_count:06d}'
+                joined_count += 1
+                members.append(pid)
+                join(pid)
+            frames = api.connections[observer_conn][received:]
+            received = len(api.connections[observer_conn])
+            event_bytes.append(sum(len(frame) for frame in frames))
+            roster = signaling.store.get_roster(ROOM_NAME)
+            others = [p for p in roster if p != observer]
+            snapshot_bytes.append(len(signaling.encode_message({
+                'type': 'roster', 'room': ROOM_NAME, 'version': roster.version, 'players': others,
+                'tokens': signaling.routing_tokens.issue_all({p: roster[p] for p in others})
+            })))
+
+        version = signaling.store.get_roster(ROOM_NAME).version
+        print(f"One room, {players} players then {churn} joins/leaves; ROSTER_DELTA_MAX {signaling.ROSTER_DELTA_MAX}, "
+              f"departures kept {signaling_storage.DEPARTED_LOG_SIZE}")
+        print(f"  per change to the observer: versioned event {sum(event_bytes) / churn:.0f} B, "
+              f"whole roster {sum(snapshot_bytes) / churn:.0f} B ({len(members)} players at the end)")
+        print(f"  {'missed changes':>15}{'reply':>10}{'bytes':>8}{'RCU':>7}{'joined':>8}{'left':>6}")
+        for gap in gaps:
+            known = max(0, version - gap)
+            db.reset_counters()
+            signaling.lambda_handler(make_event('MESSAGE', observer_conn, {
+                'type': 'roster_sync', 'playerId': observer, 'room': ROOM_NAME, 'version': known
+            }), None)
+            frame = api.connections[observer_conn][-1]
+            reply = json.loads(frame)
+            kind = 'delta' if 'since' in reply else 'snapshot'
+            joined = len(reply.get('joined', reply.get('players', [])))
+            print(f"  {version - known:>15}{kind:>10}{len(frame):>8}{total_read_units(db):>7.1f}{joined:>8}"
+                  f"{len(reply.get('left', [])):>6}")
+    finally:
+        signaling.ROOM_CAPACITY = saved_capacity
+
+
+def bench_leave_storm(players, capacity, drop_fraction, window_ms, db_latency_ms):
+    """Concurrent disconnects of part of every room: per-leave handling vs leaves coalesced per room"""
+    saved = signaling.ROOM_CAPACITY, signaling.LEAVE_WINDOW_MS
+    print(f"Players: {players} in rooms of {capacity}, {drop_fraction:.0%} disconnect at once "
+          f"(simulated DynamoDB latency {db_latency_ms} ms)")
+    print(f"  {'leaves':<26}{'frames':>8}{'leave msgs':>12}{'roster writes':>15}{'room WCU':>10}"
+          f"{'versions':>10}{'wall ms':>9}{'ghosts':>8}{'unaware':>9}")
+    try:
+        for label, window in (('one at a time', 0), (f'coalesced over {window_ms:.0f} ms', window_ms)):
+            db, api = build_environment(db_latency=db_latency_ms / 1000)
+            signaling.ROOM_CAPACITY = capacity
+            signaling.LEAVE_WINDOW_MS = window
+            connection_of = {f'player-{i:06d}': f'conn-{i:06d}' for i in range(players)}
+            for pid, connection_id in connection_of.items():
+                api.connect(connection_id)
+                signaling.lambda_handler(make_event('CONNECT', connection_id), None)
+                signaling.lambda_handler(make_event('MESSAGE', connection_id, {'type': 'join', 'playerId': pid}), None)
+
+            rng = random.Random(3)
+            dropped = set(rng.sample(sorted(connection_of), int(players * drop_fraction)))
+            rooms_before = {name: dict(roster) for name, roster in lobby_rosters(db).items()}
+            versions_before = {item['room_name']: item.get('version', 0) for item in db.Table(ROOMS_TABLE).items.values()}
+            seen = {conn_id: len(api.connections[conn_id]) for pid, conn_id in connection_of.items() if pid not in dropped}
+            for pid in dropped:
+                api.disconnect(connection_of[pid])
+            db.reset_counters()
+            frames_before = api.post_count
+
+            started = time.perf_counter()
+            run_concurrently(lambda conn_id: signaling.lambda_handler(make_event('DISCONNECT', conn_id), None),
+                             [(connection_of[pid],) for pid in dropped])
+            elapsed = time.perf_counter() - started
+
+            # Every survivor should have heard about every leaver from their room, one way or another
+            leave_messages = unaware = 0
+            for room_name, roster in rooms_before.items():
+                leavers = {pid for pid in roster if pid in dropped}
+                for pid in roster:
+                    if pid in dropped:
+                        continue
+                    heard = set()
+                    for frame in api.connections[roster[pid]][seen[roster[pid]]:]:
+                        message = json.loads(frame)
+                        if message['type'] == 'player_left':
+                            heard.add(message['playerId'])
+                            leave_messages += 1
+                        elif message['type'] == 'players_left':
+                            heard.update(message['playerIds'])
+                            leave_messages += 1
+                    unaware += bool(leavers - heard)
+            ghosts = sum(1 for roster in lobby_rosters(db).values() for pid in roster if pid in dropped)
+            versions = sum(item.get('version', 0) - versions_before.get(item['room_name'], 0)
+                           for item in db.Table(ROOMS_TABLE).items.values())
+            rooms = db.usage()[ROOMS_TABLE]
+            print(f"  {label:<26}{api.post_count - frames_before:>8}{leave_messages:>12}"
+                  f"{rooms['calls'].get('UpdateItem', 0):>15}{rooms['write_units']:>10.0f}{versions:>10}"
+                  f"{elapsed * 1000:>9.0f}{ghosts:>8}{unaware:>9}")
+    finally:
+        signaling.ROOM_CAPACITY, signaling.LEAVE_WINDOW_MS = saved
+
+
+def bench_send_burst(players, messages, rate_limit, burst):
+    """A broadcast burst against a throttling API Gateway: dropped vs retried vs paced sends"""
+    saved = signaling.send_scheduler
+    quiet = logging.getLogger('bench.send_queue')  # every drop logs an error; the table counts them instead
+    quiet.disabled = True
+    connection_of = {f'player-{i:06d}': f'conn-{i:06d}' for i in range(players)}
+    print(f"{messages} broadcasts to {players} players ({messages * players} posts) against a limit of "
+          f"{rate_limit}/s with a burst of {burst}")
+    print(f"  {'sending':<22}{'delivered':>10}{'dropped':>9}{'retried':>9}{'throttled':>11}{'queued':>8}{'wall ms':>9}")
+    try:
+        for label, rate, attempts in (('no retry (before)', 0, 1), ('jittered retry', 0, 5),
+                                      ('token bucket + retry', rate_limit, 5)):
+            api = local_dynamodb.LocalApiGatewayManagementApi(rate_limit=rate_limit, burst=burst)
+            signaling.api_client = api
+            signaling.send_scheduler = send_queue.SendScheduler(signaling.post_to_api, rate=rate, burst=burst,
+                                                                max_attempts=attempts, logger=quiet)
+            for connection_id in connection_of.values():
+                api.connect(connection_id)
+            signaling.send_scheduler.begin(time.monotonic() + 30)
+            started = time.perf_counter()
+            for i in range(messages):
+                signaling.broadcast_to_players(connection_of, {'type': 'ping', 'n': i})
+            elapsed = time.perf_counter() - started
+            stats = signaling.send_scheduler.stats()
+            delivered = sum(len(frames) for frames in api.connections.values())
+            print(f"  {label:<22}{delivered:>10}{stats['dropped']:>9}{stats['retried']:>9}"
+                  f"{api.throttled_count:>11}{stats['queued']:>8}{elapsed * 1000:>9.0f}")
+
+        # One relay_batch too big for a frame: before, the whole batch was lost
+        api = local_dynamodb.LocalApiGatewayManagementApi(max_payload=send_queue.MAX_PAYLOAD_BYTES)
+        signaling.api_client = api
+        api.connect('conn-big')
+        entries = [{'type': 'projectile_fired', 'from': 'player-000001', 'data': 'x' * 200} for _ in range(1500)]
+        payload = json.dumps({'type': 'relay_batch', 'messages': entries}).encode('utf-8')
+        print(f"relay_batch of {len(entries)} messages, {len(payload) / 1024:.0f} KB "
+              f"(frame limit {send_queue.MAX_PAYLOAD_BYTES // 1024} KB)")
+        for label in ('whole frame (before)', 'split'):
+            api.connections['conn-big'] = []
+            if label == 'split':
+                scheduler = send_queue.SendScheduler(signaling.post_to_api, rate=0, burst=0, logger=quiet)
+                status = scheduler.send('conn-big', payload)
+            else:
+                try:
+                    signaling.post_to_api('conn-big', payload)
+                    status = 'sent'
+                except Exception:
+                    status = 'failed'
+            received = sum(len(json.loads(frame)['messages']) for frame in api.connections['conn-big'])
+            print(f"  {label:<22}{status:>8}: {len(api.connections['conn-big'])} frames, "
+                  f"{received}/{len(entries)} messages delivered")
+    finally:
+        signaling.send_scheduler = saved
+
+
+def bench_metrics(players, ice_candidates, latency_ms, rounds):
+    """Cost of the metrics spans and EMF records per invocation, and the capacity they report"""
+    saved = signaling.metrics
+    totals = {enabled: {'cpu': 0.0, 'wall': 0.0, 'invocations': 0} for enabled in (False, True)}
+    print(f"Players: {players} in rooms of {signaling.ROOM_CAPACITY}, {ice_candidates} ICE candidates per link, "
+          f"{latency_ms} ms per DynamoDB / API Gateway call, {rounds} rounds")
+    try:
+        for _ in range(rounds):
+            for enabled in (False, True):
+                records = []
+                db, api = build_environment(latency=latency_ms / 1000, db_latency=latency_ms / 1000)
+                recorder = signaling_metrics.MetricsRecorder('Bench', flush_seconds=10, enabled=enabled,
+                                                             emit=records.append)
+                signaling.metrics = recorder
+                signaling.store.instrument(recorder.wrap_client)
+                signaling.api_client = recorder.wrap_client(api, 'apigateway')
+                total = totals[enabled]
+
+                def invoke(event):
+                    cpu, wall = time.process_time(), time.perf_counter()
+                    signaling.lambda_handler(event, None)
+                    total['cpu'] += time.process_time() - cpu
+                    total['wall'] += time.perf_counter() - wall
+                    total['invocations'] += 1
+
+                clients = MeshClients(api)
+                links = []
+                for i in range(players):
+                    player_id, connection_id = f'player-{i:06d}', f'conn-{i:06d}'
+                    clients.add(player_id, connection_id)
+                    api.connect(connection_id)
+                    invoke(make_event('CONNECT', connection_id))
+                    invoke(make_event('MESSAGE', connection_id, {'type': 'join', 'playerId': player_id}))
+                    links += clients.sync()
+                for initiator, peer_id in links:
+                    exchange = [(initiator, peer_id, 'offer'), (peer_id, initiator, 'answer')]
+                    exchange += [(initiator, peer_id, 'ice_candidate'), (peer_id, initiator, 'ice_candidate')] * ice_candidates
+                    for sender, recipient, message_type in exchange:
+                        invoke(make_event('MESSAGE', clients.connection_of[sender], signaling_body(
+                            message_type, sender, recipient, clients.tokens[sender].get(recipient))))
+                recorder.flush()
+                if enabled:
+                    emitted = [json.loads(line) for line in records]
+                    usage = db.usage()
+                    tables = sum(table['read_units'] + table['write_units'] for table in usage.values())
+                    reported = sum(sum(record.get('ReadCapacity', [])) + sum(record.get('WriteCapacity', []))
+                                   for record in emitted)
+                    emf_bytes = sum(len(line) + 1 for line in records)
+
+        print(f"  {'metrics':<10}{'invocations':>12}{'cpu us/inv':>12}{'wall us/inv':>13}")
+        for enabled in (False, True):
+            total = totals[enabled]
+            print(f"  {'on' if enabled else 'off':<10}{total['invocations']:>12}"
+                  f"{total['cpu'] / total['invocations'] * 1e6:>12.1f}{total['wall'] / total['invocations'] * 1e6:>13.1f}")
+        off, on = totals[False], totals[True]
+        added = (on['cpu'] - off['cpu']) / on['invocations']
+        print(f"  overhead: {added * 1e6:.1f} us CPU per invocation, {added / (off['wall'] / off['invocations']):.2%} "
+              f"of an invocation's duration ({(on['cpu'] - off['cpu']) / off['cpu']:+.1%} of its CPU)")
+        print(f"  EMF: {len(records)} records, {emf_bytes} bytes ({emf_bytes / (on['invocations'] / rounds):.1f} "
+              f"bytes per invocation)")
+        print(f"  capacity reported {reported:.1f} units, tables counted {tables:.1f} "
+              f"(the difference is writes whose condition failed)")
+        handlers = sorted(record['MessageType'] for record in emitted if 'Operation' not in record)
+        print(f"  message types: {', '.join(dict.fromkeys(handlers))}")
+    finally:
+        signaling.metrics = saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    lookup = subparsers.add_parser('lookup', help='read units per signaling message')
+    lookup.add_argument('--players', type=int, default=2000)
+    lookup.add_argument('--messages', type=int, default=200)
+
+    broadcast = subparsers.add_parser('broadcast', help='room notification fan-out latency')
+    broadcast.add_argument('--players', type=int, default=50)
+    broadcast.add_argument('--latency-ms', type=float, default=20.0)
+    broadcast.add_argument('--gone', type=int, default=5, help='recipients whose sockets have already closed')
+
+    ice_storm = subparsers.add_parser('ice-storm', help='table reads for a burst of ICE candidates')
+    ice_storm.add_argument('--candidates', type=int, default=40)
+
+    join_race = subparsers.add_parser('join-race', help='concurrent joins must not lose roster entries')
+    join_race.add_argument('--players', type=int, default=100)
+    join_race.add_argument('--db-latency-ms', type=float, default=2.0)
+
+    load = subparsers.add_parser('load', help='full session load test with per-handler metrics')
+    load.add_argument('--players', type=int, default=50)
+    load.add_argument('--ice-candidates', type=int, default=8)
+    load.add_argument('--check', action='store_true', help='exit non-zero when a handler exceeds its budget')
+    load.add_argument('--store', choices=['dynamodb', 'memory', 'sqlite'], default='dynamodb',
+                      help='storage backend (capacity is only accounted for dynamodb)')
+
+    rooms = subparsers.add_parser('rooms', help='join cost and fan-out with sharded rooms')
+    rooms.add_argument('--players', type=int, nargs='+', default=[64, 256, 1024])
+    rooms.add_argument('--capacity', type=int, default=8)
+
+    mesh = subparsers.add_parser('mesh', help='per-client connections with the planned peer mesh')
+    mesh.add_argument('--players', type=int, nargs='+', default=[16, 64, 256])
+    mesh.add_argument('--degree', type=int, default=6)
+    mesh.add_argument('--leave-fraction', type=float, default=0.25)
+    mesh.add_argument('--update-bytes', type=int, default=120, help='size of one player_update message')
+    mesh.add_argument('--update-hz', type=int, default=20)
+
+    join_storm = subparsers.add_parser('join-storm', help='signaling invocations per join, batched vs not')
+    join_storm.add_argument('--players', type=int, default=64)
+    join_storm.add_argument('--ice-candidates', type=int, default=8)
+
+    tokens = subparsers.add_parser('tokens', help='signaling message cost with routing tokens vs index lookups')
+    tokens.add_argument('--players', type=int, default=32)
+    tokens.add_argument('--ice-candidates', type=int, default=8)
+    tokens.add_argument('--db-latency-ms', type=float, default=2.0)
+
+    reaper = subparsers.add_parser('reaper', help='cost and effect of one connection reaper sweep')
+    reaper.add_argument('--players', type=int, default=1000)
+    reaper.add_argument('--dead-fraction', type=float, default=0.2)
+    reaper.add_argument('--legacy-fraction', type=float, default=0.05,
+                        help='share of players still connected but not sending heartbeats')
+    reaper.add_argument('--page-size', type=int, default=100)
+
+    heartbeat = subparsers.add_parser('heartbeat', help='heartbeat write cost and presence accuracy by coalescing')
+    heartbeat.add_argument('--players', type=int, default=500)
+    heartbeat.add_argument('--minutes', type=float, default=10.0)
+    heartbeat.add_argument('--containers', type=int, default=8, help='warm Lambda containers pings are spread over')
+    heartbeat.add_argument('--quiet-fraction', type=float, default=0.1)
+
+    roster = subparsers.add_parser('roster', help='roster change and roster_sync message sizes')
+    roster.add_argument('--players', type=int, default=64)
+    roster.add_argument('--churn', type=int, default=200, help='joins and leaves after the room fills')
+    roster.add_argument('--gaps', type=int, nargs='+', default=[1, 4, 16, 64, 200],
+                        help='changes the syncing client missed')
+
+    leave_storm = subparsers.add_parser('leave-storm', help='mass disconnect cost, per-leave vs coalesced')
+    leave_storm.add_argument('--players', type=int, default=256)
+    leave_storm.add_argument('--capacity', type=int, default=32)
+    leave_storm.add_argument('--drop-fraction', type=float, default=0.5)
+    leave_storm.add_argument('--window-ms', type=float, default=200.0)
+    leave_storm.add_argument('--db-latency-ms', type=float, default=2.0)
+
+    send_burst = subparsers.add_parser('send-burst', help='throttled broadcast bursts and oversized frames')
+    send_burst.add_argument('--players', type=int, default=64)
+    send_burst.add_argument('--messages', type=int, default=20, help='broadcasts sent back to back')
+    send_burst.add_argument('--rate-limit', type=int, default=500, help='posts per second API Gateway allows')
+    send_burst.add_argument('--burst', type=int, default=100)
+
+    metrics = subparsers.add_parser('metrics', help='overhead of timing spans and EMF metrics')
+    metrics.add_argument('--players', type=int, default=32)
+    metrics.add_argument('--ice-candidates', type=int, default=8)
+    metrics.add_argument('--latency-ms', type=float, default=5.0, help='simulated DynamoDB and API Gateway latency')
+    metrics.add_argument('--rounds', type=int, default=3)
+
+    relay = subparsers.add_parser('relay', help='server relay frames per second per core, by batching tick')
+    relay.add_argument('--players', type=int, default=8)
+    relay.add_argument('--seconds', type=float, default=10.0)
+    relay.add_argument('--fps', type=int, default=60, help='client frame rate (sets how often updates go out)')
+    relay.add_argument('--tick-ms', type=float, nargs='+', default=[0, 50, 100])
+
+    logging_bench = subparsers.add_parser('logging', help='per-message logging cost by level and sample rate')
+    logging_bench.add_argument('--messages', type=int, default=20000)
+
+    args = parser.parse_args()
+    if args.benchmark == 'lookup':
+        bench_lookup(args.players, args.messages)
+    elif args.benchmark == 'broadcast':
+        bench_broadcast(args.players, args.latency_ms, args.gone)
+    elif args.benchmark == 'ice-storm':
+        bench_ice_storm(args.candidates)
+    elif args.benchmark == 'join-race':
+        bench_join_race(args.players, args.db_latency_ms)
+    elif args.benchmark == 'load':
+        bench_load(args.players, args.ice_candidates, args.check, args.store)
+    elif args.benchmark == 'rooms':
+        bench_rooms(args.players, args.capacity)
+    elif args.benchmark == 'mesh':
+        bench_mesh(args.players, args.degree, args.leave_fraction, args.update_bytes, args.update_hz)
+    elif args.benchmark == 'join-storm':
+        bench_join_storm(args.players, args.ice_candidates)
+    elif args.benchmark == 'tokens':
+        bench_tokens(args.players, args.ice_candidates, args.db_latency_ms)
+    elif args.benchmark == 'reaper':
+        bench_reaper(args.players, args.dead_fraction, args.legacy_fraction, args.page_size)
+    elif args.benchmark == 'heartbeat':
+        bench_heartbeat(args.players, args.minutes, args.containers, args.quiet_fraction)
+    elif args.benchmark == 'roster':
+        bench_roster(args.players, args.churn, args.gaps)
+    elif args.benchmark == 'leave-storm':
+        bench_leave_storm(args.players, args.capacity, args.drop_fraction, args.window_ms, args.db_latency_ms)
+    elif args.benchmark == 'send-burst':
+        bench_send_burst(args.players, args.messages, args.rate_limit, args.burst)
+    elif args.benchmark == 'metrics':
+        bench_metrics(args.players, args.ice_candidates, args.latency_ms, args.rounds)
+    elif args.benchmark == 'relay':
+        bench_relay(args.players, args.seconds, args.fps, args.tick_ms)
+    elif args.benchmark == 'logging':
+        bench_logging(args.messages)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Logging for webrtc_signaling_lambda.py: config-driven level, per-handler sampling, lazy formatting.
+
+    LOG_LEVEL           level for the handlers (default INFO; DEBUG logs every payload)
+    LOG_SAMPLE_RATE     fraction of invocations whose DEBUG/INFO lines are kept (default 1)
+    LOG_SAMPLE_RATES    per-handler overrides, e.g. "handle_signaling_message=0.01,handle_join=1"
+    LOG_FORMAT          text (default) or json - one object per line with the invocation fields
+
+WARNING and above are never sampled out. Messages take %-style arguments so nothing
+is formatted unless the line is actually emitted; wrap structures in LazyJson rather
+than calling json.dumps at the call site.
+"""
+import json
+import logging
+import os
+import random
+
+
+class LazyJson:
+    """Defers json.dumps until a log record is formatted"""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return json.dumps(self.value, default=str)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: level, message and whatever fields the invocation carries"""
+
+    def format(self, record):
+        entry = {'level': record.levelname, 'message': record.getMessage()}
+        entry.update(getattr(record, 'signaling', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def parse_sample_rates(spec):
+    """'name=rate,name=rate' -> {name: rate}"""
+    rates = {}
+    for part in (spec or '').split(','):
+        name, sep, rate = part.partition('=')
+        if sep and name.strip():
+            rates[name.strip()] = min(1.0, max(0.0, float(rate)))
+    return rates
+
+
+class SignalingLogger:
+    """Wraps a logging.Logger so DEBUG/INFO lines are dropped before a record is even built
+    when the level is off or the current invocation wasn't sampled.
+
+    The sampling decision lives on the instance rather than in a thread-local: a Lambda
+    container runs one invocation at a time, and broadcast worker threads should follow
+    the decision of the invocation that started them.
+    """
+
+    def __init__(self, logger, default_rate=1.0, rates=None):
+        self.logger = logger
+        self.default_rate = default_rate
+        self.rates = rates or {}
+        self.sampled = True
+        self.fields = {}
+
+    def begin(self, handler_name, **fields):
+        """Start (or re-scope) an invocation: pick the handler's sample rate and roll for it"""
+        rate = self.rates.get(handler_name, self.default_rate)
+        self.sampled = rate >= 1.0 or random.random() < rate
+        self.fields = dict(fields, handler=handler_name)
+
+    def isEnabledFor(self, level):
+        if level < logging.WARNING and not self.sampled:
+            return False
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, msg, args, exc_info=False):
+        if self.isEnabledFor(level):
+            self.logger._log(level, msg, args, exc_info=exc_info, extra={'signaling': self.fields}, stacklevel=3)
+
+    def debug(self, msg, *args):
+        self._log(logging.DEBUG, msg, args)
+
+    def info(self, msg, *args):
+        self._log(logging.INFO, msg, args)
+
+    def warning(self, msg, *args):
+        self._log(logging.WARNING, msg, args)
+
+    def error(self, msg, *args, exc_info=False):
+        self._log(logging.ERROR, msg, args, exc_info=exc_info)
+
+    def exception(self, msg, *args):
+        self._log(logging.ERROR, msg, args, exc_info=True)
+
+
+def configure(logger=None):
+    """Build the handlers' logger from LOG_LEVEL / LOG_SAMPLE_RATE(S) / LOG_FORMAT"""
+    logger = logger or logging.getLogger()
+    logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    if os.environ.get('LOG_FORMAT', 'text').lower() == 'json':
+        # The Lambda runtime installs its own handler on the root logger; reformat what's there
+        for handler in logger.handlers:
+            handler.setFormatter(JsonFormatter())
+    return SignalingLogger(
+        logger,
+        default_rate=float(os.environ.get('LOG_SAMPLE_RATE', '1')),
+        rates=parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES'))
+    )
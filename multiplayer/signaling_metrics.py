@@ -0,0 +1,220 @@
+"""Metrics for webrtc_signaling_lambda.py: timing spans and consumed capacity, shipped as CloudWatch
+Embedded Metric Format (EMF) records.
+
+    METRICS_ENABLED          1 to record and emit (default: on in Lambda, off elsewhere)
+    METRICS_NAMESPACE        CloudWatch namespace (default TankSimulator/Signaling)
+    METRICS_FLUSH_SECONDS    how long samples are buffered before a record goes out (default 10)
+
+Each invocation is a span named after its message type ($connect and $disconnect for those
+routes), and every DynamoDB and API Gateway call made during it is a span under that name.
+DynamoDB calls ask for ReturnConsumedCapacity=TOTAL so each span carries the units it cost.
+
+Samples are buffered per (message type) and per (message type, operation) and written as one
+EMF line per key once METRICS_FLUSH_SECONDS have passed or a metric holds 100 values (EMF's
+limit per array). Each value in an array is one sample, so CloudWatch builds the percentiles.
+A record is written when an invocation ends, so samples buffered when a container is frozen
+go out with its next invocation, or are lost if it never gets one.
+"""
+import json
+import os
+import sys
+import threading
+import time
+
+MAX_VALUES = 100
+CAPACITY_OPERATIONS = {
+    'get_item': 'read', 'batch_get_item': 'read', 'query': 'read', 'scan': 'read', 'transact_get_items': 'read',
+    'put_item': 'write', 'update_item': 'write', 'delete_item': 'write', 'batch_write_item': 'write',
+    'transact_write_items': 'write'
+}
+# One row per invocation, one metric per column; a column only carries the rows where it applies
+INVOCATION_METRICS = (
+    ('Latency', 'Milliseconds'), ('DynamoDBCalls', 'Count'), ('ApiCalls', 'Count'), ('ReadCapacity', 'Count'),
+    ('WriteCapacity', 'Count'), ('FanOut', 'Count'), ('Errors', 'Count')
+)
+
+
+def operation_name(method):
+    """boto3 method name -> API operation name (update_item -> UpdateItem)"""
+    return ''.join(part.capitalize() for part in method.split('_'))
+
+
+def capacity_units(consumed):
+    """Total CapacityUnits in a ConsumedCapacity entry (a list for batch operations)"""
+    if not consumed:
+        return 0.0
+    if isinstance(consumed, dict):
+        return float(consumed.get('CapacityUnits', 0))
+    return float(sum(entry.get('CapacityUnits', 0) for entry in consumed))
+
+
+class InstrumentedClient:
+    """Wraps a boto3 client so every API call is recorded as a span"""
+
+    def __init__(self, client, recorder, service):
+        self._client = client
+        self._recorder = recorder
+        self._service = service
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+        timed = self._recorder.timed(self._service, name, attribute)
+        # Cached on the instance so later calls skip __getattr__
+        self.__dict__[name] = timed
+        return timed
+
+
+class MetricsRecorder:
+    """Per-invocation spans, buffered per key and written out as EMF records"""
+
+    def __init__(self, namespace, flush_seconds, enabled=True, emit=None):
+        self.namespace = namespace
+        self.flush_seconds = flush_seconds
+        self.enabled = enabled
+        self.emit = emit or (lambda line: sys.stdout.write(line + '\n'))
+        self.lock = threading.Lock()
+        self.samples = {}  # (handler,) -> [invocation rows], (handler, operation) -> [call latencies]
+        self.flushed_at = time.perf_counter()
+        self.records = 0
+        self.bytes = 0
+        self.invocations = 0
+        self.begin(None)
+
+    def begin(self, name):
+        """Start an invocation's span; `name` can be set later with name() once the message is parsed"""
+        self.handler = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self.widest = 0
+
+    def name(self, name):
+        self.handler = name
+
+    def wrap_client(self, client, service):
+        """Instrument a boto3 client ('dynamodb' or 'apigateway'); returned unchanged when disabled"""
+        if not self.enabled or isinstance(client, InstrumentedClient):
+            return client
+        return InstrumentedClient(client, self, service)
+
+    def timed(self, service, method_name, method):
+        operation = operation_name(method_name)
+        kind = CAPACITY_OPERATIONS.get(method_name) if service == 'dynamodb' else None
+
+        def call(*args, **kwargs):
+            if kind:
+                kwargs.setdefault('ReturnConsumedCapacity', 'TOTAL')
+            started = time.perf_counter()
+            try:
+                response = method(*args, **kwargs)
+            except Exception:
+                self.spans.append((service, operation, time.perf_counter() - started, None, 0.0, True))
+                raise
+            units = capacity_units(response.get('ConsumedCapacity')) if kind and isinstance(response, dict) else 0.0
+            # list.append is atomic, so broadcast threads record spans without taking the lock
+            self.spans.append((service, operation, time.perf_counter() - started, kind, units, False))
+            return response
+
+        return call
+
+    def fanout(self, width):
+        """Record a broadcast's width; the invocation reports its widest"""
+        if width > self.widest:
+            self.widest = width
+
+    def add(self, key, sample):
+        # Caller holds the lock
+        samples = self.samples.get(key)
+        if samples is None:
+            samples = self.samples[key] = []
+        samples.append(sample)
+        if len(samples) >= MAX_VALUES:
+            self.write(key, self.samples.pop(key))
+
+    def end(self):
+        """Close the invocation's span, fold its calls into the buffers and write out whatever is due"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        handler = self.handler or 'unknown'
+        dynamodb = errors = 0
+        reads = writes = 0.0
+        with self.lock:
+            self.invocations += 1
+            for service, operation, seconds, kind, units, error in self.spans:
+                if service == 'dynamodb':
+                    dynamodb += 1
+                    if kind == 'read':
+                        reads += units
+                    else:
+                        writes += units
+                errors += error
+                self.add((handler, operation), seconds)
+            self.add((handler,), (now - self.started, dynamodb, len(self.spans) - dynamodb,
+                                  reads, writes, self.widest, errors))
+            if now - self.flushed_at >= self.flush_seconds:
+                self.flush_locked()
+
+    def flush(self):
+        with self.lock:
+            self.flush_locked()
+
+    def flush_locked(self):
+        samples, self.samples = self.samples, {}
+        self.flushed_at = time.perf_counter()
+        for key, metrics in samples.items():
+            self.write(key, metrics)
+
+    def write(self, key, samples):
+        # Caller holds the lock; latencies are buffered in seconds and written in milliseconds
+        if len(key) == 2:
+            metrics = {'Latency': [round(seconds * 1000, 2) for seconds in samples]}
+            units = {'Latency': 'Milliseconds'}
+        else:
+            metrics = {}
+            latency, dynamodb, api, reads, writes, widest, errors = zip(*samples)
+            metrics['Latency'] = [round(seconds * 1000, 2) for seconds in latency]
+            metrics['DynamoDBCalls'] = list(dynamodb)
+            metrics['ApiCalls'] = list(api)
+            used = [i for i, calls in enumerate(dynamodb) if calls]
+            if used:
+                metrics['ReadCapacity'] = [reads[i] for i in used]
+                metrics['WriteCapacity'] = [writes[i] for i in used]
+            if any(widest):
+                metrics['FanOut'] = [width for width in widest if width]
+            if any(errors):
+                metrics['Errors'] = [count for count in errors if count]
+            units = dict(INVOCATION_METRICS)
+        dimensions = ['MessageType', 'Operation'][:len(key)]
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [dimensions],
+                    'Metrics': [{'Name': metric, 'Unit': units[metric]} for metric in metrics]
+                }]
+            }
+        }
+        record.update(zip(dimensions, key))
+        record.update(metrics)
+        line = json.dumps(record, separators=(',', ':'))
+        self.records += 1
+        self.bytes += len(line) + 1
+        self.emit(line)
+
+    def stats(self):
+        with self.lock:
+            return {'invocations': self.invocations, 'records': self.records, 'bytes': self.bytes}
+
+
+def configure(emit=None):
+    """Build the recorder from METRICS_ENABLED / METRICS_NAMESPACE / METRICS_FLUSH_SECONDS"""
+    default = '1' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else '0'
+    return MetricsRecorder(
+        namespace=os.environ.get('METRICS_NAMESPACE', 'TankSimulator/Signaling'),
+        flush_seconds=float(os.environ.get('METRICS_FLUSH_SECONDS', '10')),
+        enabled=os.environ.get('METRICS_ENABLED', default) == '1',
+        emit=emit
+    )
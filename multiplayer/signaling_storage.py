@@ -0,0 +1,1457 @@
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from decimal import Decimal
+from botocore.exceptions import ClientError
+
+# Storage backends for webrtc_signaling_lambda.py.
+#
+# Every backend keeps the same collections:
+#   connections  connection_id -> {connection_id, timestamp, player_id, room, origin, expires_at, last_seen}
+#   players      player_id -> {connection_id, room}            (the player index)
+#   rosters      room_name -> {player_id: connection_id}, version, when each member joined and
+#                recent departures (see Roster)
+#   departures   room_name -> leaves queued for the next flush, and who holds the flush lease
+#   positions    room_name -> {player_id: (x, y)}          (last reported, for the mesh planner)
+#   directory    lobby -> rooms with space, shard counter   (see RoomAllocator)
+# and makes the same guarantees: roster changes are atomic per player, and removals are
+# conditional on the entry still pointing at the expected connection, so a player who
+# reconnected is never removed by cleanup of their old connection. Every roster write bumps the
+# room's version by exactly one. Heartbeats set last_seen and push expires_at forward (both epoch
+# seconds); rows past expires_at are swept by the reaper in the Lambda module.
+
+# Departures remembered per room for roster deltas; past this the oldest half are dropped and
+# clients that knew only versions before them get a full snapshot instead
+DEPARTED_LOG_SIZE = int(os.environ.get('ROSTER_DEPARTED_LOG_SIZE', '64'))
+
+# Unprocessed BatchWriteItem requests mean the table is throttling: resend them after an
+# exponential backoff with full jitter, at most this many times
+BATCH_WRITE_ATTEMPTS = 8
+BATCH_WRITE_BASE_DELAY = 0.05
+BATCH_WRITE_MAX_DELAY = 2.0
+
+
+class Roster(dict):
+    """A room's {player_id: connection_id} and the version it was read at
+
+    Rosters read with history also carry the version each member joined at, the version each
+    recent leaver left at, and the floor below which departures have been forgotten.
+    """
+
+    def __init__(self, players=(), version=0, joined=None, departed=None, floor=0):
+        super().__init__(players)
+        self.version = version
+        self.joined = joined or {}
+        self.departed = departed or {}
+        self.floor = floor
+
+    def changes_since(self, version):
+        """(players who joined, players who left) after `version`, or None if that is older than the
+        departures on record (or newer than this roster)"""
+        if not self.floor <= version <= self.version:
+            return None
+        joined = [pid for pid in self if self.joined.get(pid, 0) > version]
+        left = [pid for pid, left_at in self.departed.items() if left_at > version and pid not in self]
+        return joined, left
+
+
+class SignalingStore:
+    """Interface implemented by every storage backend"""
+
+    # -- connections --------------------------------------------------------
+    def put_connection(self, connection_id, timestamp, origin, expires_at=None):
+        raise NotImplementedError
+
+    def get_connection(self, connection_id):
+        """Return the connection record as a dict, or None"""
+        raise NotImplementedError
+
+    def set_connection_player(self, connection_id, player_id, room):
+        raise NotImplementedError
+
+    def set_connection_room(self, connection_id, room):
+        raise NotImplementedError
+
+    def delete_connection(self, connection_id):
+        """Delete a connection and return the record it had, or None"""
+        raise NotImplementedError
+
+    def delete_connections(self, connection_ids):
+        """Delete many connections in as few round trips as the backend allows"""
+        raise NotImplementedError
+
+    def refresh_connection(self, connection_id, expires_at):
+        """Push an existing connection's expiry out to expires_at; returns False if there is no such record"""
+        raise NotImplementedError
+
+    def get_expired_connections(self, now, limit, start=None):
+        """Return (records whose expires_at is before `now` or missing, key to resume from or None),
+        examining about `limit` records per call; pass the key back as `start` for the next page"""
+        raise NotImplementedError
+
+    def record_heartbeat(self, connection_id, now, expires_at, fresh_for):
+        """Set last_seen = now and the new expiry, unless last_seen is already within `fresh_for` seconds
+        of now; returns the last_seen the record holds afterwards, or None if there is no such connection"""
+        raise NotImplementedError
+
+    def get_presence(self, connection_ids, consistent=False):
+        """Return {connection_id: last_seen, or None if it has never sent a heartbeat} for connections
+        that still exist"""
+        raise NotImplementedError
+
+    # -- player index -------------------------------------------------------
+    def put_player(self, player_id, connection_id, room):
+        raise NotImplementedError
+
+    def get_player_connection(self, player_id):
+        """Return the player's connection ID, or None"""
+        raise NotImplementedError
+
+    def get_player_connections(self, player_ids, consistent=False):
+        """Return {player_id: connection_id} for the players that are indexed"""
+        raise NotImplementedError
+
+    def release_player(self, player_id, connection_id):
+        """Remove the index entry only if it still points at connection_id; returns whether it was removed"""
+        raise NotImplementedError
+
+    # -- rosters ------------------------------------------------------------
+    def add_to_roster(self, room_name, player_id, connection_id, capacity=None):
+        """Atomically map player -> connection in the room (creating it) unless the room already holds
+        `capacity` other players; returns (added, Roster) with the roster as it stands afterwards"""
+        raise NotImplementedError
+
+    def get_roster(self, room_name):
+        """Return the room's Roster (empty, version 0, if there is no such room)"""
+        raise NotImplementedError
+
+    def get_roster_history(self, room_name):
+        """Return the room's Roster with its joined/departed versions, read consistently"""
+        raise NotImplementedError
+
+    def remove_from_roster(self, room_name, player_id, connection_id):
+        """Remove the player if the roster maps them to connection_id; returns the remaining Roster or None"""
+        raise NotImplementedError
+
+    def remove_stale_roster_entries(self, room_name, stale):
+        """Remove {player_id: connection_id} entries that still hold those values; returns the Roster
+        afterwards (with anyone who joined meanwhile), or None if any entry moved"""
+        raise NotImplementedError
+
+    def queue_departure(self, room_name, player_id, connection_id, lease, now, stale_after):
+        """Queue the player's leave for the room's next flush and take the flush lease for `lease` if nobody
+        holds it (or the holder took it over `stale_after` seconds ago); returns whether `lease` holds it"""
+        raise NotImplementedError
+
+    def take_departures(self, room_name, lease, limit):
+        """Take up to `limit` queued leaves out of the room in one write, skipping players who have rejoined
+        on another connection, and release the lease if the queue is then empty; returns (departed
+        {player_id: connection_id}, Roster afterwards, whether the lease was released), or None if
+        `lease` doesn't hold the lease"""
+        raise NotImplementedError
+
+    # -- positions ----------------------------------------------------------
+    def set_position(self, room_name, player_id, connection_id, position):
+        """Record the player's last reported (x, y) if the roster maps them to connection_id;
+        returns whether it was recorded"""
+        raise NotImplementedError
+
+    def get_positions(self, room_name):
+        """Return {player_id: (x, y)} for the room, possibly including players who have since left"""
+        raise NotImplementedError
+
+    def remove_positions(self, room_name, player_ids):
+        raise NotImplementedError
+
+    # -- room directory -----------------------------------------------------
+    def get_room_directory(self, lobby, consistent=False):
+        """Return (rooms last marked as having space, number of shards opened so far)"""
+        raise NotImplementedError
+
+    def set_room_open(self, lobby, room_name, is_open):
+        raise NotImplementedError
+
+    def claim_room_shard(self, lobby, shard_count):
+        """Open shard number `shard_count` if nobody else has yet; returns whether this caller did"""
+        raise NotImplementedError
+
+    # -- lifecycle ----------------------------------------------------------
+    def warm(self):
+        """Open clients or connections now rather than on the first request"""
+
+    def instrument(self, wrap):
+        """Route AWS calls through wrap(client, service), e.g. signaling_metrics' timing spans"""
+
+
+def _is_conditional_failure(error):
+    return error.response['Error']['Code'] == 'ConditionalCheckFailedException'
+
+
+class DynamoDBStore(SignalingStore):
+    """Connections, player index and rooms tables in DynamoDB
+
+    Uses the low-level client: the resource layer costs ~50 ms of cold start to build and
+    the store only needs plain item operations. The client itself is created on first use
+    (or by warm()), unless one is passed in.
+    """
+
+    def __init__(self, client, connections_table, rooms_table, players_table):
+        from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+        self._client = client
+        self._client_lock = threading.Lock()
+        self._wrap = None
+        self._serialize = TypeSerializer().serialize
+        self._deserialize = TypeDeserializer().deserialize
+        self.connections_table = connections_table
+        self.rooms_table = rooms_table
+        # Player index: player_id -> connection_id, so lookups are a single GetItem instead of a
+        # table scan. Existing deployments backfill it with migrate_player_index.py.
+        self.players_table = players_table
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import boto3
+                    client = boto3.client('dynamodb')
+                    self._client = self._wrap(client, 'dynamodb') if self._wrap else client
+        return self._client
+
+    def warm(self):
+        return self.client
+
+    def instrument(self, wrap):
+        with self._client_lock:
+            self._wrap = wrap
+            if self._client is not None:
+                self._client = wrap(self._client, 'dynamodb')
+
+    def _typed(self, values):
+        return {k: self._serialize(v) for k, v in values.items()}
+
+    def _native(self, item):
+        return {k: self._deserialize(v) for k, v in item.items()} if item is not None else None
+
+    def put_connection(self, connection_id, timestamp, origin, expires_at=None):
+        self.client.put_item(
+            TableName=self.connections_table,
+            Item=self._typed({
+                'connection_id': connection_id,
+                'timestamp': timestamp,
+                'player_id': None,  # Will be set when they join a room
+                'room': None,       # Will be set when they join a room
+                'origin': origin,
+                'expires_at': expires_at  # The table's TTL attribute, as a backstop for the reaper
+            })
+        )
+
+    def get_connection(self, connection_id):
+        response = self.client.get_item(
+            TableName=self.connections_table,
+            Key=self._typed({'connection_id': connection_id})
+        )
+        return self._native(response.get('Item'))
+
+    def set_connection_player(self, connection_id, player_id, room):
+        self.client.update_item(
+            TableName=self.connections_table,
+            Key=self._typed({'connection_id': connection_id}),
+            UpdateExpression='SET player_id = :pid, room = :room',
+            ExpressionAttributeValues=self._typed({':pid': player_id, ':room': room})
+        )
+
+    def set_connection_room(self, connection_id, room):
+        self.client.update_item(
+            TableName=self.connections_table,
+            Key=self._typed({'connection_id': connection_id}),
+            UpdateExpression='SET room = :room',
+            ExpressionAttributeValues=self._typed({':room': room})
+        )
+
+    def delete_connection(self, connection_id):
+        response = self.client.delete_item(
+            TableName=self.connections_table,
+            Key=self._typed({'connection_id': connection_id}),
+            ReturnValues='ALL_OLD'
+        )
+        return self._native(response.get('Attributes'))
+
+    def delete_connections(self, connection_ids):
+        requests = [
+            {'DeleteRequest': {'Key': self._typed({'connection_id': connection_id})}}
+            for connection_id in dict.fromkeys(connection_ids)
+        ]
+        # BatchWriteItem accepts at most 25 requests; resend whatever comes back unprocessed
+        leftover = 0
+        for start in range(0, len(requests), 25):
+            pending = {self.connections_table: requests[start:start + 25]}
+            for attempt in range(BATCH_WRITE_ATTEMPTS):
+                pending = self.client.batch_write_item(RequestItems=pending).get('UnprocessedItems')
+                if not pending:
+                    break
+                if attempt + 1 < BATCH_WRITE_ATTEMPTS:
+                    time.sleep(random.uniform(0, min(BATCH_WRITE_MAX_DELAY, BATCH_WRITE_BASE_DELAY * 2 ** attempt)))
+            else:
+                leftover += len(pending.get(self.connections_table, []))
+        if leftover:
+            raise RuntimeError(f"{leftover} connection deletes still unprocessed after {BATCH_WRITE_ATTEMPTS} attempts")
+
+    def refresh_connection(self, connection_id, expires_at):
+        try:
+            self.client.update_item(
+                TableName=self.connections_table,
+                Key=self._typed({'connection_id': connection_id}),
+                UpdateExpression='SET expires_at = :exp',
+                ConditionExpression='attribute_exists(connection_id)',
+                ExpressionAttributeValues=self._typed({':exp': expires_at})
+            )
+            return True
+        except ClientError as e:
+            if _is_conditional_failure(e):
+                return False
+            raise
+
+    def get_expired_connections(self, now, limit, start=None):
+        # Rows written before connections carried an expiry are swept too
+        request = {
+            'TableName': self.connections_table,
+            'FilterExpression': 'expires_at < :now OR attribute_not_exists(expires_at) OR attribute_type(expires_at, :null)',
+            'ProjectionExpression': 'connection_id, player_id, room, expires_at',
+            'ExpressionAttributeValues': self._typed({':now': int(now), ':null': 'NULL'}),
+            'Limit': limit
+        }
+        if start:
+            request['ExclusiveStartKey'] = start
+        response = self.client.scan(**request)
+        return [self._native(item) for item in response.get('Items', [])], response.get('LastEvaluatedKey')
+
+    def record_heartbeat(self, connection_id, now, expires_at, fresh_for):
+        try:
+            self.client.update_item(
+                TableName=self.connections_table,
+                Key=self._typed({'connection_id': connection_id}),
+                UpdateExpression='SET last_seen = :now, expires_at = :exp',
+                ConditionExpression='attribute_exists(connection_id) AND '
+                                    '(attribute_not_exists(last_seen) OR last_seen <= :cutoff)',
+                ExpressionAttributeValues=self._typed({
+                    ':now': int(now), ':exp': expires_at, ':cutoff': int(now - fresh_for)
+                }),
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+            return int(now)
+        except ClientError as e:
+            if _is_conditional_failure(e):
+                item = e.response.get('Item')
+                return int(item['last_seen']['N']) if item else None
+            raise
+
+    def get_presence(self, connection_ids, consistent=False):
+        presence = {}
+        keys = [self._typed({'connection_id': conn_id}) for conn_id in dict.fromkeys(connection_ids)]
+        for start in range(0, len(keys), 100):
+            request = {
+                self.connections_table: {
+                    'Keys': keys[start:start + 100],
+                    'ProjectionExpression': 'connection_id, last_seen',
+                    'ConsistentRead': consistent
+                }
+            }
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.connections_table, []):
+                    item = self._native(item)
+                    presence[item['connection_id']] = int(item['last_seen']) if item.get('last_seen') else None
+                request = response.get('UnprocessedKeys')
+        return presence
+
+    def put_player(self, player_id, connection_id, room):
+        self.client.put_item(
+            TableName=self.players_table,
+            Item=self._typed({'player_id': player_id, 'connection_id': connection_id, 'room': room})
+        )
+
+    def get_player_connection(self, player_id):
+        response = self.client.get_item(
+            TableName=self.players_table,
+            Key=self._typed({'player_id': player_id}),
+            ProjectionExpression='connection_id'
+        )
+        item = response.get('Item')
+        return item['connection_id']['S'] if item else None
+
+    def get_player_connections(self, player_ids, consistent=False):
+        player_connections = {}
+        keys = [self._typed({'player_id': pid}) for pid in dict.fromkeys(player_ids)]
+        # BatchGetItem accepts at most 100 keys per request
+        for start in range(0, len(keys), 100):
+            request = {
+                self.players_table: {
+                    'Keys': keys[start:start + 100],
+                    'ProjectionExpression': 'player_id, connection_id',
+                    'ConsistentRead': consistent
+                }
+            }
+            while request:
+                response = self.client.batch_get_item(RequestItems=request)
+                for item in response.get('Responses', {}).get(self.players_table, []):
+                    player_connections[item['player_id']['S']] = item['connection_id']['S']
+                request = response.get('UnprocessedKeys')
+        return player_connections
+
+    def release_player(self, player_id, connection_id):
+        try:
+            self.client.delete_item(
+                TableName=self.players_table,
+                Key=self._typed({'player_id': player_id}),
+                ConditionExpression='connection_id = :cid',
+                ExpressionAttributeValues=self._typed({':cid': connection_id})
+            )
+            return True
+        except ClientError as e:
+            if _is_conditional_failure(e):
+                return False
+            raise
+
+    def _roster(self, item, history=False):
+        item = self._native(item) or {}
+        players = item.get('players', {})
+        # A list is a roster from older versions, not yet converted by _create_room
+        roster = Roster(players if isinstance(players, dict) else {}, int(item.get('version', 0)))
+        if history:
+            roster.joined = {pid: int(v) for pid, v in item.get('joined', {}).items()}
+            roster.departed = {pid: int(v) for pid, v in item.get('departed', {}).items()}
+            roster.floor = int(item.get('departed_floor', 0))
+        return roster
+
+    def add_to_roster(self, room_name, player_id, connection_id, capacity=None):
+        # The version bump and the member's joined version are both computed from the old version
+        update = {
+            'TableName': self.rooms_table,
+            'Key': self._typed({'room_name': room_name}),
+            'UpdateExpression': ('SET players.#pid = :conn, version = if_not_exists(version, :zero) + :one, '
+                                 'joined.#pid = if_not_exists(version, :zero) + :one REMOVE departed.#pid'),
+            'ExpressionAttributeNames': {'#pid': player_id},
+            'ExpressionAttributeValues': self._typed({':conn': connection_id, ':zero': 0, ':one': 1}),
+            'ReturnValues': 'ALL_NEW'
+        }
+        if capacity is not None:
+            # A missing roster passes here and is created below; a rejoining player always fits
+            update['ConditionExpression'] = ('attribute_not_exists(players) OR attribute_exists(players.#pid) '
+                                             'OR size(players) < :cap')
+            update['ExpressionAttributeValues'][':cap'] = self._serialize(capacity)
+            update['ReturnValuesOnConditionCheckFailure'] = 'ALL_OLD'
+        for attempt in range(2):
+            try:
+                response = self.client.update_item(**update)
+                return True, self._roster(response['Attributes'])
+            except ClientError as e:
+                if _is_conditional_failure(e):
+                    item = e.response.get('Item') or {}
+                    # A roster still stored as a list by older versions is sized as one; convert it first
+                    if 'L' not in item.get('players', {}) or attempt:
+                        return False, self._roster(item)
+                # The nested SETs are rejected until the room has its maps
+                elif e.response['Error']['Code'] != 'ValidationException' or attempt:
+                    raise
+                self._create_room(room_name)
+
+    def _create_room(self, room_name):
+        """Create a room with empty roster maps, adding the joined/departed/leaving maps to rooms created
+        before those existed; a roster stored as a list by older versions is rebuilt from the player index"""
+        maps = ('joined = if_not_exists(joined, :empty), departed = if_not_exists(departed, :empty), '
+                'leaving = if_not_exists(leaving, :empty)')
+        try:
+            self.client.update_item(
+                TableName=self.rooms_table,
+                Key=self._typed({'room_name': room_name}),
+                UpdateExpression=f'SET players = :empty, {maps}, created_at = if_not_exists(created_at, :now)',
+                ConditionExpression='attribute_not_exists(players)',
+                ExpressionAttributeValues=self._typed({':empty': {}, ':now': datetime.now().isoformat()})
+            )
+            return
+        except ClientError as e:
+            if not _is_conditional_failure(e):
+                raise
+        item = self.client.get_item(
+            TableName=self.rooms_table,
+            Key=self._typed({'room_name': room_name}),
+            ProjectionExpression='players, version',
+            ConsistentRead=True
+        ).get('Item', {})
+        if 'L' in item.get('players', {}):
+            if self._convert_legacy_roster(room_name, item):
+                return
+        # Another join created or converted it first, or only the version maps were missing
+        self.client.update_item(
+            TableName=self.rooms_table,
+            Key=self._typed({'room_name': room_name}),
+            UpdateExpression=f'SET {maps}',
+            ExpressionAttributeValues=self._typed({':empty': {}})
+        )
+
+    def _convert_legacy_roster(self, room_name, item):
+        """Replace a list roster with the {player_id: connection_id} map the player index gives for its
+        members, as one new version; False if the list changed or was converted meanwhile. Members the
+        index no longer has (disconnected) are left out, and later joins prune the rest as usual."""
+        legacy = item['players']
+        members = [value['S'] for value in legacy['L'] if 'S' in value]
+        roster = self.get_player_connections(members, consistent=True)
+        version = int(self._native(item).get('version', 0)) + 1
+        values = self._typed({
+            ':roster': roster,
+            ':joined': {pid: version for pid in roster},
+            ':version': version,
+            ':empty': {},
+            ':now': datetime.now().isoformat()
+        })
+        values[':legacy'] = legacy
+        try:
+            self.client.update_item(
+                TableName=self.rooms_table,
+                Key=self._typed({'room_name': room_name}),
+                UpdateExpression=('SET players = :roster, version = :version, joined = :joined, '
+                                  'departed = if_not_exists(departed, :empty), leaving = if_not_exists(leaving, :empty), '
+                                  'created_at = if_not_exists(created_at, :now)'),
+                ConditionExpression='players = :legacy',
+                ExpressionAttributeValues=values
+            )
+            return True
+        except ClientError as e:
+            if not _is_conditional_failure(e):
+                raise
+            return False
+
+    def get_roster(self, room_name):
+        response = self.client.get_item(
+            TableName=self.rooms_table,
+            Key=self._typed({'room_name': room_name}),
+            ProjectionExpression='players, version'
+        )
+        return self._roster(response.get('Item'))
+
+    def get_roster_history(self, room_name):
+        response = self.client.get_item(
+            TableName=self.rooms_table,
+            Key=self._typed({'room_name': room_name}),
+            ProjectionExpression='players, version, joined, departed, departed_floor',
+            ConsistentRead=True
+        )
+        return self._roster(response.get('Item'), history=True)
+
+    def _remove_roster_entries(self, room_name, entries):
+        """One conditional write removing {player_id: connection_id} entries and recording them as
+        departed at the next version; returns the Roster afterwards, or None if any entry moved"""
+        names = {f'#p{i}': pid for i, pid in enumerate(entries)}
+        values = self._typed({f':c{i}': conn_id for i, conn_id in enumerate(entries.values())})
+        values.update(self._typed({':zero': 0, ':one': 1}))
+        update = {
+            'TableName': self.rooms_table,
+            'Key': self._typed({'room_name': room_name}),
+            'UpdateExpression': (
+                'REMOVE ' + ', '.join(f'players.{n}, joined.{n}' for n in names)
+                + ' SET version = if_not_exists(version, :zero) + :one, '
+                + ', '.join(f'departed.{n} = if_not_exists(version, :zero) + :one' for n in names)
+            ),
+            'ConditionExpression': ' AND '.join(f'players.#p{i} = :c{i}' for i in range(len(entries))),
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values,
+            'ReturnValues': 'ALL_NEW'
+        }
+        for attempt in range(2):
+            try:
+                response = self.client.update_item(**update)
+                break
+            except ClientError as e:
+                if _is_conditional_failure(e):
+                    return None
+                # Rooms created before rosters were versioned have no departed map yet
+                if e.response['Error']['Code'] != 'ValidationException' or attempt:
+                    raise
+                self._create_room(room_name)
+        roster = self._roster(response['Attributes'], history=True)
+        if len(roster.departed) > DEPARTED_LOG_SIZE:
+            self._trim_departed(room_name, roster.departed)
+        return roster
+
+    def _trim_departed(self, room_name, departed):
+        """Forget the oldest departures, raising the room's floor past them"""
+        oldest = sorted(departed.items(), key=lambda entry: entry[1])[:len(departed) - DEPARTED_LOG_SIZE // 2]
+        floor = oldest[-1][1]
+        values = {f':v{i}': left_at for i, (_, left_at) in enumerate(oldest)}
+        values[':floor'] = floor
+        try:
+            self.client.update_item(
+                TableName=self.rooms_table,
+                Key=self._typed({'room_name': room_name}),
+                UpdateExpression=('REMOVE ' + ', '.join(f'departed.#d{i}' for i in range(len(oldest)))
+                                  + ' SET departed_floor = :floor'),
+                # Skip it if any of them rejoined (and maybe left again) meanwhile, or a newer trim won
+                ConditionExpression=(' AND '.join(f'departed.#d{i} = :v{i}' for i in range(len(oldest)))
+                                     + ' AND (attribute_not_exists(departed_floor) OR departed_floor < :floor)'),
+                ExpressionAttributeNames={f'#d{i}': pid for i, (pid, _) in enumerate(oldest)},
+                ExpressionAttributeValues=self._typed(values)
+            )
+        except ClientError as e:
+            if not _is_conditional_failure(e):
+                raise
+
+    def remove_from_roster(self, room_name, player_id, connection_id):
+        return self._remove_roster_entries(room_name, {player_id: connection_id})
+
+    def queue_departure(self, room_name, player_id, connection_id, lease, now, stale_after):
+        update = {
+            'TableName': self.rooms_table,
+            'Key': self._typed({'room_name': room_name}),
+            'UpdateExpression': ('SET leaving.#pid = :conn, leave_lease = if_not_exists(leave_lease, :lease), '
+                                 'leave_lease_at = if_not_exists(leave_lease_at, :now)'),
+            'ExpressionAttributeNames': {'#pid': player_id},
+            'ExpressionAttributeValues': self._typed({':conn': connection_id, ':lease': lease, ':now': int(now)}),
+            'ReturnValues': 'UPDATED_NEW'
+        }
+        for attempt in range(2):
+            try:
+                held = self._native(self.client.update_item(**update)['Attributes'])
+                break
+            except ClientError as e:
+                # The nested SET is rejected until the room has a leaving map
+                if e.response['Error']['Code'] != 'ValidationException' or attempt:
+                    raise
+                self._create_room(room_name)
+        if held['leave_lease'] == lease:
+            return True
+        if held['leave_lease_at'] >= now - stale_after:
+            return False
+        # Whoever holds it died before flushing: take over
+        try:
+            self.client.update_item(
+                TableName=self.rooms_table,
+                Key=self._typed({'room_name': room_name}),
+                UpdateExpression='SET leave_lease = :lease, leave_lease_at = :now',
+                ConditionExpression='leave_lease = :held',
+                ExpressionAttributeValues=self._typed({
+                    ':lease': lease, ':now': int(now), ':held': held['leave_lease']
+                })
+            )
+            return True
+        except ClientError as e:
+            if _is_conditional_failure(e):
+                return False
+            raise
+
+    def take_departures(self, room_name, lease, limit):
+        key = self._typed({'room_name': room_name})
+        # Each attempt loses only to a leave being queued or a player rejoining meanwhile
+        for attempt in range(10):
+            item = self._native(self.client.get_item(
+                TableName=self.rooms_table,
+                Key=key,
+                ProjectionExpression='players, leaving, leave_lease',
+                ConsistentRead=True
+            ).get('Item')) or {}
+            if item.get('leave_lease') != lease:
+                return None
+            leaving = item.get('leaving', {})
+            players = item.get('players', {})
+            batch = dict(list(leaving.items())[:limit])
+            departed = {pid: conn_id for pid, conn_id in batch.items() if players.get(pid) == conn_id}
+            released = len(batch) == len(leaving)
+
+            values = {f':c{i}': conn_id for i, conn_id in enumerate(batch.values())}
+            values[':lease'] = lease
+            removes = [f'leaving.#p{i}' for i in range(len(batch))]
+            sets = []
+            conditions = ['leave_lease = :lease'] + [f'leaving.#p{i} = :c{i}' for i in range(len(batch))]
+            for i, pid in enumerate(batch):
+                if pid in departed:
+                    removes += [f'players.#p{i}', f'joined.#p{i}']
+                    sets.append(f'departed.#p{i} = if_not_exists(version, :zero) + :one')
+                    conditions.append(f'players.#p{i} = :c{i}')
+            if departed:
+                sets.append('version = if_not_exists(version, :zero) + :one')
+                values.update({':zero': 0, ':one': 1})
+            if released:
+                removes += ['leave_lease', 'leave_lease_at']
+                conditions.append('(attribute_not_exists(leaving) OR size(leaving) = :n)')
+                values[':n'] = len(batch)
+            update = {
+                'TableName': self.rooms_table,
+                'Key': key,
+                'UpdateExpression': 'REMOVE ' + ', '.join(removes) + (' SET ' + ', '.join(sets) if sets else ''),
+                'ConditionExpression': ' AND '.join(conditions),
+                'ExpressionAttributeValues': self._typed(values),
+                'ReturnValues': 'ALL_NEW'
+            }
+            # DynamoDB rejects an empty (or None) ExpressionAttributeNames and unused values alike
+            if batch:
+                update['ExpressionAttributeNames'] = {f'#p{i}': pid for i, pid in enumerate(batch)}
+            try:
+                response = self.client.update_item(**update)
+            except ClientError as e:
+                if _is_conditional_failure(e):
+                    continue
+                raise
+            roster = self._roster(response['Attributes'], history=True)
+            if len(roster.departed) > DEPARTED_LOG_SIZE:
+                self._trim_departed(room_name, roster.departed)
+            return departed, roster, released
+        return None
+
+    def set_position(self, room_name, player_id, connection_id, position):
+        update = {
+            'TableName': self.rooms_table,
+            'Key': self._typed({'room_name': room_name}),
+            'UpdateExpression': 'SET positions.#pid = :pos',
+            'ConditionExpression': 'players.#pid = :conn',
+            'ExpressionAttributeNames': {'#pid': player_id},
+            # Numbers go in as decimals; a tenth of a unit is plenty for ranking neighbours
+            'ExpressionAttributeValues': self._typed({
+                ':conn': connection_id,
+                ':pos': [Decimal(str(round(v, 1))) for v in position]
+            })
+        }
+        for attempt in range(2):
+            try:
+                self.client.update_item(**update)
+                return True
+            except ClientError as e:
+                if _is_conditional_failure(e):
+                    return False
+                # As with the roster, the nested SET needs the positions map to exist first
+                if e.response['Error']['Code'] != 'ValidationException' or attempt:
+                    raise
+                try:
+                    self.client.update_item(
+                        TableName=self.rooms_table,
+                        Key=self._typed({'room_name': room_name}),
+                        UpdateExpression='SET positions = :empty',
+                        ConditionExpression='attribute_not_exists(positions)',
+                        ExpressionAttributeValues=self._typed({':empty': {}})
+                    )
+                except ClientError as e:
+                    if not _is_conditional_failure(e):
+                        raise
+
+    def get_positions(self, room_name):
+        response = self.client.get_item(
+            TableName=self.rooms_table,
+            Key=self._typed({'room_name': room_name}),
+            ProjectionExpression='positions'
+        )
+        positions = (self._native(response.get('Item')) or {}).get('positions', {})
+        return {pid: (float(x), float(y)) for pid, (x, y) in positions.items()}
+
+    def remove_positions(self, room_name, player_ids):
+        player_ids = list(dict.fromkeys(player_ids))
+        for start in range(0, len(player_ids), 50):
+            chunk = player_ids[start:start + 50]
+            try:
+                self.client.update_item(
+                    TableName=self.rooms_table,
+                    Key=self._typed({'room_name': room_name}),
+                    UpdateExpression='REMOVE ' + ', '.join(f'positions.#p{i}' for i in range(len(chunk))),
+                    ExpressionAttributeNames={f'#p{i}': pid for i, pid in enumerate(chunk)}
+                )
+            except ClientError as e:
+                # No positions map at all: nothing to remove
+                if e.response['Error']['Code'] != 'ValidationException':
+                    raise
+
+    def _directory_key(self, lobby):
+        # The directory lives in the rooms table under a key no room can have
+        return self._typed({'room_name': f'{lobby}#directory'})
+
+    def get_room_directory(self, lobby, consistent=False):
+        response = self.client.get_item(
+            TableName=self.rooms_table,
+            Key=self._directory_key(lobby),
+            ProjectionExpression='open_rooms, shard_count',
+            ConsistentRead=consistent
+        )
+        directory = self._native(response.get('Item')) or {}
+        return sorted(directory.get('open_rooms', ())), int(directory.get('shard_count', 0))
+
+    def set_room_open(self, lobby, room_name, is_open):
+        self.client.update_item(
+            TableName=self.rooms_table,
+            Key=self._directory_key(lobby),
+            UpdateExpression=('ADD' if is_open else 'DELETE') + ' open_rooms :room',
+            ExpressionAttributeValues=self._typed({':room': {room_name}})
+        )
+
+    def claim_room_shard(self, lobby, shard_count):
+        try:
+            self.client.update_item(
+                TableName=self.rooms_table,
+                Key=self._directory_key(lobby),
+                UpdateExpression='SET shard_count = :next',
+                ConditionExpression='attribute_not_exists(shard_count) OR shard_count = :seen',
+                ExpressionAttributeValues=self._typed({':seen': shard_count, ':next': shard_count + 1})
+            )
+            return True
+        except ClientError as e:
+            if _is_conditional_failure(e):
+                return False
+            raise
+
+    def remove_stale_roster_entries(self, room_name, stale):
+        latest = None
+        removed_all = True
+        stale = list(stale.items())
+        # Keep each expression comfortably inside DynamoDB's size limits
+        for start in range(0, len(stale), 50):
+            roster = self._remove_roster_entries(room_name, dict(stale[start:start + 50]))
+            if roster is None:
+                removed_all = False
+            elif latest is None or roster.version > latest.version:
+                latest = roster
+        return latest if removed_all else None
+
+
+class MemoryStore(SignalingStore):
+    """Plain dicts behind one lock: deterministic and fast for tests, benchmarks and the local server"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}
+        self.players = {}
+        self.rosters = {}
+        self.roster_logs = {}  # room_name -> {version, joined, departed, floor}
+        self.departures = {}   # room_name -> {leaving, lease, lease_at}
+        self.positions = {}    # room_name -> {player_id: (x, y)}
+        self.open_rooms = {}   # lobby -> set of room names
+        self.shard_counts = {}
+
+    def put_connection(self, connection_id, timestamp, origin, expires_at=None):
+        with self.lock:
+            self.connections[connection_id] = {
+                'connection_id': connection_id,
+                'timestamp': timestamp,
+                'player_id': None,
+                'room': None,
+                'origin': origin,
+                'expires_at': expires_at
+            }
+
+    def get_connection(self, connection_id):
+        with self.lock:
+            record = self.connections.get(connection_id)
+            return dict(record) if record else None
+
+    def set_connection_player(self, connection_id, player_id, room):
+        with self.lock:
+            record = self.connections.setdefault(connection_id, {'connection_id': connection_id})
+            record['player_id'] = player_id
+            record['room'] = room
+
+    def set_connection_room(self, connection_id, room):
+        with self.lock:
+            self.connections.setdefault(connection_id, {'connection_id': connection_id})['room'] = room
+
+    def delete_connection(self, connection_id):
+        with self.lock:
+            return self.connections.pop(connection_id, None)
+
+    def delete_connections(self, connection_ids):
+        with self.lock:
+            for connection_id in connection_ids:
+                self.connections.pop(connection_id, None)
+
+    def refresh_connection(self, connection_id, expires_at):
+        with self.lock:
+            record = self.connections.get(connection_id)
+            if record is None:
+                return False
+            record['expires_at'] = expires_at
+            return True
+
+    def get_expired_connections(self, now, limit, start=None):
+        with self.lock:
+            page = sorted(cid for cid in self.connections if start is None or cid > start)[:limit]
+            expired = [dict(self.connections[cid]) for cid in page
+                       if self.connections[cid].get('expires_at') is None or self.connections[cid]['expires_at'] < now]
+        return expired, page[-1] if len(page) == limit else None
+
+    def record_heartbeat(self, connection_id, now, expires_at, fresh_for):
+        with self.lock:
+            record = self.connections.get(connection_id)
+            if record is None:
+                return None
+            if record.get('last_seen') is None or record['last_seen'] <= now - fresh_for:
+                record['last_seen'] = int(now)
+                record['expires_at'] = expires_at
+            return record['last_seen']
+
+    def get_presence(self, connection_ids, consistent=False):
+        with self.lock:
+            return {conn_id: self.connections[conn_id].get('last_seen')
+                    for conn_id in connection_ids if conn_id in self.connections}
+
+    def put_player(self, player_id, connection_id, room):
+        with self.lock:
+            self.players[player_id] = {'connection_id': connection_id, 'room': room}
+
+    def get_player_connection(self, player_id):
+        with self.lock:
+            entry = self.players.get(player_id)
+            return entry['connection_id'] if entry else None
+
+    def get_player_connections(self, player_ids, consistent=False):
+        with self.lock:
+            return {pid: self.players[pid]['connection_id'] for pid in player_ids if pid in self.players}
+
+    def release_player(self, player_id, connection_id):
+        with self.lock:
+            entry = self.players.get(player_id)
+            if entry is None or entry['connection_id'] != connection_id:
+                return False
+            del self.players[player_id]
+            return True
+
+    def _log(self, room_name):
+        return self.roster_logs.setdefault(room_name, {'version': 0, 'joined': {}, 'departed': {}, 'floor': 0})
+
+    def _roster(self, room_name, history=False):
+        log = self._log(room_name)
+        roster = Roster(self.rosters.get(room_name, {}), log['version'])
+        if history:
+            roster.joined, roster.departed, roster.floor = dict(log['joined']), dict(log['departed']), log['floor']
+        return roster
+
+    def add_to_roster(self, room_name, player_id, connection_id, capacity=None):
+        with self.lock:
+            roster = self.rosters.setdefault(room_name, {})
+            if capacity is not None and player_id not in roster and len(roster) >= capacity:
+                return False, self._roster(room_name)
+            roster[player_id] = connection_id
+            log = self._log(room_name)
+            log['version'] += 1
+            log['joined'][player_id] = log['version']
+            log['departed'].pop(player_id, None)
+            return True, self._roster(room_name)
+
+    def get_roster(self, room_name):
+        with self.lock:
+            return self._roster(room_name)
+
+    def get_roster_history(self, room_name):
+        with self.lock:
+            return self._roster(room_name, history=True)
+
+    def _remove_roster_entries(self, room_name, entries):
+        roster = self.rosters.get(room_name, {})
+        if any(roster.get(pid) != conn_id for pid, conn_id in entries.items()):
+            return False
+        log = self._log(room_name)
+        log['version'] += 1
+        for pid in entries:
+            del roster[pid]
+            log['joined'].pop(pid, None)
+            log['departed'][pid] = log['version']
+        if len(log['departed']) > DEPARTED_LOG_SIZE:
+            oldest = sorted(log['departed'].items(), key=lambda entry: entry[1])
+            for pid, left_at in oldest[:len(oldest) - DEPARTED_LOG_SIZE // 2]:
+                del log['departed'][pid]
+                log['floor'] = left_at
+        return True
+
+    def remove_from_roster(self, room_name, player_id, connection_id):
+        with self.lock:
+            if not self._remove_roster_entries(room_name, {player_id: connection_id}):
+                return None
+            return self._roster(room_name)
+
+    def remove_stale_roster_entries(self, room_name, stale):
+        with self.lock:
+            if not self._remove_roster_entries(room_name, stale):
+                return None
+            return self._roster(room_name)
+
+    def queue_departure(self, room_name, player_id, connection_id, lease, now, stale_after):
+        with self.lock:
+            queue = self.departures.setdefault(room_name, {'leaving': {}, 'lease': None, 'lease_at': 0})
+            queue['leaving'][player_id] = connection_id
+            if queue['lease'] is None or queue['lease_at'] < now - stale_after:
+                queue['lease'], queue['lease_at'] = lease, now
+            return queue['lease'] == lease
+
+    def take_departures(self, room_name, lease, limit):
+        with self.lock:
+            queue = self.departures.get(room_name)
+            if queue is None or queue['lease'] != lease:
+                return None
+            batch = dict(list(queue['leaving'].items())[:limit])
+            roster = self.rosters.get(room_name, {})
+            departed = {pid: conn_id for pid, conn_id in batch.items() if roster.get(pid) == conn_id}
+            for pid in batch:
+                del queue['leaving'][pid]
+            if departed:
+                self._remove_roster_entries(room_name, departed)
+            released = not queue['leaving']
+            if released:
+                queue['lease'] = None
+            return departed, self._roster(room_name), released
+
+    def set_position(self, room_name, player_id, connection_id, position):
+        with self.lock:
+            if self.rosters.get(room_name, {}).get(player_id) != connection_id:
+                return False
+            self.positions.setdefault(room_name, {})[player_id] = (float(position[0]), float(position[1]))
+            return True
+
+    def get_positions(self, room_name):
+        with self.lock:
+            return dict(self.positions.get(room_name, {}))
+
+    def remove_positions(self, room_name, player_ids):
+        with self.lock:
+            positions = self.positions.get(room_name, {})
+            for pid in player_ids:
+                positions.pop(pid, None)
+
+    def get_room_directory(self, lobby, consistent=False):
+        with self.lock:
+            return sorted(self.open_rooms.get(lobby, ())), self.shard_counts.get(lobby, 0)
+
+    def set_room_open(self, lobby, room_name, is_open):
+        with self.lock:
+            rooms = self.open_rooms.setdefault(lobby, set())
+            if is_open:
+                rooms.add(room_name)
+            else:
+                rooms.discard(room_name)
+
+    def claim_room_shard(self, lobby, shard_count):
+        with self.lock:
+            if self.shard_counts.get(lobby, 0) != shard_count:
+                return False
+            self.shard_counts[lobby] = shard_count + 1
+            return True
+
+
+class SQLiteStore(SignalingStore):
+    """Single-node storage in SQLite (WAL mode), for running signaling on one box without AWS"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS connections (
+            connection_id TEXT PRIMARY KEY,
+            timestamp TEXT,
+            player_id TEXT,
+            room TEXT,
+            origin TEXT,
+            expires_at REAL,
+            last_seen INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS players (
+            player_id TEXT PRIMARY KEY,
+            connection_id TEXT NOT NULL,
+            room TEXT
+        );
+        CREATE INDEX IF NOT EXISTS players_by_connection ON players (connection_id);
+        CREATE TABLE IF NOT EXISTS roster (
+            room_name TEXT NOT NULL,
+            player_id TEXT NOT NULL,
+            connection_id TEXT NOT NULL,
+            joined_version INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (room_name, player_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS roster_versions (
+            room_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL,
+            departed_floor INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS roster_departed (
+            room_name TEXT NOT NULL,
+            player_id TEXT NOT NULL,
+            version INTEGER NOT NULL,
+            PRIMARY KEY (room_name, player_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS departures (
+            room_name TEXT NOT NULL,
+            player_id TEXT NOT NULL,
+            connection_id TEXT NOT NULL,
+            PRIMARY KEY (room_name, player_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS departure_leases (
+            room_name TEXT PRIMARY KEY,
+            lease TEXT NOT NULL,
+            lease_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS positions (
+            room_name TEXT NOT NULL,
+            player_id TEXT NOT NULL,
+            x REAL NOT NULL,
+            y REAL NOT NULL,
+            PRIMARY KEY (room_name, player_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS open_rooms (
+            lobby TEXT NOT NULL,
+            room_name TEXT NOT NULL,
+            PRIMARY KEY (lobby, room_name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS room_shards (
+            lobby TEXT PRIMARY KEY,
+            shard_count INTEGER NOT NULL
+        );
+    """
+
+    def __init__(self, path):
+        import sqlite3  # only paid for by deployments that use this backend
+        # One connection shared by the handler threads; the lock serialises its use
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.executescript(self.SCHEMA)
+        # Databases created before connections carried an expiry and heartbeat time, and before
+        # rosters were versioned
+        for table, column, column_type in (('connections', 'expires_at', 'REAL'),
+                                           ('connections', 'last_seen', 'INTEGER'),
+                                           ('roster', 'joined_version', 'INTEGER NOT NULL DEFAULT 0')):
+            columns = {row['name'] for row in self.db.execute(f'PRAGMA table_info({table})')}
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+        self.lock = threading.Lock()
+
+    def _transaction(self, statements):
+        """Run (sql, params) pairs atomically"""
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                for sql, params in statements:
+                    self.db.execute(sql, params)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def _roster(self, room_name, history=False):
+        rows = self.db.execute(
+            'SELECT player_id, connection_id, joined_version FROM roster WHERE room_name = ?', (room_name,)
+        ).fetchall()
+        log = self.db.execute(
+            'SELECT version, departed_floor FROM roster_versions WHERE room_name = ?', (room_name,)
+        ).fetchone()
+        roster = Roster({row['player_id']: row['connection_id'] for row in rows}, log['version'] if log else 0)
+        if history:
+            roster.joined = {row['player_id']: row['joined_version'] for row in rows}
+            roster.departed = {row['player_id']: row['version'] for row in self.db.execute(
+                'SELECT player_id, version FROM roster_departed WHERE room_name = ?', (room_name,)
+            )}
+            roster.floor = log['departed_floor'] if log else 0
+        return roster
+
+    def _bump_version(self, room_name):
+        """Advance the room's version inside the current transaction and return the new one"""
+        self.db.execute(
+            'INSERT INTO roster_versions (room_name, version) VALUES (?, 1) '
+            'ON CONFLICT (room_name) DO UPDATE SET version = version + 1',
+            (room_name,)
+        )
+        return self.db.execute('SELECT version FROM roster_versions WHERE room_name = ?', (room_name,)).fetchone()[0]
+
+    def _trim_departed(self, room_name):
+        rows = self.db.execute(
+            'SELECT player_id, version FROM roster_departed WHERE room_name = ? ORDER BY version', (room_name,)
+        ).fetchall()
+        if len(rows) <= DEPARTED_LOG_SIZE:
+            return
+        oldest = rows[:len(rows) - DEPARTED_LOG_SIZE // 2]
+        self.db.execute('DELETE FROM roster_departed WHERE room_name = ? AND version <= ?',
+                        (room_name, oldest[-1]['version']))
+        self.db.execute('UPDATE roster_versions SET departed_floor = ? WHERE room_name = ?',
+                        (oldest[-1]['version'], room_name))
+
+    def put_connection(self, connection_id, timestamp, origin, expires_at=None):
+        self._transaction([(
+            'INSERT OR REPLACE INTO connections (connection_id, timestamp, player_id, room, origin, expires_at) '
+            'VALUES (?, ?, NULL, NULL, ?, ?)',
+            (connection_id, timestamp, origin, expires_at)
+        )])
+
+    def get_connection(self, connection_id):
+        rows = self._query('SELECT * FROM connections WHERE connection_id = ?', (connection_id,))
+        return dict(rows[0]) if rows else None
+
+    def set_connection_player(self, connection_id, player_id, room):
+        self._transaction([(
+            'UPDATE connections SET player_id = ?, room = ? WHERE connection_id = ?',
+            (player_id, room, connection_id)
+        )])
+
+    def set_connection_room(self, connection_id, room):
+        self._transaction([('UPDATE connections SET room = ? WHERE connection_id = ?', (room, connection_id))])
+
+    def delete_connection(self, connection_id):
+        with self.lock:
+            row = self.db.execute('SELECT * FROM connections WHERE connection_id = ?', (connection_id,)).fetchone()
+            self.db.execute('DELETE FROM connections WHERE connection_id = ?', (connection_id,))
+            return dict(row) if row else None
+
+    def delete_connections(self, connection_ids):
+        self._transaction([
+            ('DELETE FROM connections WHERE connection_id = ?', (connection_id,))
+            for connection_id in connection_ids
+        ])
+
+    def refresh_connection(self, connection_id, expires_at):
+        with self.lock:
+            return self.db.execute('UPDATE connections SET expires_at = ? WHERE connection_id = ?',
+                                   (expires_at, connection_id)).rowcount > 0
+
+    def get_expired_connections(self, now, limit, start=None):
+        # Page by primary key, like a DynamoDB scan, so the sweep never holds the lock for long
+        page = self._query(
+            'SELECT connection_id, player_id, room, expires_at FROM connections WHERE connection_id > ? '
+            'ORDER BY connection_id LIMIT ?',
+            (start or '', limit)
+        )
+        expired = [dict(row) for row in page if row['expires_at'] is None or row['expires_at'] < now]
+        return expired, page[-1]['connection_id'] if len(page) == limit else None
+
+    def record_heartbeat(self, connection_id, now, expires_at, fresh_for):
+        with self.lock:
+            written = self.db.execute(
+                'UPDATE connections SET last_seen = ?, expires_at = ? '
+                'WHERE connection_id = ? AND (last_seen IS NULL OR last_seen <= ?)',
+                (int(now), expires_at, connection_id, int(now - fresh_for))
+            ).rowcount
+            if written:
+                return int(now)
+            row = self.db.execute('SELECT last_seen FROM connections WHERE connection_id = ?', (connection_id,)).fetchone()
+            return row['last_seen'] if row else None
+
+    def get_presence(self, connection_ids, consistent=False):
+        connection_ids = list(dict.fromkeys(connection_ids))
+        presence = {}
+        for start in range(0, len(connection_ids), 500):
+            chunk = connection_ids[start:start + 500]
+            rows = self._query(
+                f'SELECT connection_id, last_seen FROM connections WHERE connection_id IN ({",".join("?" * len(chunk))})',
+                chunk
+            )
+            presence.update((row['connection_id'], row['last_seen']) for row in rows)
+        return presence
+
+    def put_player(self, player_id, connection_id, room):
+        self._transaction([(
+            'INSERT OR REPLACE INTO players (player_id, connection_id, room) VALUES (?, ?, ?)',
+            (player_id, connection_id, room)
+        )])
+
+    def get_player_connection(self, player_id):
+        rows = self._query('SELECT connection_id FROM players WHERE player_id = ?', (player_id,))
+        return rows[0]['connection_id'] if rows else None
+
+    def get_player_connections(self, player_ids, consistent=False):
+        player_ids = list(dict.fromkeys(player_ids))
+        player_connections = {}
+        # Stay under SQLite's bound-parameter limit
+        for start in range(0, len(player_ids), 500):
+            chunk = player_ids[start:start + 500]
+            rows = self._query(
+                f'SELECT player_id, connection_id FROM players WHERE player_id IN ({",".join("?" * len(chunk))})',
+                chunk
+            )
+            player_connections.update((row['player_id'], row['connection_id']) for row in rows)
+        return player_connections
+
+    def release_player(self, player_id, connection_id):
+        with self.lock:
+            return self.db.execute('DELETE FROM players WHERE player_id = ? AND connection_id = ?',
+                                   (player_id, connection_id)).rowcount > 0
+
+    def add_to_roster(self, room_name, player_id, connection_id, capacity=None):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                roster = self._roster(room_name)
+                added = capacity is None or player_id in roster or len(roster) < capacity
+                if added:
+                    version = self._bump_version(room_name)
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO roster (room_name, player_id, connection_id, joined_version) '
+                        'VALUES (?, ?, ?, ?)',
+                        (room_name, player_id, connection_id, version)
+                    )
+                    self.db.execute('DELETE FROM roster_departed WHERE room_name = ? AND player_id = ?',
+                                    (room_name, player_id))
+                    roster[player_id] = connection_id
+                    roster.version = version
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            return added, roster
+
+    def get_roster(self, room_name):
+        with self.lock:
+            return self._roster(room_name)
+
+    def get_roster_history(self, room_name):
+        with self.lock:
+            return self._roster(room_name, history=True)
+
+    def _delete_roster_entries(self, room_name, entries):
+        """Inside a transaction: delete the entries and record them as departed at the next version;
+        returns False if any had moved (the caller rolls back)"""
+        removed = sum(self.db.execute(
+            'DELETE FROM roster WHERE room_name = ? AND player_id = ? AND connection_id = ?',
+            (room_name, pid, conn_id)
+        ).rowcount for pid, conn_id in entries.items())
+        if removed != len(entries):
+            return False
+        version = self._bump_version(room_name)
+        self.db.executemany(
+            'INSERT OR REPLACE INTO roster_departed (room_name, player_id, version) VALUES (?, ?, ?)',
+            [(room_name, pid, version) for pid in entries]
+        )
+        self._trim_departed(room_name)
+        return True
+
+    def _remove_roster_entries(self, room_name, entries):
+        """Remove the entries and record them as departed in one transaction; returns the Roster
+        afterwards, or None (having changed nothing) if any entry moved"""
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if not self._delete_roster_entries(room_name, entries):
+                    self.db.execute('ROLLBACK')
+                    return None
+                roster = self._roster(room_name)
+                self.db.execute('COMMIT')
+                return roster
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+
+    def remove_from_roster(self, room_name, player_id, connection_id):
+        return self._remove_roster_entries(room_name, {player_id: connection_id})
+
+    def remove_stale_roster_entries(self, room_name, stale):
+        return self._remove_roster_entries(room_name, stale)
+
+    def queue_departure(self, room_name, player_id, connection_id, lease, now, stale_after):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO departures (room_name, player_id, connection_id) VALUES (?, ?, ?)',
+                    (room_name, player_id, connection_id)
+                )
+                self.db.execute(
+                    'INSERT INTO departure_leases (room_name, lease, lease_at) VALUES (?, ?, ?) '
+                    'ON CONFLICT (room_name) DO UPDATE SET lease = excluded.lease, lease_at = excluded.lease_at '
+                    'WHERE lease_at < ?',
+                    (room_name, lease, now, now - stale_after)
+                )
+                held = self.db.execute(
+                    'SELECT lease FROM departure_leases WHERE room_name = ?', (room_name,)
+                ).fetchone()[0]
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            return held == lease
+
+    def take_departures(self, room_name, lease, limit):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                held = self.db.execute(
+                    'SELECT lease FROM departure_leases WHERE room_name = ?', (room_name,)
+                ).fetchone()
+                if held is None or held[0] != lease:
+                    self.db.execute('ROLLBACK')
+                    return None
+                batch = {row['player_id']: row['connection_id'] for row in self.db.execute(
+                    'SELECT player_id, connection_id FROM departures WHERE room_name = ? LIMIT ?', (room_name, limit)
+                )}
+                roster = self._roster(room_name)
+                departed = {pid: conn_id for pid, conn_id in batch.items() if roster.get(pid) == conn_id}
+                self.db.executemany('DELETE FROM departures WHERE room_name = ? AND player_id = ?',
+                                    [(room_name, pid) for pid in batch])
+                if departed:
+                    self._delete_roster_entries(room_name, departed)
+                released = self.db.execute(
+                    'SELECT 1 FROM departures WHERE room_name = ? LIMIT 1', (room_name,)
+                ).fetchone() is None
+                if released:
+                    self.db.execute('DELETE FROM departure_leases WHERE room_name = ?', (room_name,))
+                roster = self._roster(room_name)
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            return departed, roster, released
+
+    def set_position(self, room_name, player_id, connection_id, position):
+        with self.lock:
+            return self.db.execute(
+                'INSERT OR REPLACE INTO positions (room_name, player_id, x, y) '
+                'SELECT room_name, player_id, ?, ? FROM roster '
+                'WHERE room_name = ? AND player_id = ? AND connection_id = ?',
+                (position[0], position[1], room_name, player_id, connection_id)
+            ).rowcount > 0
+
+    def get_positions(self, room_name):
+        rows = self._query('SELECT player_id, x, y FROM positions WHERE room_name = ?', (room_name,))
+        return {row['player_id']: (row['x'], row['y']) for row in rows}
+
+    def remove_positions(self, room_name, player_ids):
+        self._transaction([
+            ('DELETE FROM positions WHERE room_name = ? AND player_id = ?', (room_name, pid))
+            for pid in player_ids
+        ])
+
+    def get_room_directory(self, lobby, consistent=False):
+        with self.lock:
+            rows = self.db.execute('SELECT room_name FROM open_rooms WHERE lobby = ? ORDER BY room_name', (lobby,))
+            open_rooms = [row['room_name'] for row in rows]
+            row = self.db.execute('SELECT shard_count FROM room_shards WHERE lobby = ?', (lobby,)).fetchone()
+            return open_rooms, row['shard_count'] if row else 0
+
+    def set_room_open(self, lobby, room_name, is_open):
+        if is_open:
+            sql = 'INSERT OR IGNORE INTO open_rooms (lobby, room_name) VALUES (?, ?)'
+        else:
+            sql = 'DELETE FROM open_rooms WHERE lobby = ? AND room_name = ?'
+        self._transaction([(sql, (lobby, room_name))])
+
+    def claim_room_shard(self, lobby, shard_count):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('INSERT OR IGNORE INTO room_shards (lobby, shard_count) VALUES (?, 0)', (lobby,))
+                claimed = self.db.execute(
+                    'UPDATE room_shards SET shard_count = ? WHERE lobby = ? AND shard_count = ?',
+                    (shard_count + 1, lobby, shard_count)
+                ).rowcount > 0
+                self.db.execute('COMMIT')
+            except Exception:
+                self.db.execute('ROLLBACK')
+                raise
+            return claimed
+
+
+def create_store(backend=None):
+    """Build the backend named by SIGNALING_STORE (dynamodb, memory or sqlite)"""
+    backend = backend or os.environ.get('SIGNALING_STORE', 'dynamodb')
+    if backend == 'memory':
+        return MemoryStore()
+    if backend == 'sqlite':
+        return SQLiteStore(os.environ.get('SIGNALING_SQLITE_PATH', 'signaling.db'))
+    if backend == 'dynamodb':
+        return DynamoDBStore(
+            None,
+            os.environ.get('CONNECTIONS_TABLE', 'tank-simulator-signaling-connections-prod'),
+            os.environ.get('ROOMS_TABLE', 'tank-simulator-signaling-rooms-prod'),
+            os.environ.get('PLAYERS_TABLE', 'tank-simulator-signaling-players-prod')
+        )
+    raise ValueError(f"Unknown SIGNALING_STORE backend: {backend}")
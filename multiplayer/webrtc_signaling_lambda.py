@@ -1,21 +1,383 @@
 import json
+import math
 import os
-import boto3
 import logging
-import traceback
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import signaling_log
+import signaling_metrics
+from signaling_log import LazyJson
+from signaling_storage import Roster, create_store
+from mesh_planner import plan_mesh
+from game_relay import RELAYED_TYPES, RelayHub
+from routing_token import RoutingTokens
+from send_queue import SendScheduler
+from event_capture import EventRecorder
 
-# Set up enhanced logging
-logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)  # Set to DEBUG for more detailed logging
+# Level, per-handler sampling and output format come from LOG_LEVEL / LOG_SAMPLE_RATES / LOG_FORMAT;
+# DEBUG and INFO lines cost nothing unless they are enabled and the invocation was sampled
+logger = signaling_log.configure()
 
-# Initialize DynamoDB client
-dynamodb = boto3.resource('dynamodb')
-connections_table = dynamodb.Table(os.environ.get('CONNECTIONS_TABLE', 'tank-simulator-signaling-connections-prod'))
-rooms_table = dynamodb.Table(os.environ.get('ROOMS_TABLE', 'tank-simulator-signaling-rooms-prod'))
+# Timing spans per message type and per DynamoDB / API Gateway call, written as EMF records
+# (METRICS_ENABLED, METRICS_NAMESPACE, METRICS_FLUSH_SECONDS; on by default in Lambda)
+metrics = signaling_metrics.configure()
 
-# Initialize API Gateway Management API client
+# Handler each WebSocket event type (and each message type) is logged and sampled under
+EVENT_HANDLERS = {'CONNECT': 'handle_connect', 'DISCONNECT': 'handle_disconnect', 'MESSAGE': 'handle_message'}
+MESSAGE_HANDLERS = {
+    'join': 'handle_join',
+    'leave': 'handle_leave',
+    'offer': 'handle_signaling_message',
+    'answer': 'handle_signaling_message',
+    'ice_candidate': 'handle_signaling_message',
+    'batch': 'handle_batch',
+    'position': 'handle_position',
+    'relay': 'handle_relay',
+    'presence': 'handle_presence',
+    'roster_sync': 'handle_roster_sync',
+    'ping': 'handle_ping'
+}
+
+# CAPTURE_PATH records every event (a file, or '-' for stdout / CloudWatch Logs) with IDs anonymized,
+# for replay_events.py; CAPTURE_SAMPLE_RATE keeps that share of connections, and containers sharing
+# CAPTURE_SECRET give an ID the same pseudonym so their captures merge
+event_recorder = EventRecorder(
+    os.environ['CAPTURE_PATH'],
+    secret=os.environ.get('CAPTURE_SECRET'),
+    sample_rate=float(os.environ.get('CAPTURE_SAMPLE_RATE', '1'))
+) if os.environ.get('CAPTURE_PATH') else None
+
+# Connections, player index and room rosters (DynamoDB unless SIGNALING_STORE says otherwise);
+# building the store creates no AWS clients, see warm_clients at the bottom of the module
+store = create_store()
+store.instrument(metrics.wrap_client)
+
+# API Gateway Management API client, built on first use from WEBSOCKET_API_ENDPOINT
+# (https://{api-id}.execute-api.{region}.amazonaws.com/{stage}) or the first event's request context
 api_client = None
+WEBSOCKET_API_ENDPOINT = os.environ.get('WEBSOCKET_API_ENDPOINT')
+
+# Broadcasts fan out over a thread pool; the API client's connection pool is sized to match
+# so concurrent post_to_connection calls don't queue on botocore's default of 10 connections
+BROADCAST_CONCURRENCY = int(os.environ.get('BROADCAST_CONCURRENCY', '16'))
+broadcast_executor = None
+
+class RoutingCache:
+    """In-process LRU cache of player_id -> connection_id with a TTL, kept across warm invocations"""
+    
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # player_id -> (connection_id, expires_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidations = 0
+    
+    def get(self, player_id):
+        with self.lock:
+            entry = self.entries.get(player_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[1] < time.monotonic():
+                del self.entries[player_id]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(player_id)
+            self.hits += 1
+            return entry[0]
+    
+    def put(self, player_id, connection_id):
+        with self.lock:
+            self.entries[player_id] = (connection_id, time.monotonic() + self.ttl_seconds)
+            self.entries.move_to_end(player_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def observe(self, player_id, connection_id):
+        """Correct an entry when a message proves the player is on a different connection"""
+        with self.lock:
+            entry = self.entries.get(player_id)
+            if entry is not None and entry[0] != connection_id:
+                del self.entries[player_id]
+                self.invalidations += 1
+    
+    def invalidate(self, player_id):
+        with self.lock:
+            if self.entries.pop(player_id, None) is not None:
+                self.invalidations += 1
+    
+    def invalidate_connection(self, connection_id):
+        """Drop every player routed to a connection (used when only the connection ID is known)"""
+        with self.lock:
+            stale = [pid for pid, entry in self.entries.items() if entry[0] == connection_id]
+            for pid in stale:
+                del self.entries[pid]
+            self.invalidations += len(stale)
+    
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'invalidations': self.invalidations,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+# Warm containers forward bursts of ICE candidates between the same peers, so recipient lookups are
+# cached here; a stale entry is caught by the GoneException / retry path in handle_signaling_message
+routing_cache = RoutingCache(
+    max_entries=int(os.environ.get('ROUTING_CACHE_SIZE', '2048')),
+    ttl_seconds=float(os.environ.get('ROUTING_CACHE_TTL_SECONDS', '60'))
+)
+
+# room_info / new_player carry a signed route per player, so signaling messages that send it back
+# are forwarded without a player index read. Every container must share ROUTING_TOKEN_SECRET for
+# tokens issued by one to verify in another; tokens expire with API Gateway's 2 hour connection limit
+routing_tokens = RoutingTokens(
+    secret=os.environ.get('ROUTING_TOKEN_SECRET'),
+    ttl_seconds=float(os.environ.get('ROUTING_TOKEN_TTL_SECONDS', '7200'))
+)
+
+def create_api_client(endpoint_url):
+    """Build the API Gateway Management API client (boto3 is only imported once a client is needed)"""
+    import boto3
+    from botocore.config import Config
+    logger.debug("Initializing API client with endpoint: %s", endpoint_url)
+    return metrics.wrap_client(boto3.client(
+        'apigatewaymanagementapi',
+        endpoint_url=endpoint_url,
+        # send_scheduler does the retrying, with jitter and the invocation's deadline in mind
+        config=Config(max_pool_connections=BROADCAST_CONCURRENCY, retries={'total_max_attempts': 1})
+    ), 'apigateway')
+
+def post_to_api(connection_id, payload):
+    api_client.post_to_connection(ConnectionId=connection_id, Data=payload)
+
+# post_to_connection is rate limited per account and region, so each container paces its sends with
+# a token bucket at its share of the limit (SEND_RATE_PER_SECOND, SEND_BURST) and retries throttled
+# ones with jittered backoff instead of dropping them; 0 turns the pacing off
+send_scheduler = SendScheduler(
+    post_to_api,
+    rate=float(os.environ.get('SEND_RATE_PER_SECOND', '10000')),
+    burst=int(os.environ.get('SEND_BURST', '5000')),
+    max_attempts=int(os.environ.get('SEND_MAX_ATTEMPTS', '5')),
+    logger=logger
+)
+
+class RoomDirectory:
+    """Names a lobby's room shards and caches which of them have space, kept across warm invocations"""
+    
+    def __init__(self, lobby, ttl_seconds):
+        self.lobby = lobby
+        self.ttl_seconds = ttl_seconds
+        self.rooms = None
+        self.shard_count = 0
+        self.expires_at = 0.0
+        self.lock = threading.Lock()
+    
+    def room_name(self, shard):
+        # Shard 0 keeps the lobby's own name so the room from before sharding stays in use
+        return self.lobby if shard == 0 else f'{self.lobby}-{shard}'
+    
+    def shard_of(self, room_name):
+        suffix = room_name[len(self.lobby) + 1:]
+        return int(suffix) if suffix.isdigit() else 0
+    
+    def candidates(self, refresh=False):
+        """Rooms to try, lowest shard first: those marked as having space, then the newest shard"""
+        with self.lock:
+            if refresh or self.rooms is None or self.expires_at < time.monotonic():
+                rooms, self.shard_count = store.get_room_directory(self.lobby, consistent=refresh)
+                self.rooms = sorted(rooms, key=self.shard_of)
+                self.expires_at = time.monotonic() + self.ttl_seconds
+            rooms = list(self.rooms)
+            newest = self.room_name(self.shard_count - 1) if self.shard_count else None
+            return rooms + [newest] if newest and newest not in rooms else rooms
+    
+    def mark(self, room_name, is_open):
+        store.set_room_open(self.lobby, room_name, is_open)
+        with self.lock:
+            if self.rooms is not None:
+                if is_open and room_name not in self.rooms:
+                    self.rooms = sorted(self.rooms + [room_name], key=self.shard_of)
+                elif not is_open and room_name in self.rooms:
+                    self.rooms.remove(room_name)
+    
+    def claim_next(self):
+        """Open the next shard unless a concurrent join already has; returns its name, or None if we lost"""
+        with self.lock:
+            shard = self.shard_count
+        if store.claim_room_shard(self.lobby, shard):
+            with self.lock:
+                self.shard_count = max(self.shard_count, shard + 1)
+            return self.room_name(shard)
+        return None
+
+# Players are spread over rooms of at most ROOM_CAPACITY, so the room item, broadcast fan-out and
+# each client's WebRTC mesh stay the same size however many people are online. The default matches
+# multiplayer.js, which has colours and AI fill for 5 players (maxPlayers); raise both together
+LOBBY_NAME = os.environ.get('LOBBY_NAME', 'tank-simulator-main-room')
+ROOM_CAPACITY = int(os.environ.get('ROOM_CAPACITY', '5'))
+room_directory = RoomDirectory(LOBBY_NAME, ttl_seconds=float(os.environ.get('ROOM_DIRECTORY_TTL_SECONDS', '5')))
+
+# Within a room each player connects to at most MESH_DEGREE peers, nearest first by the positions
+# clients report every POSITION_REPORT_SECONDS, instead of to everyone; rooms that can't outgrow
+# MESH_DEGREE + 1 players are a full mesh and clients aren't asked to report positions at all.
+# Clients only exchange game state with their peers, so players who aren't linked don't see each
+# other: the default is a full mesh, and a partial one only when MESH_DEGREE is set below
+# ROOM_CAPACITY - 1
+MESH_DEGREE = int(os.environ.get('MESH_DEGREE', str(ROOM_CAPACITY - 1)))
+MESH_PARTIAL = ROOM_CAPACITY > MESH_DEGREE + 1
+POSITION_REPORT_SECONDS = float(os.environ.get('POSITION_REPORT_SECONDS', '10')) if MESH_PARTIAL else 0
+
+# Roster messages carry the room's version so clients apply each change once and in order; a
+# client that finds a gap asks for roster_sync and gets the changes since the version it knows,
+# or the whole roster when more than ROSTER_DELTA_MAX players came or went in between
+ROSTER_DELTA_MAX = int(os.environ.get('ROSTER_DELTA_MAX', '32'))
+
+# Leaves caused by disconnects are coalesced per room over LEAVE_WINDOW_MS, so a mass disconnect costs
+# each room one roster write and each remaining player one players_left message per window, not one
+# of each per leaver. The first disconnect to queue a leave takes the room's flush lease and waits out
+# the window before flushing; a host that calls flush_departures on a timer instead (the local server
+# does) sets DEPARTURES_TICKED so no handler waits. 0 takes each player out straight away
+LEAVE_WINDOW_MS = float(os.environ.get('LEAVE_WINDOW_MS', '500'))
+LEAVE_LEASE_SECONDS = 30  # a lease held longer than this belongs to a flusher that died
+DEPARTURE_BATCH = 40      # leaves taken per roster write (keeps the expression inside DynamoDB's limits)
+DEPARTURES_TICKED = False
+departure_leases = {}     # room_name -> (lease, monotonic time due) for flush_departures
+departure_lock = threading.Lock()
+
+# Game data between players whose DataChannel couldn't connect is relayed through here, batched
+# into one frame per recipient per tick. Something has to call flush_relay every RELAY_TICK_MS
+# (the local server does); the default of 0 flushes after every relay message, since a Lambda
+# container is frozen between invocations and can't hold messages for a later tick
+RELAY_TICK_MS = float(os.environ.get('RELAY_TICK_MS', '0'))
+relay_hub = RelayHub()
+
+class RelayScopes:
+    """In-process cache of connection_id -> (player_id, room roster) for relaying connections, with a TTL
+    
+    Relays come many times a second per player, so the sender's connection row and room roster are
+    read once per RELAY_SCOPE_TTL_SECONDS rather than per message. A relay naming someone the cached
+    roster doesn't hold re-reads it, at most once per refresh_seconds per connection.
+    """
+    
+    def __init__(self, ttl_seconds, max_entries, refresh_seconds=1.0):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.refresh_seconds = refresh_seconds
+        self.entries = OrderedDict()  # connection_id -> (player_id, {player_id: connection_id}, loaded_at)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+    
+    def get(self, connection_id):
+        with self.lock:
+            entry = self.entries.get(connection_id)
+            if entry is None or time.monotonic() - entry[2] > self.ttl_seconds:
+                return None
+            self.entries.move_to_end(connection_id)
+            self.hits += 1
+            return entry
+    
+    def put(self, connection_id, player_id, members):
+        entry = (player_id, members, time.monotonic())
+        with self.lock:
+            self.loads += 1
+            self.entries[connection_id] = entry
+            self.entries.move_to_end(connection_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+    
+    def may_refresh(self, entry):
+        return entry is None or time.monotonic() - entry[2] >= self.refresh_seconds
+    
+    def invalidate(self, connection_id):
+        with self.lock:
+            self.entries.pop(connection_id, None)
+    
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits, 'loads': self.loads}
+
+# A relay is only accepted from the connection the sender's room roster maps them to, and only
+# delivered to players in that roster
+relay_scopes = RelayScopes(
+    ttl_seconds=float(os.environ.get('RELAY_SCOPE_TTL_SECONDS', '5')),
+    max_entries=int(os.environ.get('RELAY_SCOPE_CACHE_SIZE', '2048'))
+)
+
+# Connection rows expire CONNECTION_TTL_SECONDS after the last heartbeat (clients ping every
+# HEARTBEAT_SECONDS). reap_handler, run on a schedule, sweeps expired rows REAPER_PAGE_SIZE at a
+# time; the connections table's TTL on expires_at only backs it up, since TTL deletes can lag by
+# days and don't touch rosters or the player index
+HEARTBEAT_SECONDS = float(os.environ.get('HEARTBEAT_SECONDS', '30'))
+CONNECTION_TTL_SECONDS = float(os.environ.get('CONNECTION_TTL_SECONDS', '180'))
+REAPER_PAGE_SIZE = int(os.environ.get('REAPER_PAGE_SIZE', '100'))
+
+# A heartbeat records last_seen at most once per PRESENCE_WRITE_SECONDS per connection; a player
+# is present while last_seen is within PRESENCE_TIMEOUT_SECONDS (two missed heartbeats past a write)
+PRESENCE_WRITE_SECONDS = float(os.environ.get('PRESENCE_WRITE_SECONDS', '60'))
+PRESENCE_TIMEOUT_SECONDS = float(os.environ.get(
+    'PRESENCE_TIMEOUT_SECONDS', str(PRESENCE_WRITE_SECONDS + 2 * HEARTBEAT_SECONDS)
+))
+
+class HeartbeatCoalescer:
+    """When each connection's heartbeat was last recorded, kept across warm invocations
+    
+    Heartbeats inside the write window are dropped here without a call at all: the conditional write
+    behind it would skip them too, but DynamoDB still bills a failed condition as a write. Pings reach
+    whichever container is free, so besides the writes this container has seen, clients echo the
+    lastSeen from their last pong (a client that lies only makes itself look absent).
+    """
+    
+    def __init__(self, window_seconds, max_entries):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # connection_id -> time of the last write this container knows of
+        self.lock = threading.Lock()
+        self.skipped = 0
+        self.attempted = 0
+    
+    def check(self, connection_id, now, reported=None):
+        """Return (whether a heartbeat at `now` needs writing, latest last_seen known or None)"""
+        with self.lock:
+            last = self.entries.get(connection_id)
+            if isinstance(reported, (int, float)) and not isinstance(reported, bool) and reported <= now:
+                last = reported if last is None else max(last, reported)
+            if last is not None and now - last < self.window_seconds:
+                self.skipped += 1
+                return False, last
+            self.attempted += 1
+            return True, last
+    
+    def record(self, connection_id, now):
+        with self.lock:
+            self.entries[connection_id] = now
+            self.entries.move_to_end(connection_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+    
+    def forget(self, connection_id):
+        with self.lock:
+            self.entries.pop(connection_id, None)
+    
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'skipped': self.skipped, 'attempted': self.attempted}
+
+heartbeat_coalescer = HeartbeatCoalescer(PRESENCE_WRITE_SECONDS, max_entries=int(os.environ.get('HEARTBEAT_CACHE_SIZE', '8192')))
 
 def init_api_client(event):
     """Initialize the API Gateway Management API client with the correct endpoint"""
@@ -24,27 +386,32 @@ def init_api_client(event):
         try:
             domain = event['requestContext']['domainName']
             stage = event['requestContext']['stage']
-            endpoint_url = f'https://{domain}/{stage}'
-            logger.debug(f"Initializing API client with endpoint: {endpoint_url}")
-            api_client = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
+            api_client = create_api_client(f'https://{domain}/{stage}')
         except Exception as e:
-            logger.error(f"Error initializing API client: {str(e)}")
-            logger.error(f"Event structure: {json.dumps(event)}")
+            logger.error("Error initializing API client: %s", e)
+            logger.error("Event structure: %s", LazyJson(event))
             raise
 
 def lambda_handler(event, context):
     """Main Lambda handler function"""
     try:
-        logger.debug(f"Received event: {json.dumps(event)}")
-        
-        # Initialize API client
-        init_api_client(event)
-        
         request_context = event.get('requestContext', {})
         event_type = request_context.get('eventType')
         connection_id = request_context.get('connectionId')
+        logger.begin(EVENT_HANDLERS.get(event_type, 'lambda_handler'), connection_id=connection_id)
+        metrics.begin(f'${event_type.lower()}' if event_type in ('CONNECT', 'DISCONNECT') else None)
+        send_scheduler.begin(invocation_deadline(context))
         
-        logger.info(f"Processing {event_type} event for connection {connection_id}")
+        logger.debug("Received event: %s", LazyJson(event))
+        if event_recorder:
+            capture_event(event)
+        
+        # Initialize API client
+        init_api_client(event)
+        
+        if event_type != 'MESSAGE':
+            # Messages log (and are sampled) under their own handler once the body is parsed
+            logger.info("Processing %s event for connection %s", event_type, connection_id)
         
         # Handle WebSocket events
         if event_type == 'CONNECT':
@@ -54,45 +421,60 @@ def lambda_handler(event, context):
         elif event_type == 'MESSAGE':
             return handle_message(event)
         else:
-            logger.warning(f"Unhandled event type: {event_type}")
+            logger.warning("Unhandled event type: %s", event_type)
             return {'statusCode': 200, 'body': 'Unhandled event type'}
     
     except Exception as e:
         # Log the full exception traceback for debugging
-        logger.error(f"Unhandled exception in lambda_handler: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Unhandled exception in lambda_handler: %s", e)
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)})
         }
+    finally:
+        log_send_stats()
+        metrics.end()
+
+def capture_event(event):
+    """Record the event for replay; a capture that fails never fails the invocation"""
+    try:
+        event_recorder.record(event)
+    except Exception as e:
+        logger.warning("Event capture failed: %s", e)
+
+def invocation_deadline(context):
+    """Monotonic time by which send retries give up, leaving a margin before Lambda's timeout"""
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return time.monotonic() + max(context.get_remaining_time_in_millis() - 500, 0) / 1000
+
+def log_send_stats():
+    """Report the invocation's sends when any of them had to wait, retry or be dropped"""
+    stats = send_scheduler.stats()
+    if stats['dropped']:
+        logger.warning("Send queue dropped %s messages: %s", stats['dropped'], LazyJson(stats))
+    elif stats['queued'] or stats['retried'] or stats['split']:
+        logger.info("Send queue: %s", LazyJson(stats))
 
 def handle_connect(event):
     """Handle new WebSocket connection"""
     connection_id = event['requestContext']['connectionId']
     timestamp = datetime.now().isoformat()
     
-    logger.info(f"New connection request: {connection_id}")
-    logger.debug(f"Connect event details: {json.dumps(event)}")
+    logger.info("New connection request: %s", connection_id)
+    logger.debug("Connect event details: %s", LazyJson(event))
     
     # Check for origin if needed for CORS
     headers = event.get('headers', {})
     origin = headers.get('Origin') or headers.get('origin')
     if origin:
-        logger.info(f"Connection from origin: {origin}")
+        logger.info("Connection from origin: %s", origin)
     
     try:
         # Store connection information - using connection_id as the primary key
-        connections_table.put_item(
-            Item={
-                'connection_id': connection_id,
-                'timestamp': timestamp,
-                'player_id': None,  # Will be set when they join a room
-                'room': None,       # Will be set when they join a room
-                'origin': origin
-            }
-        )
+        store.put_connection(connection_id, timestamp, origin, expires_at=connection_expiry())
         
-        logger.info(f"Connection established and stored: {connection_id}")
+        logger.info("Connection established and stored: %s", connection_id)
         return {
             'statusCode': 200, 
             'body': 'Connected',
@@ -104,42 +486,54 @@ def handle_connect(event):
         }
     
     except Exception as e:
-        logger.error(f"Error storing connection {connection_id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error storing connection %s: %s", connection_id, e)
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
 def handle_disconnect(event):
     """Handle WebSocket disconnection"""
     connection_id = event['requestContext']['connectionId']
     
-    logger.info(f"Handling disconnect for connection: {connection_id}")
+    logger.info("Handling disconnect for connection: %s", connection_id)
     
+    flush_room = None
     try:
         # Get player info before deleting
-        response = connections_table.get_item(Key={'connection_id': connection_id})
+        player_data = store.get_connection(connection_id)
         
-        if 'Item' in response:
-            player_data = response['Item']
+        if player_data:
             room_name = player_data.get('room')
             player_id = player_data.get('player_id')
             
-            logger.debug(f"Found player data for disconnection: {json.dumps(player_data)}")
+            logger.debug("Found player data for disconnection: %s", LazyJson(player_data))
             
-            # If player was in a room, handle their departure
+            # If player was in a room, handle their departure (with any others leaving around now)
             if room_name and player_id:
-                handle_player_leave(room_name, player_id, connection_id)
+                if LEAVE_WINDOW_MS <= 0:
+                    handle_player_leave(room_name, player_id, connection_id)
+                elif queue_departure(room_name, player_id, connection_id, connection_id):
+                    flush_room = room_name
+            
+            if player_id:
+                release_player_index(player_id, connection_id)
+                routing_cache.invalidate(player_id)
         else:
-            logger.warning(f"No player data found for disconnecting connection: {connection_id}")
+            logger.warning("No player data found for disconnecting connection: %s", connection_id)
+        
+        routing_cache.invalidate_connection(connection_id)
+        heartbeat_coalescer.forget(connection_id)
+        relay_scopes.invalidate(connection_id)
         
         # Delete connection record
-        connections_table.delete_item(Key={'connection_id': connection_id})
+        store.delete_connection(connection_id)
         
-        logger.info(f"Disconnected and removed connection: {connection_id}")
+        if flush_room:
+            schedule_departures(flush_room, connection_id)
+        
+        logger.info("Disconnected and removed connection: %s", connection_id)
         return {'statusCode': 200, 'body': 'Disconnected'}
     
     except Exception as e:
-        logger.error(f"Error handling disconnect for {connection_id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error handling disconnect for %s: %s", connection_id, e)
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
 def handle_message(event):
@@ -147,12 +541,16 @@ def handle_message(event):
     connection_id = event['requestContext']['connectionId']
     
     try:
-        logger.debug(f"Received message from {connection_id}: {event.get('body')}")
+        logger.debug("Received message from %s: %s", connection_id, event.get('body'))
         
         message_body = json.loads(event['body'])
         message_type = message_body.get('type')
+        logger.begin(MESSAGE_HANDLERS.get(message_type, 'handle_message'),
+                     connection_id=connection_id, message_type=message_type)
+        # Only known types become a metric dimension: clients choose what they send
+        metrics.name(message_type if message_type in MESSAGE_HANDLERS else 'unknown')
         
-        logger.info(f"Processing message type: {message_type} from connection: {connection_id}")
+        logger.info("Processing message type: %s from connection: %s", message_type, connection_id)
         
         if message_type == 'join':
             return handle_join(connection_id, message_body)
@@ -160,32 +558,138 @@ def handle_message(event):
             return handle_leave(connection_id, message_body)
         elif message_type in ['offer', 'answer', 'ice_candidate']:
             return handle_signaling_message(connection_id, message_body)
+        elif message_type == 'batch':
+            return handle_batch(connection_id, message_body)
+        elif message_type == 'position':
+            return handle_position(connection_id, message_body)
+        elif message_type == 'relay':
+            return handle_relay(connection_id, message_body)
+        elif message_type == 'presence':
+            return handle_presence(connection_id, message_body)
+        elif message_type == 'roster_sync':
+            return handle_roster_sync(connection_id, message_body)
         elif message_type == 'ping':
-            # Handle simple ping messages for debugging
-            # Send pong response back to the client
-            send_to_connection(connection_id, {"type": "pong", "timestamp": datetime.now().isoformat()})
-            return {'statusCode': 200, 'body': 'pong'}
+            return handle_ping(connection_id, message_body)
         else:
-            logger.warning(f"Unknown message type: {message_type} from {connection_id}")
+            logger.warning("Unknown message type: %s from %s", message_type, connection_id)
             return {'statusCode': 400, 'body': 'Unknown message type'}
     
     except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON message from {connection_id}: {event.get('body')}")
+        logger.error("Invalid JSON message from %s: %s", connection_id, event.get('body'))
         return {'statusCode': 400, 'body': 'Invalid JSON message'}
     
     except Exception as e:
-        logger.error(f"Error handling message from {connection_id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error handling message from %s: %s", connection_id, e)
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
+def handle_ping(connection_id, message):
+    """Heartbeat: record last_seen (at most once per write window), push the connection's expiry out,
+    and answer with a pong saying how often to ping"""
+    now = time.time()
+    due, last_seen = heartbeat_coalescer.check(connection_id, now, message.get('lastSeen'))
+    if due:
+        # Another container may have written within the window; the condition skips the write then,
+        # and we learn when that was
+        last_seen = store.record_heartbeat(connection_id, now, connection_expiry(now), PRESENCE_WRITE_SECONDS)
+        if last_seen is None:
+            logger.warning("Heartbeat from %s, which has no connection record", connection_id)
+        else:
+            heartbeat_coalescer.record(connection_id, last_seen)
+    send_to_connection(connection_id, {
+        "type": "pong",
+        "timestamp": datetime.now().isoformat(),
+        "heartbeatInterval": HEARTBEAT_SECONDS,
+        "lastSeen": last_seen
+    })
+    return {'statusCode': 200, 'body': 'pong'}
+
+def connection_expiry(now=None):
+    """expires_at for a connection heard from at `now` (whole epoch seconds, as DynamoDB TTL expects)"""
+    return int((now or time.time()) + CONNECTION_TTL_SECONDS)
+
+def handle_presence(connection_id, message):
+    """Tell a player which of their room's players are online, from heartbeat data alone"""
+    player_id = message.get('playerId')
+    room_name = message.get('room')
+    
+    if not player_id or not room_name:
+        return {'statusCode': 400, 'body': 'playerId and room are required'}
+    
+    try:
+        roster = store.get_roster(room_name)
+        if roster.get(player_id) != connection_id:
+            logger.warning("Presence request from %s for room %s it isn't in", connection_id, room_name)
+            return {'statusCode': 403, 'body': 'Not in that room'}
+        
+        present = present_connections(roster.values())
+        send_to_connection(connection_id, {
+            'type': 'presence',
+            'room': room_name,
+            'players': {
+                pid: {'online': conn_id in present, 'lastSeen': present.get(conn_id)}
+                for pid, conn_id in roster.items() if pid != player_id
+            }
+        })
+        return {'statusCode': 200, 'body': 'presence sent'}
+    
+    except Exception as e:
+        logger.exception("Error handling presence for %s: %s", player_id, e)
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+def handle_roster_sync(connection_id, message):
+    """Bring a player's view of their room up to date: the players who joined and left since the
+    version they know, or the whole roster if that is too far behind"""
+    player_id = message.get('playerId')
+    room_name = message.get('room')
+    known = message.get('version')
+    
+    if not player_id or not room_name:
+        return {'statusCode': 400, 'body': 'playerId and room are required'}
+    
+    try:
+        roster = store.get_roster_history(room_name)
+        if roster.get(player_id) != connection_id:
+            logger.warning("Roster sync from %s for room %s it isn't in", connection_id, room_name)
+            return {'statusCode': 403, 'body': 'Not in that room'}
+        
+        changes = None
+        if isinstance(known, int) and not isinstance(known, bool):
+            changes = roster.changes_since(known)
+        if changes is not None and len(changes[0]) + len(changes[1]) <= ROSTER_DELTA_MAX:
+            joined = [pid for pid in changes[0] if pid != player_id]
+            reply = {'type': 'roster', 'room': room_name, 'since': known, 'version': roster.version,
+                     'joined': joined, 'left': changes[1]}
+        else:
+            joined = [pid for pid in roster if pid != player_id]
+            reply = {'type': 'roster', 'room': room_name, 'version': roster.version, 'players': joined}
+        reply['tokens'] = routing_tokens.issue_all({pid: roster[pid] for pid in joined})
+        logger.info("Roster sync for %s in %s: %s from version %s to %s", player_id, room_name,
+                    'delta' if 'since' in reply else 'snapshot', known, roster.version)
+        send_to_connection(connection_id, reply)
+        return {'statusCode': 200, 'body': 'roster sent'}
+    
+    except Exception as e:
+        logger.exception("Error handling roster sync for %s: %s", player_id, e)
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+def present_connections(connection_ids, consistent=False):
+    """{connection_id: last_seen} for connections that exist and have sent a heartbeat within
+    PRESENCE_TIMEOUT_SECONDS; last_seen is None for ones yet to send their first"""
+    cutoff = time.time() - PRESENCE_TIMEOUT_SECONDS
+    return {
+        conn_id: last_seen
+        for conn_id, last_seen in store.get_presence(list(connection_ids), consistent=consistent).items()
+        if last_seen is None or last_seen >= cutoff
+    }
+
 def handle_join(connection_id, message):
-    """Handle a player joining a game room - always use a single persistent room"""
+    """Handle a player joining a game room - placed in the lowest room shard of the lobby with space"""
     player_id = message.get('playerId')
     
-    logger.info(f"Player {player_id} requesting to join the main game room")
+    logger.info("Player %s requesting to join a room shard of lobby %s", player_id, LOBBY_NAME)
     
     if not player_id:
-        logger.warning(f"Join attempt without player ID from connection: {connection_id}")
+        logger.warning("Join attempt without player ID from connection: %s", connection_id)
         return {
             'statusCode': 400, 
             'body': 'Player ID is required',
@@ -197,115 +701,87 @@ def handle_join(connection_id, message):
         }
     
     try:
-        # Always use the same permanent room name
-        permanent_room_name = "tank-simulator-main-room"
-        
         # Add detailed logging for debugging
-        logger.debug(f"DEBUGGING: Player {player_id} with connection {connection_id} joining {permanent_room_name}")
+        logger.debug("DEBUGGING: Player %s with connection %s joining lobby %s", player_id, connection_id, LOBBY_NAME)
         
-        # Check if the permanent room exists, if not create it
-        response = rooms_table.get_item(Key={'room_name': permanent_room_name})
+        # Point the player index at this connection (a reconnect simply overwrites the old mapping);
+        # the room isn't known yet and is recorded on the connection below
+        store.put_player(player_id, connection_id, None)
+        logger.debug("DEBUGGING: Indexed player %s -> %s", player_id, connection_id)
+        routing_cache.put(player_id, connection_id)
         
-        if 'Item' not in response:
-            logger.info(f"Creating permanent room: {permanent_room_name}")
-            
-            rooms_table.put_item(
-                Item={
-                    'room_name': permanent_room_name,
-                    'players': [],
-                    'created_at': datetime.now().isoformat()
-                }
-            )
-            logger.debug(f"DEBUGGING: Created new permanent room {permanent_room_name}")
-        else:
-            logger.info(f"Using existing permanent room: {permanent_room_name}")
-            logger.debug(f"DEBUGGING: Room data: {json.dumps(response['Item'])}")
+        # Add this player to a room with space in one atomic write (the index entry must exist first, so
+        # that concurrent joins pruning the roster see this player as live)
+        room_name, roster = allocate_room(player_id, connection_id)
         
         # Update connection record with player info and room
-        connections_table.update_item(
-            Key={'connection_id': connection_id},
-            UpdateExpression='SET player_id = :pid, room = :room',
-            ExpressionAttributeValues={
-                ':pid': player_id,
-                ':room': permanent_room_name
-            }
-        )
-        logger.debug(f"DEBUGGING: Updated connection record for {connection_id} with player_id {player_id}")
-        
-        # Get the current player list for the room
-        response = rooms_table.get_item(Key={'room_name': permanent_room_name})
-        players = response['Item'].get('players', []) if 'Item' in response else []
-        logger.debug(f"DEBUGGING: Current player list in room: {players}")
-        
-        # Clean up the player list by checking which players are still connected
-        active_players = []
-        for pid in players:
-            conn_response = connections_table.scan(
-                FilterExpression='player_id = :pid',
-                ExpressionAttributeValues={':pid': pid}
-            )
-            if conn_response.get('Items'):
-                active_players.append(pid)
-                logger.debug(f"DEBUGGING: Player {pid} is still active")
-            else:
-                logger.debug(f"DEBUGGING: Player {pid} is no longer active, removing")
-        
-        # Update the room with only active players
-        if active_players != players:
-            logger.info(f"Cleaning up player list. Was: {players}, Now: {active_players}")
-            players = active_players
-            rooms_table.update_item(
-                Key={'room_name': permanent_room_name},
-                UpdateExpression='SET players = :players',
-                ExpressionAttributeValues={':players': players}
-            )
-            logger.debug(f"DEBUGGING: Updated room with cleaned player list: {active_players}")
-        
-        # Add the current player if not already in the list
-        if player_id not in players:
-            players.append(player_id)
-            rooms_table.update_item(
-                Key={'room_name': permanent_room_name},
-                UpdateExpression='SET players = :players',
-                ExpressionAttributeValues={':players': players}
-            )
-            logger.debug(f"DEBUGGING: Added player {player_id} to room, new list: {players}")
-        
-        # Send room info to the new player
+        store.set_connection_player(connection_id, player_id, room_name)
+        relay_scopes.invalidate(connection_id)
+        logger.debug("DEBUGGING: Updated connection record for %s with player_id %s in %s", connection_id, player_id, room_name)
+        
+        # Drop players who are no longer connected: one batched lookup, one conditional write
+        player_connections = prune_roster(room_name, roster)
+        if len(roster) >= ROOM_CAPACITY > len(player_connections):
+            room_directory.mark(room_name, True)
+        players = list(player_connections)
+        logger.debug("DEBUGGING: Current player list in room: %s", players)
+        
+        # Work out who connects to whom now, and who was connected to whom before this join
+        position = parse_position(message.get('position'))
+        if MESH_PARTIAL:
+            if position is not None:
+                store.set_position(room_name, player_id, connection_id, position)
+            stale = [pid for pid in roster if pid not in player_connections]
+            if stale:
+                store.remove_positions(room_name, stale)
         existing_players = [p for p in players if p != player_id]
+        mesh_before, mesh_after = plan_room_mesh(room_name, existing_players, players, {player_id: position})
+        
+        # Send room info to the new player: everyone in the room, the peers to open connections to,
+        # and a routing token for each player to send with signaling messages
         room_info_message = {
             'type': 'room_info',
-            'players': existing_players
+            'room': room_name,
+            'players': existing_players,
+            'peers': mesh_after.get(player_id, []),
+            'tokens': routing_tokens.issue_all({pid: player_connections[pid] for pid in existing_players}),
+            'version': player_connections.version,
+            'positionInterval': POSITION_REPORT_SECONDS
         }
-        logger.debug(f"DEBUGGING: Sending room_info to player {player_id}: {json.dumps(room_info_message)}")
+        logger.debug("DEBUGGING: Sending room_info to player %s: %s", player_id, LazyJson(room_info_message))
         send_result = send_to_connection(connection_id, room_info_message)
         
         if not send_result:
-            logger.error(f"DEBUGGING: Failed to send room_info to player {player_id}")
+            logger.error("DEBUGGING: Failed to send room_info to player %s", player_id)
             # Try to analyze why the send failed
             try:
                 api_client.get_connection(ConnectionId=connection_id)
-                logger.debug(f"DEBUGGING: Connection {connection_id} still exists according to API")
+                logger.debug("DEBUGGING: Connection %s still exists according to API", connection_id)
             except Exception as conn_error:
-                logger.error(f"DEBUGGING: Error checking connection: {str(conn_error)}")
+                logger.error("DEBUGGING: Error checking connection: %s", conn_error)
         
         # Notify other players about the new player
-        player_connections = get_player_connections(permanent_room_name)
-        logger.debug(f"DEBUGGING: Found {len(player_connections)} other connections to notify")
-        
-        for pid, conn_id in player_connections.items():
-            if pid != player_id:
-                new_player_message = {
-                    'type': 'new_player',
-                    'playerId': player_id
-                }
-                logger.debug(f"DEBUGGING: Notifying player {pid} about new player {player_id}")
-                send_result = send_to_connection(conn_id, new_player_message)
-                
-                if not send_result:
-                    logger.warning(f"DEBUGGING: Failed to notify player {pid} about new player {player_id}")
-        
-        logger.info(f"Player {player_id} successfully joined permanent room with {len(existing_players)} existing players")
+        logger.debug("DEBUGGING: Found %s other connections to notify", len(player_connections))
+        results = broadcast_to_players(
+            player_connections,
+            {'type': 'new_player', 'playerId': player_id, 'token': routing_tokens.issue(player_id, connection_id),
+             'version': roster.version},
+            exclude_player_id=player_id
+        )
+        for pid, status in results.items():
+            if status != 'sent':
+                logger.warning("DEBUGGING: Failed to notify player %s about new player %s (%s)", pid, player_id, status)
+        
+        # Pruning was a roster change of its own, one version after the join
+        pruned = [pid for pid in roster if pid not in player_connections]
+        if pruned and player_connections.version > roster.version:
+            broadcast_to_players(player_connections, {
+                'type': 'roster', 'room': room_name, 'since': player_connections.version - 1,
+                'version': player_connections.version, 'joined': [], 'left': pruned, 'tokens': {}
+            }, exclude_player_id=player_id)
+        send_mesh_updates(player_connections, mesh_before, mesh_after, joined=player_id)
+        
+        logger.info("Player %s successfully joined room %s with %s existing players", player_id, room_name, len(existing_players))
         return {
             'statusCode': 200, 
             'body': 'Joined room',
@@ -317,8 +793,7 @@ def handle_join(connection_id, message):
         }
     
     except Exception as e:
-        logger.error(f"Error handling join for player {player_id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error handling join for player %s: %s", player_id, e)
         return {
             'statusCode': 500,
             'body': json.dumps({'error': str(e)}),
@@ -333,214 +808,729 @@ def handle_leave(connection_id, message):
     """Handle a player leaving a game room"""
     player_id = message.get('playerId')
     
-    logger.info(f"Player {player_id} attempting to leave room")
+    logger.info("Player %s attempting to leave room", player_id)
     
     try:
         # Get player's current room
-        response = connections_table.get_item(Key={'connection_id': connection_id})
+        player_data = store.get_connection(connection_id)
         
-        if 'Item' not in response:
-            logger.warning(f"Connection not found for player {player_id}")
+        if not player_data:
+            logger.warning("Connection not found for player %s", player_id)
             return {'statusCode': 404, 'body': 'Connection not found'}
         
-        player_data = response['Item']
         room_name = player_data.get('room')
         
         if not room_name:
-            logger.warning(f"Player {player_id} not in a room")
+            logger.warning("Player %s not in a room", player_id)
             return {'statusCode': 400, 'body': 'Player not in a room'}
         
-        logger.debug(f"Found player {player_id} in room {room_name}")
+        logger.debug("Found player %s in room %s", player_id, room_name)
         
         # Handle player leaving
         handle_player_leave(room_name, player_id, connection_id)
         
         # Update connection record to remove room
-        connections_table.update_item(
-            Key={'connection_id': connection_id},
-            UpdateExpression='SET room = :room',
-            ExpressionAttributeValues={':room': None}
-        )
+        store.set_connection_room(connection_id, None)
+        relay_scopes.invalidate(connection_id)
         
-        logger.info(f"Player {player_id} successfully left room {room_name}")
+        logger.info("Player %s successfully left room %s", player_id, room_name)
         return {'statusCode': 200, 'body': 'Left room'}
     
     except Exception as e:
-        logger.error(f"Error handling leave for player {player_id}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error handling leave for player %s: %s", player_id, e)
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
 def handle_player_leave(room_name, player_id, connection_id):
     """Handle the cleanup when a player leaves a room"""
-    logger.info(f"Handling leave cleanup for player {player_id} from room {room_name}")
+    logger.info("Handling leave cleanup for player %s from room %s", player_id, room_name)
     
     try:
-        # Remove player from room
-        response = rooms_table.get_item(Key={'room_name': room_name})
+        # Remove player from room in one write, but only if the roster still maps them to this
+        # connection - a player who already rejoined on a new connection must not be removed
+        player_connections = store.remove_from_roster(room_name, player_id, connection_id)
+        if player_connections is None:
+            logger.warning("Player %s on %s not found in room %s player list", player_id, connection_id, room_name)
+            return
         
-        if 'Item' in response:
-            room_data = response['Item']
-            players = room_data.get('players', [])
-            
-            logger.debug(f"Current players in room: {players}")
-            
-            if player_id in players:
-                players.remove(player_id)
-                rooms_table.update_item(
-                    Key={'room_name': room_name},
-                    UpdateExpression='SET players = :players',
-                    ExpressionAttributeValues={':players': players}
-                )
-                logger.debug(f"Removed player {player_id} from room, remaining players: {players}")
-            else:
-                logger.warning(f"Player {player_id} not found in room player list")
-            
-            # Notify other players
-            player_connections = get_player_connections(room_name)
-            logger.debug(f"Found {len(player_connections)} other connections to notify")
-            
-            for pid, conn_id in player_connections.items():
-                if pid != player_id:
-                    player_left_message = {
-                        'type': 'player_left',
-                        'playerId': player_id
-                    }
-                    logger.debug(f"Notifying player {pid} about player {player_id} leaving")
-                    send_result = send_to_connection(conn_id, player_left_message)
-                    
-                    if not send_result:
-                        logger.warning(f"Failed to notify player {pid} about player {player_id} leaving")
-        else:
-            logger.warning(f"Room {room_name} not found when handling player leave")
+        logger.debug("Removed player %s from room, remaining players: %s", player_id, list(player_connections))
+        
+        # The room just went from full to having space: let the allocator fill it again
+        if len(player_connections) == ROOM_CAPACITY - 1:
+            room_directory.mark(room_name, True)
+        
+        # Notify other players
+        logger.debug("Found %s other connections to notify", len(player_connections))
+        results = broadcast_to_players(
+            player_connections,
+            {'type': 'player_left', 'playerId': player_id, 'version': player_connections.version},
+            exclude_player_id=player_id
+        )
+        for pid, status in results.items():
+            if status != 'sent':
+                logger.warning("Failed to notify player %s about player %s leaving (%s)", pid, player_id, status)
+        
+        # Recipients that turned out to be gone have lost their connection rows just now, so the reaper
+        # will never see them: drop them from the roster here, silently, as prune_roster would
+        gone = {pid: player_connections[pid] for pid, status in results.items() if status == 'gone'}
+        if gone:
+            store.remove_stale_roster_entries(room_name, gone)
+        
+        # Players who were linked to the leaver may now have room for nearer peers
+        remaining = [pid for pid in player_connections if pid not in gone]
+        mesh_before, mesh_after = plan_room_mesh(room_name, remaining + [player_id], remaining)
+        send_mesh_updates(player_connections, mesh_before, mesh_after, left=[player_id])
+        if MESH_PARTIAL:
+            store.remove_positions(room_name, [player_id])
     
     except Exception as e:
-        logger.error(f"Error handling player {player_id} leave from room {room_name}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error handling player %s leave from room %s: %s", player_id, room_name, e)
+
+def queue_departure(room_name, player_id, connection_id, lease):
+    """Queue a player's leave for the room's next flush; returns whether `lease` now holds the room's
+    flush lease (and so has to see the flush done)"""
+    return store.queue_departure(room_name, player_id, connection_id, lease, time.time(), LEAVE_LEASE_SECONDS)
+
+def schedule_departures(room_name, lease):
+    """Flush the room's queued leaves once LEAVE_WINDOW_MS has passed: on the host's timer, or here
+    after waiting out the window (other disconnects meanwhile just queue theirs)"""
+    if DEPARTURES_TICKED:
+        with departure_lock:
+            departure_leases[room_name] = (lease, time.monotonic() + LEAVE_WINDOW_MS / 1000)
+        return
+    time.sleep(LEAVE_WINDOW_MS / 1000)
+    flush_room_departures(room_name, lease)
+
+def flush_departures():
+    """Flush every room whose leave window has passed; called on a timer by hosts that set DEPARTURES_TICKED"""
+    now = time.monotonic()
+    with departure_lock:
+        due = [(room_name, lease) for room_name, (lease, at) in departure_leases.items() if at <= now]
+        for room_name, _ in due:
+            del departure_leases[room_name]
+    for room_name, lease in due:
+        flush_room_departures(room_name, lease)
+
+def flush_room_departures(room_name, lease):
+    """Take everyone queued to leave the room out (one roster write per DEPARTURE_BATCH leaves), tell the
+    players left with one players_left message each, and release the lease"""
+    try:
+        while True:
+            taken = store.take_departures(room_name, lease, DEPARTURE_BATCH)
+            if taken is None:
+                logger.warning("Lost the departure lease for room %s, another flusher took over", room_name)
+                return
+            departed, player_connections, released = taken
+            requeued = False
+            if departed:
+                requeued = notify_players_left(room_name, departed, player_connections, lease)
+            if released and not requeued:
+                return
+    except Exception as e:
+        logger.exception("Error flushing departures from room %s: %s", room_name, e)
+
+def notify_players_left(room_name, departed, player_connections, lease):
+    """Tell the remaining players who left in one players_left message each, and re-plan the mesh;
+    recipients found gone are queued to leave in turn, and the return value says whether `lease` holds
+    the lease for them"""
+    logger.info("%s players left room %s, %s remain", len(departed), room_name, len(player_connections))
+    
+    # The room just went from full to having space: let the allocator fill it again
+    if len(player_connections) < ROOM_CAPACITY <= len(player_connections) + len(departed):
+        room_directory.mark(room_name, True)
+    
+    results = broadcast_to_players(
+        player_connections,
+        {'type': 'players_left', 'playerIds': list(departed), 'version': player_connections.version}
+    )
+    gone = {pid: player_connections[pid] for pid, status in results.items() if status == 'gone'}
+    for pid, status in results.items():
+        if status not in ('sent', 'gone'):
+            logger.warning("Failed to notify player %s about players leaving (%s)", pid, status)
+    held = [queue_departure(room_name, pid, conn_id, lease) for pid, conn_id in gone.items()]
+    
+    remaining = [pid for pid in player_connections if pid not in gone]
+    mesh_before, mesh_after = plan_room_mesh(room_name, remaining + list(departed), remaining)
+    send_mesh_updates(player_connections, mesh_before, mesh_after, left=departed)
+    if MESH_PARTIAL:
+        store.remove_positions(room_name, list(departed))
+    return any(held)
 
 def handle_signaling_message(connection_id, message):
     """Handle WebRTC signaling messages (offer, answer, ice_candidate)"""
     message_type = message.get('type')
     from_player_id = message.get('from')
     to_player_id = message.get('to')
+    token = message.pop('token', None)
     
-    logger.info(f"Handling {message_type} message from {from_player_id} to {to_player_id}")
+    logger.info("Handling %s message from %s to %s", message_type, from_player_id, to_player_id)
     
     if not to_player_id:
-        logger.warning(f"Signaling message without recipient from {connection_id}")
+        logger.warning("Signaling message without recipient from %s", connection_id)
         return {'statusCode': 400, 'body': 'Recipient player ID is required'}
     
     try:
-        # Get recipient's connection ID
-        recipient_connection = get_connection_by_player_id(to_player_id)
+        # A sender whose cached route points elsewhere has reconnected since we cached it
+        if from_player_id:
+            routing_cache.observe(from_player_id, connection_id)
         
+        # Get recipient's connection ID: from the routing token if it checks out, else the index
+        recipient_connection = routing_tokens.verify(to_player_id, token) if token else None
         if not recipient_connection:
-            logger.warning(f"Recipient {to_player_id} not found for signaling message")
+            recipient_connection = get_connection_by_player_id(to_player_id)
+        
+        if not recipient_connection:
+            logger.warning("Recipient %s not found for signaling message", to_player_id)
             return {'statusCode': 404, 'body': 'Recipient not found or not connected'}
         
-        logger.debug(f"Found recipient connection: {recipient_connection}")
+        logger.debug("Found recipient connection: %s", recipient_connection)
         
-        # Forward the message
-        send_result = send_to_connection(recipient_connection, message)
+        # Forward the message (serialized once, even if it has to be retried)
+        payload = encode_message(message)
+        send_result = send_to_connection(recipient_connection, payload)
+        
+        if not send_result:
+            # A cached route or routing token may predate the recipient reconnecting; retry once from the table
+            routing_cache.invalidate(to_player_id)
+            fresh_connection = get_connection_by_player_id(to_player_id)
+            if fresh_connection and fresh_connection != recipient_connection:
+                logger.info("Retrying %s to %s on refreshed connection %s", message_type, to_player_id, fresh_connection)
+                send_result = send_to_connection(fresh_connection, payload)
         
         if send_result:
-            logger.info(f"Successfully forwarded {message_type} from {from_player_id} to {to_player_id}")
+            logger.info("Successfully forwarded %s from %s to %s", message_type, from_player_id, to_player_id)
             return {'statusCode': 200, 'body': f'{message_type} forwarded'}
         else:
-            logger.warning(f"Failed to forward {message_type} to {to_player_id}")
+            logger.warning("Failed to forward %s to %s", message_type, to_player_id)
             return {'statusCode': 500, 'body': f'Failed to send {message_type}'}
     
     except Exception as e:
-        logger.error(f"Error handling signaling message: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error handling signaling message: %s", e)
         return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
-def get_connection_by_player_id(player_id):
-    """Get the connection ID for a specific player"""
-    logger.debug(f"Looking up connection for player: {player_id}")
+# Signaling messages a batch may carry, and how many in one frame
+BATCHABLE_TYPES = ('offer', 'answer', 'ice_candidate')
+MAX_BATCH_ENTRIES = int(os.environ.get('MAX_BATCH_ENTRIES', '256'))
+
+def handle_batch(connection_id, message):
+    """Forward many offer / answer / ice_candidate entries in one invocation, one frame per recipient
+    
+    A recipient with a single entry gets it as a plain message; more than one go out as a
+    'batch' frame carrying that recipient's entries in order.
+    """
+    from_player_id = message.get('from')
+    entries = message.get('messages')
+    
+    if not isinstance(entries, list) or not entries or len(entries) > MAX_BATCH_ENTRIES:
+        logger.warning("Malformed batch from %s", connection_id)
+        return {'statusCode': 400, 'body': f'messages must hold 1 to {MAX_BATCH_ENTRIES} entries'}
+    
+    # Group by recipient, keeping each recipient's entries in the order they were sent
+    groups = {}
+    tokens = {}
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get('type') not in BATCHABLE_TYPES or not entry.get('to'):
+            logger.warning("Dropping invalid batch entry from %s", connection_id)
+            continue
+        entry.setdefault('from', from_player_id)
+        token = entry.pop('token', None)
+        if token:
+            tokens.setdefault(entry['to'], token)
+        groups.setdefault(entry['to'], []).append(entry)
+    if not groups:
+        return {'statusCode': 400, 'body': 'No valid entries in batch'}
     
     try:
-        # Query connections table for the player
-        response = connections_table.scan(
-            FilterExpression='player_id = :pid',
-            ExpressionAttributeValues={':pid': player_id}
-        )
+        if from_player_id:
+            routing_cache.observe(from_player_id, connection_id)
         
-        items = response.get('Items', [])
-        logger.debug(f"Found {len(items)} connections for player {player_id}")
+        # Routing tokens and cached routes first, then one batched lookup for everyone else
+        player_connections = {}
+        for pid in groups:
+            route = routing_tokens.verify(pid, tokens[pid]) if pid in tokens else None
+            route = route or routing_cache.get(pid)
+            if route:
+                player_connections[pid] = route
+        misses = [pid for pid in groups if pid not in player_connections]
+        if misses:
+            player_connections.update(get_connections_for_players(misses))
         
-        if items:
-            connection_id = items[0]['connection_id']
-            logger.debug(f"Using connection: {connection_id} for player {player_id}")
-            return connection_id
+        messages = {
+            pid: group[0] if len(group) == 1 else {'type': 'batch', 'messages': group}
+            for pid, group in groups.items()
+        }
+        results = send_to_players(player_connections, messages)
         
-        logger.warning(f"No connection found for player: {player_id}")
-        return None
+        # A token or cached route may predate the recipient reconnecting; retry those once from the table
+        retry = [pid for pid, status in results.items() if status != 'sent' and pid not in misses]
+        if retry:
+            for pid in retry:
+                routing_cache.invalidate(pid)
+            fresh = {pid: conn_id for pid, conn_id in get_connections_for_players(retry, consistent=True).items()
+                     if conn_id != player_connections[pid]}
+            results.update(send_to_players(fresh, {pid: messages[pid] for pid in fresh}))
+        
+        delivered = sum(1 for status in results.values() if status == 'sent')
+        logger.info("Forwarded batch of %s entries from %s to %s/%s recipients",
+                    len(entries), from_player_id, delivered, len(groups))
+        if delivered < len(groups):
+            return {'statusCode': 207, 'body': json.dumps({
+                'undelivered': sorted(pid for pid in groups if results.get(pid) != 'sent')
+            })}
+        return {'statusCode': 200, 'body': f'{len(entries)} messages forwarded'}
     
     except Exception as e:
-        logger.error(f"Error getting connection for player {player_id}: {str(e)}")
-        logger.error(traceback.format_exc())
-        return None
+        logger.exception("Error handling batch from %s: %s", connection_id, e)
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
 
-def get_player_connections(room_name):
-    """Get all player connections in a room"""
-    logger.debug(f"Getting player connections for room: {room_name}")
+def handle_position(connection_id, message):
+    """Record a player's reported position for the next mesh plan of their room"""
+    player_id = message.get('playerId')
+    room_name = message.get('room')
+    position = parse_position(message.get('position'))
+    
+    if not player_id or not room_name or position is None:
+        logger.warning("Malformed position report from %s", connection_id)
+        return {'statusCode': 400, 'body': 'playerId, room and position are required'}
     
     try:
-        # Scan for all connections in the room
-        response = connections_table.scan(
-            FilterExpression='room = :room',
-            ExpressionAttributeValues={':room': room_name}
-        )
-        
-        items = response.get('Items', [])
-        logger.debug(f"Found {len(items)} connections in room {room_name}")
+        # Conditional on the roster mapping the player to this connection, so nobody can move someone else
+        if not store.set_position(room_name, player_id, connection_id, position):
+            logger.info("Ignoring position of %s, not in room %s on %s", player_id, room_name, connection_id)
+            return {'statusCode': 404, 'body': 'Player not in room'}
+        return {'statusCode': 200, 'body': 'Position recorded'}
+    
+    except Exception as e:
+        logger.exception("Error recording position for %s: %s", player_id, e)
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+def handle_relay(connection_id, message):
+    """Queue game data for players the sender has no working DataChannel to"""
+    from_player_id = message.get('from')
+    recipients = message.get('to')
+    data = message.get('data')
+    
+    if (not from_player_id or not isinstance(recipients, list) or not isinstance(data, dict)
+            or data.get('type') not in RELAYED_TYPES):
+        logger.warning("Malformed relay message from %s", connection_id)
+        return {'statusCode': 400, 'body': 'from, to and a relayable data message are required'}
+    
+    try:
+        # The sender must be who the room roster says is on this connection, and can only reach that room
+        scope = relay_scope(connection_id)
+        if scope is None or scope[1].get(from_player_id) != connection_id or any(
+                pid not in scope[1] for pid in recipients[:ROOM_CAPACITY]):
+            if relay_scopes.may_refresh(scope):
+                scope = relay_scope(connection_id, refresh=True)
+        if scope is None or scope[0] != from_player_id or scope[1].get(from_player_id) != connection_id:
+            logger.warning("Relay from %s as %s, which isn't in its room", connection_id, from_player_id)
+            return {'statusCode': 403, 'body': 'Not in a room as that player'}
         
-        # Create a mapping of player IDs to connection IDs
-        player_connections = {}
-        for item in items:
-            player_id = item.get('player_id')
-            if player_id:
-                player_connections[player_id] = item['connection_id']
+        routing_cache.observe(from_player_id, connection_id)
+        # Nobody has more peers than there are players in a room
+        in_room = [pid for pid in recipients[:ROOM_CAPACITY] if pid in scope[1]]
+        queued = relay_hub.submit(from_player_id, in_room, data)
+        logger.debug("Queued %s from %s for %s players", data.get('type'), from_player_id, queued)
         
-        logger.debug(f"Mapped {len(player_connections)} player IDs to connections")
-        return player_connections
+        if RELAY_TICK_MS <= 0:
+            flush_relay()
+        return {'statusCode': 200, 'body': 'Relayed'}
     
     except Exception as e:
-        logger.error(f"Error getting player connections for room {room_name}: {str(e)}")
-        logger.error(traceback.format_exc())
+        logger.exception("Error relaying game data from %s: %s", from_player_id, e)
+        return {'statusCode': 500, 'body': json.dumps({'error': str(e)})}
+
+def relay_scope(connection_id, refresh=False):
+    """(player_id, {player_id: connection_id} of their room) for a connection, or None if it isn't in a room"""
+    scope = None if refresh else relay_scopes.get(connection_id)
+    if scope is None:
+        record = store.get_connection(connection_id) or {}
+        if not record.get('room') or not record.get('player_id'):
+            relay_scopes.invalidate(connection_id)
+            return None
+        scope = relay_scopes.put(connection_id, record['player_id'], dict(store.get_roster(record['room'])))
+    return scope
+
+def flush_relay():
+    """Send each recipient everything relayed to them since the last flush as one relay_batch frame"""
+    batches = relay_hub.drain()
+    if not batches:
+        return {}
+    
+    player_connections = {}
+    misses = []
+    for pid in batches:
+        connection_id = routing_cache.get(pid)
+        if connection_id:
+            player_connections[pid] = connection_id
+        else:
+            misses.append(pid)
+    if misses:
+        try:
+            player_connections.update(get_connections_for_players(misses))
+        except Exception as e:
+            logger.error("Error resolving relay recipients: %s", e)
+    
+    return send_to_players(player_connections, {
+        pid: {'type': 'relay_batch', 'messages': messages} for pid, messages in batches.items()
+    })
+
+def parse_position(value):
+    """(x, y) from a client's {'x': ..., 'y': ...}, or None unless both are finite numbers"""
+    try:
+        x, y = float(value['x']), float(value['y'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return (x, y) if math.isfinite(x) and math.isfinite(y) else None
+
+def plan_room_mesh(room_name, players_before, players_after, reported=None):
+    """Plan the room's peer overlay before and after a join or leave
+    
+    Positions are only read when the room is too big for a full mesh; `reported` holds
+    positions that arrived with this request and may not be readable yet.
+    """
+    positions = {}
+    if max(len(players_before), len(players_after)) > MESH_DEGREE + 1:
+        positions = store.get_positions(room_name)
+        positions.update((pid, pos) for pid, pos in (reported or {}).items() if pos is not None)
+    return plan_mesh(players_before, positions, MESH_DEGREE), plan_mesh(players_after, positions, MESH_DEGREE)
+
+def send_mesh_updates(player_connections, before, after, joined=None, left=()):
+    """Send a 'mesh' message to each player whose planned peers changed by more than gaining the
+    joiner or losing the leavers (new_player / player_left already tell them that much)
+    
+    'peers' is the player's full peer set, 'connect' the new links they should open. Links to a
+    joiner are opened by the joiner; any other new link by whichever player ID sorts first.
+    """
+    messages = {}
+    for pid, peers in after.items():
+        if pid == joined:
+            continue
+        previous = set(before.get(pid, ())) - set(left)
+        if set(peers) == previous | ({joined} & set(peers)):
+            continue
+        messages[pid] = {
+            'type': 'mesh',
+            'peers': peers,
+            'connect': [p for p in peers if p not in previous and p != joined and pid < p]
+        }
+    if not messages:
         return {}
+    
+    logger.info("Re-planned mesh: %s players get new peer sets", len(messages))
+    results = send_to_players(player_connections, messages)
+    for pid, status in results.items():
+        if status != 'sent':
+            logger.warning("Failed to send mesh update to player %s (%s)", pid, status)
+    return results
+
+def allocate_room(player_id, connection_id):
+    """Add a joining player to the lowest room shard with space, opening a new shard when every room is full;
+    returns (room_name, roster)"""
+    tried = set()
+    refresh = False
+    for attempt in range(ROOM_CAPACITY + 4):
+        for room_name in room_directory.candidates(refresh):
+            if room_name in tried:
+                continue
+            tried.add(room_name)
+            added, roster = store.add_to_roster(room_name, player_id, connection_id, ROOM_CAPACITY)
+            if not added and len(prune_roster(room_name, roster)) < ROOM_CAPACITY:
+                # The room was only full of players whose connections are gone
+                added, roster = store.add_to_roster(room_name, player_id, connection_id, ROOM_CAPACITY)
+            if added:
+                if len(roster) >= ROOM_CAPACITY:
+                    room_directory.mark(room_name, False)
+                return room_name, roster
+            logger.debug("Room %s is full", room_name)
+            room_directory.mark(room_name, False)
+        
+        # Every known room is full: open the next shard. Only one of several concurrent joins wins the
+        # claim; the others re-read the directory and pile into the shard the winner opened
+        room_name = room_directory.claim_next()
+        if room_name is None:
+            refresh = True
+            continue
+        added, roster = store.add_to_roster(room_name, player_id, connection_id, ROOM_CAPACITY)
+        if added:
+            logger.info("Opened room %s for player %s", room_name, player_id)
+            if len(roster) < ROOM_CAPACITY:
+                room_directory.mark(room_name, True)
+            return room_name, roster
+        tried.add(room_name)
+        refresh = True
+    raise RuntimeError(f"Could not find a room with space for player {player_id}")
+
+def get_connection_by_player_id(player_id):
+    """Get the connection ID for a specific player"""
+    logger.debug("Looking up connection for player: %s", player_id)
+    
+    connection_id = routing_cache.get(player_id)
+    if connection_id:
+        logger.debug("Using cached connection: %s for player %s", connection_id, player_id)
+        return connection_id
+    
+    try:
+        # Single-item read from the player index - no scan on the signaling hot path
+        connection_id = store.get_player_connection(player_id)
+        
+        if connection_id:
+            routing_cache.put(player_id, connection_id)
+            logger.debug("Using connection: %s for player %s", connection_id, player_id)
+            return connection_id
+        
+        logger.warning("No connection found for player: %s", player_id)
+        return None
+    
+    except Exception as e:
+        logger.exception("Error getting connection for player %s: %s", player_id, e)
+        return None
+
+def release_player_index(player_id, connection_id):
+    """Remove a player's index entry, unless they have already reconnected on a newer connection"""
+    try:
+        if store.release_player(player_id, connection_id):
+            logger.debug("Released player index entry for %s", player_id)
+        else:
+            logger.debug("Player %s is indexed to a newer connection, leaving it in place", player_id)
+            routing_cache.invalidate(player_id)
+    except Exception as e:
+        logger.error("Error releasing player index for %s: %s", player_id, e)
+
+def get_connections_for_players(player_ids, consistent=False):
+    """Resolve many players to their connection IDs in one batched lookup against the player index"""
+    logger.debug("Batch-resolving connections for %s players", len(player_ids))
+    player_connections = store.get_player_connections(player_ids, consistent=consistent)
+    for pid, conn_id in player_connections.items():
+        routing_cache.put(pid, conn_id)
+    logger.debug("Mapped %s player IDs to connections", len(player_connections))
+    return player_connections
+
+def prune_roster(room_name, roster):
+    """Remove roster entries whose connection is gone or has stopped sending heartbeats; returns the live
+    Roster as the removal left it, including anyone who joined since `roster` was read
+    
+    A connection whose heartbeats stopped is only dropped once API Gateway confirms it is closed, the
+    way the reaper does: clients too old to send heartbeats stay while their socket is open.
+    """
+    try:
+        presence = store.get_presence(list(roster.values()), consistent=True)
+        cutoff = time.time() - PRESENCE_TIMEOUT_SECONDS
+        quiet = [conn_id for conn_id, last_seen in presence.items() if last_seen is not None and last_seen < cutoff]
+        still_open = find_open_connections(quiet) if quiet else set()
+    except Exception as e:
+        # Without an answer every player would look stale - keep the roster as it is
+        logger.exception("Error checking liveness for room %s: %s", room_name, e)
+        return Roster(roster, roster.version)
+    
+    stale = [pid for pid, conn_id in roster.items()
+             if conn_id not in presence or (conn_id in quiet and conn_id not in still_open)]
+    if not stale:
+        return Roster(roster, roster.version)
+    
+    logger.info("Cleaning up player list. Removing: %s", stale)
+    # Each entry is only removed if it still points at the dead connection, so a player who
+    # rejoined in the meantime is never dropped
+    removed = store.remove_stale_roster_entries(room_name, {pid: roster[pid] for pid in stale})
+    if removed is None:
+        logger.info("Roster for %s changed concurrently, leaving cleanup to the next join", room_name)
+        return Roster({pid: conn_id for pid, conn_id in roster.items() if pid not in stale}, roster.version)
+    
+    return Roster(removed, removed.version)
+
+def encode_message(data):
+    """Serialize a message for post_to_connection; do it once per message, not once per use"""
+    return json.dumps(data).encode('utf-8')
 
 def send_to_connection(connection_id, data):
-    """Send a message to a WebSocket connection"""
+    """Send a message (a dict, or bytes from encode_message) to a WebSocket connection"""
     if not api_client:
         logger.error("API client not initialized for send_to_connection")
         return False
     
-    logger.debug(f"Sending message to connection {connection_id}: {json.dumps(data)}")
+    payload = data if isinstance(data, bytes) else encode_message(data)
+    logger.debug("Sending %s bytes to connection %s", len(payload), connection_id)
     
-    try:
-        api_client.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps(data).encode('utf-8')
-        )
-        logger.debug(f"Message sent successfully to {connection_id}")
-        return True
+    status = post_payload(connection_id, payload)
+    if status == 'gone':
+        logger.info("Connection %s is gone, cleaning up", connection_id)
+        routing_cache.invalidate_connection(connection_id)
+        try:
+            gone_connection = store.delete_connection(connection_id) or {}
+            gone_player_id = gone_connection.get('player_id')
+            if gone_player_id:
+                release_player_index(gone_player_id, connection_id)
+            logger.info("Cleaned up gone connection: %s", connection_id)
+        except Exception as cleanup_error:
+            logger.error("Error cleaning up connection: %s", cleanup_error)
+    
+    return status == 'sent'
+
+def post_payload(connection_id, payload):
+    """Post an already-serialized payload to a connection; returns 'sent', 'gone' or 'failed'"""
+    status = send_scheduler.send(connection_id, payload)
+    logger.debug("Message to %s: %s", connection_id, status)
+    return status
+
+def get_broadcast_executor():
+    """Thread pool shared by broadcasts for the lifetime of the warm container"""
+    global broadcast_executor
+    if broadcast_executor is None:
+        broadcast_executor = ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY, thread_name_prefix='broadcast')
+    return broadcast_executor
+
+def broadcast_to_players(player_connections, data, exclude_player_id=None):
+    """Send one message to many players concurrently; returns {player_id: 'sent' | 'gone' | 'failed'}"""
+    recipients = {pid: conn_id for pid, conn_id in player_connections.items() if pid != exclude_player_id}
+    if not recipients:
+        return {}
+    
+    # Serialize once for every recipient
+    payload = encode_message(data)
+    results = deliver_payloads({pid: (conn_id, payload) for pid, conn_id in recipients.items()})
     
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Broadcast %s to %s players, %s gone, %s failed", data.get('type'), len(recipients),
+                     sum(1 for s in results.values() if s == 'gone'), sum(1 for s in results.values() if s == 'failed'))
+    return results
+
+def send_to_players(player_connections, messages):
+    """Send each player in {player_id: message} their own message concurrently; returns {player_id: status}"""
+    return deliver_payloads({
+        pid: (player_connections[pid], encode_message(data))
+        for pid, data in messages.items() if pid in player_connections
+    })
+
+def deliver_payloads(deliveries):
+    """Post {player_id: (connection_id, payload)} over the broadcast pool and clean up gone connections"""
+    if not deliveries:
+        return {}
+    
+    if not api_client:
+        logger.error("API client not initialized for deliver_payloads")
+        return {pid: 'failed' for pid in deliveries}
+    
+    metrics.fanout(len(deliveries))
+    if len(deliveries) == 1:
+        results = {pid: post_payload(conn_id, payload) for pid, (conn_id, payload) in deliveries.items()}
+    else:
+        executor = get_broadcast_executor()
+        futures = {pid: executor.submit(post_payload, conn_id, payload) for pid, (conn_id, payload) in deliveries.items()}
+        results = {pid: future.result() for pid, future in futures.items()}
+    
+    gone_connections = {deliveries[pid][0]: pid for pid, status in results.items() if status == 'gone'}
+    if gone_connections:
+        remove_gone_connections(gone_connections)
+    return results
+
+def remove_gone_connections(gone_connections):
+    """Delete connections API Gateway reported as gone in one batch write, then release their player index entries"""
+    logger.info("Cleaning up %s gone connections", len(gone_connections))
+    for pid in gone_connections.values():
+        routing_cache.invalidate(pid)
+    
+    try:
+        store.delete_connections(list(gone_connections))
+        
+        for conn_id, pid in gone_connections.items():
+            if pid:
+                release_player_index(pid, conn_id)
     except Exception as e:
-        error_message = str(e)
-        logger.error(f"Error sending message to connection {connection_id}: {error_message}")
+        logger.exception("Error cleaning up gone connections: %s", e)
+
+def reap_handler(event, context):
+    """Scheduled entry point (e.g. an EventBridge rule every few minutes) that runs the connection reaper"""
+    logger.begin('reap_handler')
+    metrics.begin('$reaper')
+    if api_client is None and WEBSOCKET_API_ENDPOINT:
+        warm_clients()
+    if api_client is None:
+        # Nothing could confirm a connection gone, and reaping open ones would orphan their sockets
+        logger.error("WEBSOCKET_API_ENDPOINT is not set, so the reaper can't check connections; not running")
+        metrics.end()
+        return {'statusCode': 500, 'body': json.dumps({'error': 'WEBSOCKET_API_ENDPOINT is not set'})}
+    # Leave a few seconds of the invocation for the last page; the next run carries on
+    deadline = None
+    if context is not None:
+        deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - 5
+    try:
+        stats = reap_expired_connections(deadline)
+    finally:
+        metrics.end()
+    return {'statusCode': 200, 'body': json.dumps(stats)}
+
+def reap_expired_connections(deadline=None):
+    """Sweep connections whose heartbeats stopped without a $disconnect reaching us
+    
+    Each page of expired rows is checked with API Gateway: connections that are in fact still open
+    (a client too old to send heartbeats) get their expiry pushed out, the rest leave their rooms
+    like a disconnect would, one flush per room, and are deleted with one batch write per page.
+    """
+    stats = {'pages': 0, 'expired': 0, 'reaped': 0, 'still_open': 0}
+    if not api_client:
+        logger.error("No API client to confirm expired connections are gone, skipping the sweep")
+        return stats
+    lease = 'reaper-' + os.urandom(8).hex()
+    start = None
+    while True:
+        expired, start = store.get_expired_connections(time.time(), REAPER_PAGE_SIZE, start)
+        stats['pages'] += 1
+        stats['expired'] += len(expired)
         
-        # More detailed error analysis
-        if 'GoneException' in error_message:
-            logger.info(f"Connection {connection_id} is gone, cleaning up")
-            try:
-                connections_table.delete_item(Key={'connection_id': connection_id})
-                logger.info(f"Cleaned up gone connection: {connection_id}")
-            except Exception as cleanup_error:
-                logger.error(f"Error cleaning up connection: {str(cleanup_error)}")
-        elif 'LimitExceededException' in error_message:
-            logger.error("Rate limit exceeded when sending message. Consider implementing backoff.")
-        elif 'PayloadTooLargeException' in error_message:
-            logger.error(f"Payload too large: {len(json.dumps(data))} bytes")
-        
-        return False
\ No newline at end of file
+        if expired:
+            still_open = find_open_connections([record['connection_id'] for record in expired])
+            for connection_id in still_open:
+                store.refresh_connection(connection_id, connection_expiry())
+            gone = [record for record in expired if record['connection_id'] not in still_open]
+            
+            # Rooms whose lease another flusher holds are flushed by it
+            flush_rooms = set()
+            for record in gone:
+                if record.get('room') and record.get('player_id'):
+                    if queue_departure(record['room'], record['player_id'], record['connection_id'], lease):
+                        flush_rooms.add(record['room'])
+                routing_cache.invalidate_connection(record['connection_id'])
+            for room_name in flush_rooms:
+                flush_room_departures(room_name, lease)
+            if gone:
+                remove_gone_connections({record['connection_id']: record.get('player_id') for record in gone})
+            stats['reaped'] += len(gone)
+            stats['still_open'] += len(still_open)
+        
+        if start is None:
+            break
+        if deadline is not None and time.monotonic() > deadline:
+            logger.warning("Reaper out of time after %s pages, the next run continues the sweep", stats['pages'])
+            break
+    
+    logger.info("Reaped %s of %s expired connections (%s still open) over %s pages",
+                stats['reaped'], stats['expired'], stats['still_open'], stats['pages'])
+    return stats
+
+def find_open_connections(connection_ids):
+    """The connections API Gateway still has open; without an API client none can be confirmed gone,
+    so every connection counts as open"""
+    if not api_client:
+        return set(connection_ids)
+    
+    def is_open(connection_id):
+        try:
+            api_client.get_connection(ConnectionId=connection_id)
+            return True
+        except Exception as e:
+            # Anything but a definite GoneException leaves the connection alone until the next sweep
+            return 'GoneException' not in str(e)
+    
+    results = get_broadcast_executor().map(is_open, connection_ids)
+    return {connection_id for connection_id, open_ in zip(connection_ids, results) if open_}
+
+def warm_clients():
+    """Create the store's clients, and the API client when its endpoint is configured, ahead of any request"""
+    global api_client
+    store.warm()
+    if api_client is None and WEBSOCKET_API_ENDPOINT:
+        api_client = create_api_client(WEBSOCKET_API_ENDPOINT)
+
+# In Lambda the init phase runs before the first event is routed here (and is what SnapStart and
+# provisioned concurrency snapshot), so build clients there; elsewhere they're built on first use
+if os.environ.get('PREWARM_CLIENTS', '1' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else '0') == '1':
+    warm_clients()
@@ -1,17 +1,133 @@
 import json
-import boto3
-from decimal import Decimal
+import logging
+import os
 from botocore.exceptions import ClientError
 
-dynamodb = boto3.resource('dynamodb')
+logger = logging.getLogger()
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 
-# Helper function to convert Decimal to int or float
-class DecimalEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, Decimal):
-            # Convert to int if it's a whole number, otherwise float
-            return int(obj) if obj % 1 == 0 else float(obj)
-        return super(DecimalEncoder, self).default(obj)
+# Low-level DynamoDB client, created on first use by get_dynamodb (the resource layer
+# adds ~50 ms to a cold start and this function only needs UpdateItem and Query)
+dynamodb = None
+
+# Visits are one item per page in PAGE_TABLE_NAME, keyed (site_id, page_name), with a visits
+# number. TABLE_NAME holds the older layout, one item per site with a page_visits map of every
+# page, which grows with the site towards DynamoDB's 400 KB item limit and costs a write unit
+# per KB of the whole map on every hit. It stays the default (PAGE_LAYOUT=map) until
+# migrate_page_visits.py has merged the maps across; then set PAGE_LAYOUT=item.
+TABLE_NAME = "ccs_site_meta_data"
+PAGE_TABLE_NAME = os.environ.get('PAGE_TABLE_NAME', 'ccs_page_visits')
+PAGE_LAYOUT = os.environ.get('PAGE_LAYOUT', 'map')
+LIST_LIMIT = 100
+MAX_LIST_LIMIT = 1000
+
+def get_dynamodb():
+    global dynamodb
+    if dynamodb is None:
+        import boto3
+        dynamodb = boto3.client('dynamodb')
+    return dynamodb
+
+def increment_page_visits(client, site_id, page_name, amount=1):
+    """Add `amount` to a page's item (one UpdateItem, created by the first hit) and return the new count"""
+    response = client.update_item(
+        TableName=PAGE_TABLE_NAME,
+        Key={'site_id': {'S': site_id}, 'page_name': {'S': page_name}},
+        UpdateExpression='ADD visits :amount',
+        ExpressionAttributeValues={':amount': {'N': str(amount)}},
+        ReturnValues='UPDATED_NEW'
+    )
+    return int(response['Attributes']['visits']['N'])
+
+def query_page_visits(client, site_id, limit=LIST_LIMIT, start_after=None):
+    """One page of a site's counts in page_name order: ({page_name: visits}, last page_name or None)
+
+    A Query on the site's partition reads only that site's items, `limit` at a time; pass the
+    returned page_name back as `start_after` for the next page (None once there are no more).
+    """
+    request = {
+        'TableName': PAGE_TABLE_NAME,
+        'KeyConditionExpression': 'site_id = :site',
+        'ProjectionExpression': 'page_name, visits',
+        'ExpressionAttributeValues': {':site': {'S': site_id}},
+        'Limit': limit
+    }
+    if start_after:
+        request['ExclusiveStartKey'] = {'site_id': {'S': site_id}, 'page_name': {'S': start_after}}
+    response = client.query(**request)
+    visits = {item['page_name']['S']: int(item['visits']['N']) for item in response.get('Items', [])}
+    last = response.get('LastEvaluatedKey')
+    return visits, last['page_name']['S'] if last else None
+
+def increment_map_visits(client, site_id, page_name, amount=1):
+    """Add `amount` to a page's count inside DynamoDB (one UpdateItem) and return the new count
+
+    ADD only works on top-level attributes, hence SET with if_not_exists on the map entry. A new
+    site has no page_visits map for the path to point into; that write fails validation, the map
+    is created and the increment retried.
+    """
+    for attempt in range(2):
+        try:
+            response = client.update_item(
+                TableName=TABLE_NAME,
+                Key={'site_id': {'S': site_id}},
+                UpdateExpression='SET page_visits.#page = if_not_exists(page_visits.#page, :zero) + :amount',
+                ExpressionAttributeNames={'#page': page_name},
+                ExpressionAttributeValues={':zero': {'N': '0'}, ':amount': {'N': str(amount)}},
+                ReturnValues='UPDATED_NEW'
+            )
+            return int(response['Attributes']['page_visits']['M'][page_name]['N'])
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ValidationException' or attempt:
+                raise
+            create_page_visits_map(client, site_id)
+
+def create_page_visits_map(client, site_id):
+    """Give a site an empty page_visits map, unless a concurrent first hit already has"""
+    try:
+        client.update_item(
+            TableName=TABLE_NAME,
+            Key={'site_id': {'S': site_id}},
+            UpdateExpression='SET page_visits = :empty',
+            ConditionExpression='attribute_not_exists(page_visits)',
+            ExpressionAttributeValues={':empty': {'M': {}}}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+def increment_visits(site_id, page_name, amount=1):
+    increment = increment_map_visits if PAGE_LAYOUT == 'map' else increment_page_visits
+    return increment(get_dynamodb(), site_id, page_name, amount)
+
+def map_page_visits(client, site_id):
+    """Every page of a site in the map layout, as {page_name: visits}"""
+    item = client.get_item(TableName=TABLE_NAME, Key={'site_id': {'S': site_id}}).get('Item', {})
+    return {name: int(value['N']) for name, value in item.get('page_visits', {}).get('M', {}).items()}
+
+def list_response(client, site_id, query_params):
+    if PAGE_LAYOUT == 'map':
+        page_visits, cursor = map_page_visits(client, site_id), None
+    else:
+        try:
+            limit = min(max(int(query_params.get('limit') or LIST_LIMIT), 1), MAX_LIST_LIMIT)
+        except ValueError:
+            return {
+                'statusCode': 400,
+                'body': json.dumps({
+                    'message': "'limit' must be a number."
+                })
+            }
+        page_visits, cursor = query_page_visits(client, site_id, limit, query_params.get('cursor'))
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'site_id': site_id,
+            'page_visits': page_visits,
+            'cursor': cursor
+        })
+    }
 
 def lambda_handler(event, context):
     # Parse query parameters from the raw request
@@ -27,45 +143,45 @@ def lambda_handler(event, context):
             })
         }
 
-    if not site_id or not page_name:
+    if not site_id:
         return {
             'statusCode': 400,
             'body': json.dumps({
-                'message': "Both 'site_id' and 'page_name' are required query parameters."
+                'message': "'site_id' is a required query parameter."
             })
         }
 
-    # Reference the DynamoDB table
-    table_name = "ccs_site_meta_data"
-    table = dynamodb.Table(table_name)
-
     try:
-        # Attempt to retrieve the item
-        response = table.get_item(Key={'site_id': site_id})
-        item = response.get('Item')
+        # site_id on its own lists the site's pages, a page at a time (pass 'cursor' back for the next)
+        if not page_name:
+            return list_response(get_dynamodb(), site_id, query_params)
 
-        if not item:
-            # Create a new item if it doesn't exist
-            item = {
-                'site_id': site_id,
-                'page_visits': {}
-            }
+        if visit_buffer is not None:
+            pending = visit_buffer.add(site_id, page_name)
+            reason = visit_buffer.due()
+            if reason:
+                visit_buffer.flush(reason, context)
 
-        # Update the page_visits count
-        page_visits = item.get('page_visits', {})
-        page_visits[page_name] = page_visits.get(page_name, 0) + 1
-        item['page_visits'] = page_visits
+            return {
+                'statusCode': 200,
+                'body': json.dumps({
+                    'message': 'Page visit recorded; the count is written behind.',
+                    'site_id': site_id,
+                    'page_name': page_name,
+                    'pending': pending
+                })
+            }
 
-        # Write the updated item back to the table
-        table.put_item(Item=item)
+        visits = increment_visits(site_id, page_name)
 
         return {
             'statusCode': 200,
             'body': json.dumps({
                 'message': 'Page visit count updated successfully.',
                 'site_id': site_id,
-                'page_visits': item['page_visits']
-            }, cls=DecimalEncoder)  # Use the custom encoder here
+                'page_name': page_name,
+                'visits': visits
+            })
         }
 
     except ClientError as e:
@@ -76,3 +192,26 @@ def lambda_handler(event, context):
                 'error': str(e)
             })
         }
+
+# WRITE_BEHIND=1 buffers hits in the warm container and writes them as one increment per page
+# (see visit_buffer.py) once WRITE_BEHIND_MAX_HITS are buffered or the oldest is
+# WRITE_BEHIND_MAX_SECONDS old, spending at most WRITE_BEHIND_FLUSH_BUDGET_MS of an invocation
+# on it. Hits respond with how many are pending for the page instead of its count.
+visit_buffer = None
+if os.environ.get('WRITE_BEHIND', '0') == '1':
+    # Only imported here: a direct-write deployment can ship main.py on its own and skips loading
+    # the thread pool and signal machinery
+    from visit_buffer import VisitBuffer
+    visit_buffer = VisitBuffer(
+        increment_visits,
+        max_hits=int(os.environ.get('WRITE_BEHIND_MAX_HITS', '100')),
+        max_seconds=float(os.environ.get('WRITE_BEHIND_MAX_SECONDS', '5')),
+        flush_budget_ms=float(os.environ.get('WRITE_BEHIND_FLUSH_BUDGET_MS', '250')),
+        logger=logger
+    )
+    visit_buffer.install_signal_handlers()
+
+# In Lambda the init phase runs before the first request is routed here (and is what SnapStart and
+# provisioned concurrency snapshot), so create the client there; elsewhere it's created on first use
+if os.environ.get('PREWARM_CLIENTS', '1' if os.environ.get('AWS_LAMBDA_FUNCTION_NAME') else '0') == '1':
+    get_dynamodb()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Copy page visit counts from the per-site map layout into per-page items.
+
+    python migrate_page_visits.py [--site SITE ...] [--workers 4] [--dry-run] [--verify]
+
+Scans TABLE_NAME (or reads just the --site items) a page at a time and merges each map entry
+into its (site_id, page_name) item in PAGE_TABLE_NAME, streaming pages to --workers threads.
+Counts are added, never overwritten: each item's `migrated` attribute records how much of the
+map's count it has been given, and one conditional UpdateItem per page adds the rest to visits
+(ADD visits :delta, conditional on migrated still holding what was read). Hits the Lambda has
+already counted in the item are kept, and a re-run only adds what the map gained since, so it is
+safe before or after the Lambda is switched from PAGE_LAYOUT=map to item. The usual order is:
+run it, switch, run it again to carry over hits the maps took in between.
+--verify reads each site's items back a page at a time and reports pages whose migrated count
+differs from the map.
+
+The page table needs site_id (S) as its partition key and page_name (S) as its sort key.
+"""
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+import main
+
+BATCH_SIZE = 25  # pages handed to a worker at a time
+MAX_ATTEMPTS = 5
+
+
+def site_items(client, site_ids=None):
+    """Map-layout items, one scan page at a time (or just the given sites)"""
+    if site_ids:
+        for site_id in site_ids:
+            item = client.get_item(TableName=main.TABLE_NAME, Key={'site_id': {'S': site_id}}).get('Item')
+            if item:
+                yield item
+        return
+    request = {'TableName': main.TABLE_NAME, 'ProjectionExpression': 'site_id, page_visits'}
+    while True:
+        response = client.scan(**request)
+        yield from response.get('Items', [])
+        if 'LastEvaluatedKey' not in response:
+            return
+        request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def page_counts(item):
+    site_id = item['site_id']['S']
+    for page_name, visits in item.get('page_visits', {}).get('M', {}).items():
+        yield site_id, page_name, int(visits['N'])
+
+
+def merge_page(client, site_id, page_name, count):
+    """Bring a page item's migrated count up to the map's `count`, adding the difference to visits;
+    returns (UpdateItem calls made, whether anything was added)"""
+    migrated = None
+    for attempt in range(MAX_ATTEMPTS):
+        values = {':delta': {'N': str(count - (migrated or 0))}, ':count': {'N': str(count)}}
+        if migrated is None:
+            condition = 'attribute_not_exists(migrated)'
+        else:
+            condition = 'migrated = :migrated'
+            values[':migrated'] = {'N': str(migrated)}
+        try:
+            client.update_item(
+                TableName=main.PAGE_TABLE_NAME,
+                Key={'site_id': {'S': site_id}, 'page_name': {'S': page_name}},
+                UpdateExpression='ADD visits :delta SET migrated = :count',
+                ConditionExpression=condition,
+                ExpressionAttributeValues=values,
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+            return attempt + 1, True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            # Migrated before (or by a concurrent run): only what the map gained since is added
+            migrated = int(e.response.get('Item', {}).get('migrated', {}).get('N', '0'))
+            if migrated >= count:
+                return attempt + 1, False
+    raise RuntimeError(f"{site_id} {page_name}: migrated count kept changing over {MAX_ATTEMPTS} attempts")
+
+
+class Migration:
+    """Streams map entries to worker threads in batches, keeping at most 2 batches per worker in flight"""
+
+    def __init__(self, client, workers=4, dry_run=False):
+        self.client = client
+        self.dry_run = dry_run
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.in_flight = threading.BoundedSemaphore(workers * 2)
+        self.lock = threading.Lock()
+        self.futures = []
+        self.sites = 0
+        self.pages = 0
+        self.calls = 0
+        self.merged = 0
+        self.unchanged = 0
+
+    def write_batch(self, pages):
+        # Throttled calls are retried by botocore's own backoff
+        try:
+            for site_id, page_name, count in pages:
+                calls, added = merge_page(self.client, site_id, page_name, count)
+                with self.lock:
+                    self.calls += calls
+                    if added:
+                        self.merged += 1
+                    else:
+                        self.unchanged += 1
+        finally:
+            self.in_flight.release()
+
+    def submit(self, batch):
+        if self.dry_run:
+            return
+        self.in_flight.acquire()
+        self.futures.append(self.executor.submit(self.write_batch, batch))
+
+    def run(self, items):
+        started = time.perf_counter()
+        batch = []
+        try:
+            for item in items:
+                self.sites += 1
+                for page in page_counts(item):
+                    self.pages += 1
+                    batch.append(page)
+                    if len(batch) == BATCH_SIZE:
+                        self.submit(batch)
+                        batch = []
+            if batch:
+                self.submit(batch)
+        finally:
+            self.executor.shutdown(wait=True)
+        for future in self.futures:
+            future.result()
+        return {
+            'sites': self.sites,
+            'pages': self.pages,
+            'calls': self.calls,
+            'merged': self.merged,
+            'unchanged': self.unchanged,
+            'seconds': time.perf_counter() - started
+        }
+
+
+def migrated_counts(client, site_id):
+    """{page_name: migrated} for a site's page items, read a query page at a time"""
+    request = {
+        'TableName': main.PAGE_TABLE_NAME,
+        'KeyConditionExpression': 'site_id = :site',
+        'ProjectionExpression': 'page_name, migrated',
+        'ExpressionAttributeValues': {':site': {'S': site_id}},
+        'Limit': main.MAX_LIST_LIMIT
+    }
+    counts = {}
+    while True:
+        response = client.query(**request)
+        counts.update((item['page_name']['S'], int(item['migrated']['N']))
+                      for item in response.get('Items', []) if 'migrated' in item)
+        if 'LastEvaluatedKey' not in response:
+            return counts
+        request['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+def differences(client, item):
+    """(page_name, map count, migrated count) for every page whose map count hasn't all been merged"""
+    site_id = item['site_id']['S']
+    expected = {name: int(value['N']) for name, value in item.get('page_visits', {}).get('M', {}).items()}
+    found = migrated_counts(client, site_id)
+    return [(name, expected.get(name), found.get(name))
+            for name in sorted(expected.keys() | found.keys()) if expected.get(name) != found.get(name)]
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--site', action='append', help='migrate only this site (repeatable)')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--dry-run', action='store_true', help='count the pages without writing them')
+    parser.add_argument('--verify', action='store_true', help='compare every site with its page items afterwards')
+    args = parser.parse_args()
+
+    client = main.get_dynamodb()
+    result = Migration(client, max(1, args.workers), args.dry_run).run(site_items(client, args.site))
+    print(f"{result['sites']} sites, {result['pages']} pages found, {result['merged']} merged, "
+          f"{result['unchanged']} already up to date, in {result['calls']} UpdateItem calls, {result['seconds']:.1f} s")
+
+    if args.verify:
+        mismatched = 0
+        for item in site_items(client, args.site):
+            for page_name, expected, found in differences(client, item):
+                mismatched += 1
+                print(f"  {item['site_id']['S']} {page_name}: map {expected}, migrated {found}")
+        print(f"{mismatched} pages differ")
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""Contention benchmark for the page visit counter in main.py, against the in-memory DynamoDB
+stand-in from ../multiplayer/local_dynamodb.py.
+
+    python page_visits_bench.py --hits 500 --pages 5 --existing-pages 200 --db-latency-ms 5
+        [--sites 200 --site-pages 300 --migration-workers 32] [--write-behind-hits 2000 --max-hits 100]
+
+Fires --hits concurrent requests at one site, spread over --pages pages, once at a site seen for
+the first time and once at a site that already counts --existing-pages other pages. Each run is
+done with the read-modify-write of the whole page_visits map this function used to do, with the
+in-place increment of the map entry and with the per-page item layout, and reports increments
+lost, DynamoDB calls and capacity per hit. Then migrates --sites sites of --site-pages pages each
+from the map layout to page items with migrate_page_visits.py on --migration-workers threads,
+counts hits on the item layout and on the maps, migrates again and checks that both were kept,
+and lists a site back a page at a time.
+Last, sends --write-behind-hits hits one after another (as one warm container would get them)
+over --pages pages, busiest first, through lambda_handler with and without the write-behind
+buffer flushing every --max-hits, and compares write units, then sends SIGTERM while a flush's
+writes are in flight. Exits non-zero if an increment or the buffer loses hits, the migration loses
+or double-counts any, or the signal is handed on before the flush in flight is written.
+"""
+import argparse
+import logging
+import os
+import random
+import signal
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'multiplayer'))
+
+import local_dynamodb
+import main
+import migrate_page_visits
+import visit_buffer
+
+
+def read_modify_write(client, site_id, page_name):
+    """What lambda_handler did before: GetItem the whole site, add one in Python, PutItem it all back"""
+    item = client.get_item(TableName=main.TABLE_NAME, Key={'site_id': {'S': site_id}}).get('Item')
+    if not item:
+        item = {'site_id': {'S': site_id}, 'page_visits': {'M': {}}}
+    visits = {name: int(value['N']) for name, value in item['page_visits']['M'].items()}
+    visits[page_name] = visits.get(page_name, 0) + 1
+    item['page_visits'] = {'M': {name: {'N': str(count)} for name, count in visits.items()}}
+    client.put_item(TableName=main.TABLE_NAME, Item=item)
+    return visits[page_name]
+
+
+def run_hits(hit, client, site_id, pages, hits):
+    barrier = threading.Barrier(hits)
+    errors = []
+
+    def worker(i):
+        barrier.wait()
+        try:
+            hit(client, site_id, pages[i % len(pages)])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(hits)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def environment(db_latency_ms):
+    db = local_dynamodb.LocalDynamoDB(latency=db_latency_ms / 1000)
+    db.create_table(main.TABLE_NAME, 'site_id')
+    db.create_table(main.PAGE_TABLE_NAME, 'site_id', 'page_name')
+    return db
+
+
+def counted_visits(db, layout, pages):
+    if layout == 'map':
+        item = db.Table(main.TABLE_NAME).get_item(Key={'site_id': 'bench'}).get('Item', {})
+        return sum(int(item.get('page_visits', {}).get(page, 0)) for page in pages)
+    table = db.Table(main.PAGE_TABLE_NAME)
+    return sum(int(table.get_item(Key={'site_id': 'bench', 'page_name': page}).get('Item', {}).get('visits', 0))
+               for page in pages)
+
+
+def bench(hits, page_count, existing_pages, db_latency_ms):
+    pages = [f'page-{i}' for i in range(page_count)]
+    print(f"{hits} concurrent hits over {page_count} pages (simulated DynamoDB latency {db_latency_ms} ms)")
+    print(f"  {'site':<22}{'counter':<20}{'counted':>9}{'lost':>7}{'calls/hit':>11}{'RCU/hit':>9}"
+          f"{'WCU/hit':>9}{'wall ms':>9}{'errors':>8}")
+    lost_by_increment = 0
+    counters = (
+        ('read-modify-write', 'map', read_modify_write),
+        ('in-place increment', 'map', main.increment_map_visits),
+        ('page items', 'item', main.increment_page_visits)
+    )
+    for site, existing in (('new', 0), (f'{existing_pages} pages counted', existing_pages)):
+        for label, layout, hit in counters:
+            db = environment(db_latency_ms)
+            client = db.client()
+            if existing and layout == 'map':
+                db.Table(main.TABLE_NAME).put_item(Item={
+                    'site_id': 'bench', 'page_visits': {f'other-page-{i}': 1000 + i for i in range(existing)}
+                })
+            elif existing:
+                with db.Table(main.PAGE_TABLE_NAME).batch_writer() as batch:
+                    for i in range(existing):
+                        batch.put_item(Item={'site_id': 'bench', 'page_name': f'other-page-{i}', 'visits': 1000 + i})
+            db.reset_counters()
+
+            started = time.perf_counter()
+            errors = run_hits(hit, client, 'bench', pages, hits)
+            elapsed = time.perf_counter() - started
+
+            usage = db.usage()[main.TABLE_NAME if layout == 'map' else main.PAGE_TABLE_NAME]
+            counted = counted_visits(db, layout, pages)
+            lost = hits - counted
+            if hit is not read_modify_write:
+                lost_by_increment += lost
+            print(f"  {site:<22}{label:<20}{counted:>9}{lost:>7}{sum(usage['calls'].values()) / hits:>11.2f}"
+                  f"{usage['read_units'] / hits:>9.2f}{usage['write_units'] / hits:>9.2f}"
+                  f"{elapsed * 1000:>9.0f}{len(errors):>8}")
+    return lost_by_increment
+
+
+def bench_migration(sites, site_pages, workers, db_latency_ms):
+    db = environment(db_latency_ms)
+    client = db.client()
+    with db.Table(main.TABLE_NAME).batch_writer() as batch:
+        for site in range(sites):
+            batch.put_item(Item={
+                'site_id': f'site-{site}', 'page_visits': {f'page-{page}': site + page for page in range(site_pages)}
+            })
+    db.reset_counters()
+
+    result = migrate_page_visits.Migration(client, workers).run(migrate_page_visits.site_items(client))
+    usage = db.usage()
+    print(f"Migrated {result['sites']} sites, {result['pages']} pages in {result['seconds'] * 1000:.0f} ms: "
+          f"{usage[main.TABLE_NAME]['calls'].get('Scan', 0)} scans, {result['calls']} UpdateItem calls, "
+          f"{usage[main.PAGE_TABLE_NAME]['write_units']:.0f} WCU")
+
+    # Hits after the switch land in the page items, hits still on the old layout land in the maps;
+    # running the migration again must keep the first and carry over the second
+    for page in range(site_pages):
+        main.increment_page_visits(client, 'site-0', f'page-{page}', 3)
+        main.increment_map_visits(client, 'site-1', f'page-{page}', 2)
+    db.reset_counters()
+    result = migrate_page_visits.Migration(client, workers).run(migrate_page_visits.site_items(client))
+    print(f"Migrated again: {result['merged']} pages merged, {result['unchanged']} already up to date, "
+          f"{db.usage()[main.PAGE_TABLE_NAME]['write_units']:.0f} WCU")
+
+    mismatched = sum(len(migrate_page_visits.differences(client, item))
+                     for item in migrate_page_visits.site_items(client))
+    pages = db.Table(main.PAGE_TABLE_NAME)
+    for site, extra in ((0, 3), (1, 2), (2, 0)):
+        for page in range(site_pages):
+            item = pages.get_item(Key={'site_id': f'site-{site}', 'page_name': f'page-{page}'}).get('Item', {})
+            if int(item.get('visits', 0)) != site + page + extra:
+                mismatched += 1
+    db.reset_counters()
+    listed, calls, start_after = 0, 0, None
+    while True:
+        visits, start_after = main.query_page_visits(client, 'site-0', main.LIST_LIMIT, start_after)
+        listed += len(visits)
+        calls += 1
+        if start_after is None:
+            break
+    usage = db.usage()[main.PAGE_TABLE_NAME]
+    print(f"Listed site-0's {listed} pages in {calls} queries of {main.LIST_LIMIT}: "
+          f"{usage['read_units']:.1f} RCU; {mismatched} migrated pages lost or double-counted hits")
+    return mismatched
+
+
+class Context:
+    def get_remaining_time_in_millis(self):
+        return 3000
+
+
+def bench_write_behind(hits, page_count, max_hits, db_latency_ms):
+    # Hits skewed towards the first pages, the way a site's home page outdraws the rest
+    rng = random.Random(1)
+    weights = [1 / (rank + 1) for rank in range(page_count)]
+    pages = rng.choices([f'page-{i}' for i in range(page_count)], weights, k=hits)
+    print(f"{hits} hits in turn over {page_count} pages, buffer flushed every {max_hits} hits")
+    print(f"  {'mode':<14}{'calls/hit':>11}{'WCU/hit':>9}{'hit p50 ms':>12}{'flushes':>9}{'flush p50 ms':>14}"
+          f"{'flush max ms':>14}{'counted':>9}")
+    lost = 0
+    main.PAGE_LAYOUT = 'item'
+    quiet = logging.getLogger('bench.visit_buffer')  # a line per flush; the table sums them up instead
+    quiet.disabled = True
+    for mode in ('direct', 'write-behind'):
+        db = environment(db_latency_ms)
+        main.dynamodb = db.client()
+        buffer = None
+        if mode == 'write-behind':
+            buffer = visit_buffer.VisitBuffer(main.increment_visits, max_hits=max_hits, max_seconds=60,
+                                              logger=quiet)
+        main.visit_buffer = buffer
+        latencies = []
+        for page in pages:
+            started = time.perf_counter()
+            main.lambda_handler({'queryStringParameters': {'site_id': 'bench', 'page_name': page}}, Context())
+            latencies.append(time.perf_counter() - started)
+        if buffer:
+            # What a shutdown signal would write out
+            buffer.flush('shutdown')
+        usage = db.usage()[main.PAGE_TABLE_NAME]
+        counted = counted_visits(db, 'item', set(pages))
+        lost += hits - counted
+        stats = buffer.stats() if buffer else {'flushes': 0, 'flush_ms_p50': 0.0, 'flush_ms_max': 0.0}
+        print(f"  {mode:<14}{sum(usage['calls'].values()) / hits:>11.3f}{usage['write_units'] / hits:>9.3f}"
+              f"{sorted(latencies)[len(latencies) // 2] * 1000:>12.2f}{stats['flushes']:>9}"
+              f"{stats['flush_ms_p50']:>14.1f}{stats['flush_ms_max']:>14.1f}{counted:>9}")
+    main.visit_buffer = None
+    return lost
+
+
+def bench_shutdown_signal(hits=10, write_seconds=0.3, signal_after=0.1):
+    """SIGTERM arriving while a flush's writes are in flight: the handler that was installed before
+    the buffer's (SIG_DFL would end the process) must only run once they have been written"""
+    written = []
+    seen = []
+
+    def increment(site_id, page_name, amount):
+        time.sleep(write_seconds)
+        written.append(amount)
+
+    saved = {signum: signal.getsignal(signum) for signum in visit_buffer.SHUTDOWN_SIGNALS}
+    signal.signal(signal.SIGTERM, lambda signum, frame: seen.append(sum(written)))
+    try:
+        buffer = visit_buffer.VisitBuffer(increment, max_hits=hits + 1, logger=logging.getLogger('bench.visit_buffer'))
+        buffer.install_signal_handlers()
+        for i in range(hits):
+            buffer.add('bench', f'page-{i % 3}')
+        threading.Timer(signal_after, os.kill, (os.getpid(), signal.SIGTERM)).start()
+        buffer.flush('count', budget=write_seconds * 10)
+    finally:
+        for signum, handler in saved.items():
+            signal.signal(signum, handler)
+    print(f"SIGTERM {signal_after * 1000:.0f} ms into a flush of {hits} hits: previous handler ran "
+          f"{len(seen)} time(s), after {seen[0] if seen else 0} hits were written")
+    return 0 if seen == [hits] else hits
+
+
+def main_():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--hits', type=int, default=500)
+    parser.add_argument('--pages', type=int, default=5)
+    parser.add_argument('--existing-pages', type=int, default=200)
+    parser.add_argument('--db-latency-ms', type=float, default=5.0)
+    parser.add_argument('--sites', type=int, default=200)
+    parser.add_argument('--site-pages', type=int, default=300)
+    parser.add_argument('--migration-workers', type=int, default=32)
+    parser.add_argument('--write-behind-hits', type=int, default=2000)
+    parser.add_argument('--max-hits', type=int, default=100)
+    args = parser.parse_args()
+    failed = bench(args.hits, args.pages, args.existing_pages, args.db_latency_ms)
+    failed += bench_migration(args.sites, args.site_pages, args.migration_workers, args.db_latency_ms)
+    failed += bench_write_behind(args.write_behind_hits, args.pages, args.max_hits, args.db_latency_ms)
+    failed += bench_shutdown_signal()
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main_()
@@ -0,0 +1,188 @@
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+# Write-behind buffer for page visit counts (WRITE_BEHIND=1 in main.py).
+#
+# Hits are added up per (site_id, page_name) in the warm container and written as one merged
+# increment per page once the buffer holds max_hits hits or its oldest hit is max_seconds old.
+# Lambda freezes the container between invocations, so there is no timer: the thresholds are
+# checked as each hit is buffered and the flush runs in that invocation. A flush writes the
+# busiest pages first and stops starting writes once flush_budget_ms is spent or the invocation
+# is that close to its own timeout; what is left stays buffered, keeping its age, for the next one.
+# Failed writes go back in the buffer too. SIGTERM and SIGINT flush what they can first; Lambda
+# only sends SIGTERM at shutdown when the function has an extension registered, and hits
+# buffered in a container reclaimed without one are lost. A signal that interrupts the main
+# thread inside add(), due() or flush() is held until that call returns: the shutdown flush never
+# swaps the buffer out from under add(), and never hands the signal on (which may end the
+# process) while an interrupted flush still has writes in flight.
+
+FLUSH_HISTORY = 1000
+SHUTDOWN_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class VisitBuffer:
+    """Counts hits per (site_id, page_name) and writes them out as merged increments"""
+
+    def __init__(self, increment, max_hits=100, max_seconds=5.0, flush_budget_ms=250, workers=8, logger=None):
+        self.increment = increment  # (site_id, page_name, amount) -> new count
+        self.max_hits = max_hits
+        self.max_seconds = max_seconds
+        self.flush_budget = flush_budget_ms / 1000
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.logger = logger or logging.getLogger(__name__)
+        # Re-entrant: a shutdown signal can arrive while the main thread holds it
+        self.lock = threading.RLock()
+        self.depth = 0  # critical sections the main thread is inside
+        self.deferred = None  # (signum, frame, previous handler) held until they're all done
+        self.pending = {}
+        self.pending_hits = 0
+        self.oldest = None
+        self.hits = 0
+        self.flushes = 0
+        self.updates = 0
+        self.written = 0
+        self.failed = 0
+        self.flush_ms = []
+
+    @contextmanager
+    def deferring(self):
+        """A shutdown signal the main thread takes meanwhile is handled on the way out"""
+        main = threading.current_thread() is threading.main_thread()
+        if main:
+            self.depth += 1
+        try:
+            yield
+        finally:
+            if main:
+                self.depth -= 1
+        if main and not self.depth and self.deferred:
+            deferred, self.deferred = self.deferred, None
+            self.shutdown(*deferred)
+
+    @contextmanager
+    def critical(self):
+        """Hold the lock, deferring shutdown signals until it's released"""
+        with self.deferring(), self.lock:
+            yield
+
+    def add(self, site_id, page_name):
+        """Buffer one hit; returns the hits now buffered for that page"""
+        key = (site_id, page_name)
+        with self.critical():
+            self.pending[key] = self.pending.get(key, 0) + 1
+            self.pending_hits += 1
+            self.hits += 1
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            count = self.pending[key]
+        return count
+
+    def due(self):
+        """Why the buffer should be flushed now ('count' or 'age'), or None"""
+        with self.critical():
+            if not self.pending_hits:
+                return None
+            if self.pending_hits >= self.max_hits:
+                return 'count'
+            if time.monotonic() - self.oldest >= self.max_seconds:
+                return 'age'
+            return None
+
+    def write(self, key, amount, deadline):
+        if time.perf_counter() > deadline:
+            return False
+        try:
+            self.increment(key[0], key[1], amount)
+            return True
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            return False
+
+    def flush(self, reason='flush', context=None, budget=None):
+        """Write out buffered hits within the budget (seconds) and the invocation's remaining time"""
+        # The writes in flight are covered too: a shutdown signal waits for them, then flushes the rest
+        with self.deferring():
+            started = time.perf_counter()
+            deadline = started + (self.flush_budget if budget is None else budget)
+            if context is not None:
+                deadline = min(deadline, started + context.get_remaining_time_in_millis() / 1000 - self.flush_budget)
+            with self.lock:
+                if not self.pending:
+                    return 0
+                batch, self.pending = self.pending, {}
+                oldest, self.oldest = self.oldest, None
+                self.pending_hits = 0
+
+            keys = sorted(batch, key=batch.get, reverse=True)
+            results = list(self.executor.map(lambda key: self.write(key, batch[key], deadline), keys))
+
+            updates = hits = 0
+            with self.lock:
+                for key, done in zip(keys, results):
+                    if done:
+                        updates += 1
+                        hits += batch[key]
+                    else:
+                        self.pending[key] = self.pending.get(key, 0) + batch[key]
+                        self.pending_hits += batch[key]
+                if hits < sum(batch.values()):
+                    # What is left keeps its age, so the next invocation picks it up straight away
+                    self.oldest = oldest if self.oldest is None else min(self.oldest, oldest)
+                elapsed = (time.perf_counter() - started) * 1000
+                self.flushes += 1
+                self.updates += updates
+                self.written += hits
+                self.flush_ms.append(elapsed)
+                del self.flush_ms[:-FLUSH_HISTORY]
+                left = self.pending_hits
+            self.logger.info(json.dumps({'write_behind': {
+                'reason': reason, 'updates': updates, 'hits': hits, 'left': left, 'ms': round(elapsed, 1)
+            }}))
+            return hits
+
+    def shutdown(self, signum, frame, previous):
+        """Flush for a shutdown signal, then hand it to whatever handled it before"""
+        self.flush(signal.Signals(signum).name)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+
+    def install_signal_handlers(self):
+        """Flush on SIGTERM/SIGINT, then hand the signal to whatever handled it before"""
+        if threading.current_thread() is not threading.main_thread():
+            return
+        for signum in SHUTDOWN_SIGNALS:
+            previous = signal.getsignal(signum)
+
+            def handler(signum, frame, previous=previous):
+                if self.depth:
+                    # The main thread was interrupted mid-update: critical() runs this once it's done
+                    self.deferred = (signum, frame, previous)
+                else:
+                    self.shutdown(signum, frame, previous)
+
+            signal.signal(signum, handler)
+
+    def stats(self):
+        with self.lock:
+            durations = sorted(self.flush_ms)
+            return {
+                'hits': self.hits,
+                'pending_hits': self.pending_hits,
+                'pending_pages': len(self.pending),
+                'flushes': self.flushes,
+                'updates': self.updates,
+                'written': self.written,
+                'failed': self.failed,
+                'flush_ms_p50': durations[len(durations) // 2] if durations else 0.0,
+                'flush_ms_max': durations[-1] if durations else 0.0
+            }